@@ -0,0 +1,249 @@
+import argparse
+import base64
+import json
+import os
+import socket
+import socketserver
+import tempfile
+import numpy as np
+import soundfile as sf
+from analysis_profiles import DEFAULT_PROFILE, PROFILE_ORDER
+
+SOCKET_PATH = os.environ.get("ANALYSIS_SOCKET", os.path.join(tempfile.gettempdir(), f"audio_analysis-{os.getuid()}.sock"))
+CONNECT_TIMEOUT = 0.5  # Seconds to wait for a running daemon before analyzing in-process
+REQUEST_TIMEOUT = 3600  # Seconds a client waits for the results of one request
+
+# The daemon does not import the analysis modules until it starts serving, and clients never do
+# while a daemon is running, so that a short command skips the TensorFlow and torch start-up.
+
+def encode_attributes(attributes):
+    """Make an attribute dict from audio_analysis.analyze() JSON serializable."""
+    encoded = dict(attributes)
+    if encoded.get("fingerprint") is not None:
+        encoded["fingerprint"] = base64.b64encode(np.asarray(encoded["fingerprint"], dtype="<u4").tobytes()).decode("ascii")
+    for name, value in encoded.items():
+        if isinstance(value, np.generic):
+            encoded[name] = value.item()
+    return encoded
+
+def decode_attributes(encoded):
+    """Inverse of encode_attributes()."""
+    attributes = dict(encoded)
+    if attributes.get("fingerprint") is not None:
+        attributes["fingerprint"] = np.frombuffer(base64.b64decode(attributes["fingerprint"]), dtype="<u4")
+    return attributes
+
+def encode_buffer(name, audio_data, sample_rate):
+    """
+    Describe decoded audio for an analyze request.
+
+    Args:
+        name (str): File name used for path tags, e.g. "Bass_120_Am.wav".
+        audio_data (numpy.array): Audio data, mono or shaped (frames, channels).
+        sample_rate (int): Sample rate of the audio data.
+    """
+    audio_data = np.asarray(audio_data, dtype="<f4")
+    return {
+        "name": name,
+        "sample_rate": int(sample_rate),
+        "channels": 1 if audio_data.ndim == 1 else audio_data.shape[1],
+        "data": base64.b64encode(audio_data.tobytes()).decode("ascii"),
+    }
+
+def analyze_buffer(buffer, profile):
+    """Analyze a buffer from encode_buffer() by writing it to a temporary file with its name."""
+    import audio_analysis
+
+    audio_data = np.frombuffer(base64.b64decode(buffer["data"]), dtype="<f4").reshape(-1, buffer["channels"])
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, os.path.basename(buffer["name"]) or "buffer.wav")
+        sf.write(path, audio_data, buffer["sample_rate"])
+        return audio_analysis.analyze(path, profile=profile)
+
+def warm_models(profile=DEFAULT_PROFILE):
+    """Load the models `profile` uses, so the first request does not wait for them."""
+    import analysis_profiles
+    import audio_analysis
+
+    settings = analysis_profiles.get_profile(profile)
+    if settings["clap"]:
+        audio_analysis.clap_text_embeddings()
+    if settings["crepe_model"]:
+        import crepe.core
+        crepe.core.build_and_load_model(settings["crepe_model"])
+
+class AnalysisRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Serve requests of one connection, one JSON object per line in each direction.
+
+    Requests:
+    - {"command": "ping"}
+    - {"command": "analyze", "paths": [...], "buffers": [...], "profile": "fast"}
+    - {"command": "shutdown"}
+    """
+
+    def handle(self):
+        import audio_analysis
+
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                command = request.get("command")
+
+                if command == "ping":
+                    response = {"ok": True, "pid": os.getpid()}
+                elif command == "shutdown":
+                    response = {"ok": True}
+                    self.server.shutdown_requested = True
+                elif command == "analyze":
+                    profile = request.get("profile", DEFAULT_PROFILE)
+                    results = []
+                    for path in request.get("paths", []):
+                        try:
+                            results.append({"path": path, "attributes": [encode_attributes(a) for a in audio_analysis.analyze(path, profile=profile)]})
+                        except Exception as e:
+                            results.append({"path": path, "error": f"{type(e).__name__}: {e}"})
+                    for buffer in request.get("buffers", []):
+                        try:
+                            results.append({"path": buffer["name"], "attributes": [encode_attributes(a) for a in analyze_buffer(buffer, profile)]})
+                        except Exception as e:
+                            results.append({"path": buffer["name"], "error": f"{type(e).__name__}: {e}"})
+                    response = {"ok": True, "results": results}
+                else:
+                    response = {"ok": False, "error": f"Unknown command: {command}"}
+            except Exception as e:
+                response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+            self.wfile.flush()
+
+            if self.server.shutdown_requested:
+                return
+
+class AnalysisServer(socketserver.UnixStreamServer):
+    # Requests are served one at a time: the models are shared and not safe to call concurrently
+    shutdown_requested = False
+    timeout = 0.5  # Seconds handle_request() waits, so shutdown requests and interrupts are noticed
+
+def serve(socket_path=SOCKET_PATH, profiles=(DEFAULT_PROFILE,)):
+    """
+    Run the analysis daemon until it is asked to shut down or interrupted.
+
+    Parameters:
+    - socket_path (str, optional): Path of the Unix socket to listen on.
+    - profiles (list, optional): Profiles whose models are loaded before the first request.
+    """
+    if os.path.exists(socket_path):
+        if request({"command": "ping"}, socket_path) is not None:
+            print(f"An analysis daemon is already listening on {socket_path}")
+            return
+        os.unlink(socket_path)  # Left behind by a daemon that did not exit cleanly
+
+    for profile in profiles:
+        warm_models(profile)
+
+    old_umask = os.umask(0o177)  # Only the owner may connect
+    try:
+        server = AnalysisServer(socket_path, AnalysisRequestHandler)
+    finally:
+        os.umask(old_umask)
+
+    print(f"Analysis daemon listening on {socket_path}")
+    try:
+        while not server.shutdown_requested:
+            server.handle_request()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+def request(message, socket_path=SOCKET_PATH, timeout=REQUEST_TIMEOUT):
+    """
+    Send one request to the daemon and return its response, or None if no daemon is running.
+
+    Raises:
+    - TimeoutError: If the daemon took the request but did not answer within `timeout` seconds.
+      It may still be working on it, so the request is not repeated elsewhere.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        try:
+            client.settimeout(CONNECT_TIMEOUT)
+            client.connect(socket_path)
+        except OSError:
+            # No socket, a stale one, or one we may not connect to
+            return None
+
+        try:
+            client.settimeout(timeout)
+            client.sendall(json.dumps(message).encode() + b"\n")
+
+            with client.makefile("rb") as stream:
+                line = stream.readline()
+        except socket.timeout:
+            raise TimeoutError(f"The analysis daemon did not answer within {timeout} seconds")
+        except OSError:
+            # The daemon went away before answering
+            return None
+
+    if not line:
+        return None
+    return json.loads(line)
+
+def analyze_paths(paths, profile=DEFAULT_PROFILE, socket_path=SOCKET_PATH):
+    """
+    Analyze audio files with the daemon when it is running, or in this process when it is not.
+
+    Returns:
+    - dict: Absolute path -> list of attribute dicts as returned by audio_analysis.analyze().
+      Files that failed, or every file if the daemon timed out, map to the error message instead.
+    """
+    # The daemon resolves relative paths against its own working directory, not ours
+    paths = [os.path.abspath(path) for path in paths]
+
+    try:
+        response = request({"command": "analyze", "paths": paths, "profile": profile}, socket_path)
+    except TimeoutError as e:
+        # Analyzing here as well would only repeat the work the daemon is still doing
+        print(f"An error occurred: {str(e)}")
+        return {path: f"TimeoutError: {e}" for path in paths}
+
+    if response is not None and response.get("ok"):
+        return {
+            result["path"]: result["error"] if "error" in result else [decode_attributes(a) for a in result["attributes"]]
+            for result in response["results"]
+        }
+
+    # No daemon: pay the model start-up here
+    import audio_analysis
+
+    results = {}
+    for path in paths:
+        try:
+            results[path] = audio_analysis.analyze(path, profile=profile)
+        except Exception as e:
+            results[path] = f"{type(e).__name__}: {e}"
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep the analysis models loaded and analyze files on request.")
+    parser.add_argument("paths", nargs="*", help="Audio files to analyze.")
+    parser.add_argument("--serve", action="store_true", help="Run the daemon.")
+    parser.add_argument("--stop", action="store_true", help="Ask a running daemon to exit.")
+    parser.add_argument("--socket", default=SOCKET_PATH, help="Path of the Unix socket.")
+    parser.add_argument("--profile", default=DEFAULT_PROFILE, choices=PROFILE_ORDER, help="Analysis profile.")
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.socket, [args.profile])
+    elif args.stop:
+        print("Stopped" if request({"command": "shutdown"}, args.socket) else "No analysis daemon is running")
+    else:
+        for path, attributes in analyze_paths(args.paths, args.profile, args.socket).items():
+            if isinstance(attributes, str):
+                print(f"{path}: An error occurred: {attributes}")
+                continue
+            for segment in attributes:
+                print(f"{path}: key={segment['musical_key']} {segment['scale_mode']}, tempo={segment['tempo']}, "
+                      f"instrument={segment['instrument_type']}, segment={segment['segment_start']}-{segment['segment_end']}")
@@ -0,0 +1,62 @@
+import key_detection
+
+# Duration window of analysis. These live here rather than in audio_analysis so that header-only
+# tools such as prescan.py can use them without importing librosa, TensorFlow and torch.
+MIN_DURATION = 3.0  # Seconds; shorter files are not analyzed
+MAX_DURATION = 24.0  # Seconds; longer files are analyzed as segments
+SEGMENT_TARGET_SECONDS = 12.0  # Segments are the whole number of bars closest to this length
+
+# Named analysis profiles, cheapest first. Each one chooses which extractors run and how:
+# - sample_rate: rate the audio is decoded at for analysis (None keeps the file's own rate)
+# - tempo_seconds: audio given to beat_track when the path has no tempo (None for all of it)
+# - clap: classify the instrument with CLAP when the path has no instrument tag
+# - crepe_model: CREPE capacity for keys the chroma detector is unsure of (None skips CREPE)
+# - pitch_seconds: audio pitched by CREPE per file
+# - key_confidence: chroma correlation needed to accept a key without CREPE
+# - upgrade_below: rows analyzed with this profile and a lower confidence are refined by an upgrade pass
+PROFILES = {
+    "fast": {
+        "sample_rate": 22050,
+        "tempo_seconds": 10.0,
+        "clap": False,
+        "crepe_model": None,
+        "pitch_seconds": 0.5,
+        "key_confidence": key_detection.CONFIDENCE_THRESHOLD,
+        "upgrade_below": 0.6,
+    },
+    "balanced": {
+        "sample_rate": None,
+        "tempo_seconds": None,
+        "clap": True,
+        "crepe_model": "tiny",
+        "pitch_seconds": 0.5,
+        "key_confidence": key_detection.CONFIDENCE_THRESHOLD,
+        "upgrade_below": 0.5,
+    },
+    "accurate": {
+        "sample_rate": None,
+        "tempo_seconds": None,
+        "clap": True,
+        "crepe_model": "medium",
+        "pitch_seconds": 2.0,
+        "key_confidence": 0.75,
+        "upgrade_below": 0.0,
+    },
+}
+PROFILE_ORDER = ["fast", "balanced", "accurate"]
+DEFAULT_PROFILE = "balanced"
+
+def get_profile(name):
+    """
+    Return the settings of an analysis profile.
+
+    Raises:
+    - ValueError: If there is no profile of that name.
+    """
+    if name not in PROFILES:
+        raise ValueError(f"Invalid profile: {name}. Expected one of: {', '.join(PROFILE_ORDER)}.")
+    return PROFILES[name]
+
+def cheaper_profiles(name):
+    """Return the names of the profiles below `name`, whose rows an upgrade to it may refine."""
+    return PROFILE_ORDER[:PROFILE_ORDER.index(name)]
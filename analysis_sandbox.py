@@ -0,0 +1,190 @@
+import multiprocessing
+import os
+import time
+from analysis_profiles import DEFAULT_PROFILE
+import profiling
+
+FILE_TIMEOUT_SECONDS = 300  # Wall-clock limit for analyzing one file
+FILE_MEMORY_LIMIT_MB = 4096  # Resident memory limit of the analysis process
+POLL_SECONDS = 0.5  # How often the supervisor checks the deadline and memory use
+HEARTBEAT_SECONDS = 30.0  # How often a call's heartbeat callback runs while the call is in progress
+STAGE_LENGTH = 32
+
+class FileFailure(Exception):
+    """Analysis of a file failed, timed out, ran out of memory or crashed its process."""
+
+    def __init__(self, stage, error):
+        super().__init__(f"{stage}: {error}")
+        self.stage = stage
+        self.error = error
+
+def resident_mb(pid):
+    """Return the resident memory of a process in MB, or None where /proc is not available."""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+def worker_main(conn, stage):
+    """
+    Serve analysis requests from the supervisor until the pipe is closed.
+
+    Runs in the child process, so the models are loaded once per process rather than once per file.
+    """
+    import main_analysis
+    import audio_analysis as analysis
+    from database_setup import engine
+
+    # Connections inherited from the parent must not be shared
+    engine.dispose()
+
+    def report_stage(name):
+        stage.value = name.encode()[:STAGE_LENGTH - 1]
+
+    while True:
+        try:
+            command, payload = conn.recv()
+        except EOFError:
+            return
+
+        try:
+            if command == "analyze":
+                path, profile = payload
+                pitch_queue = []
+                audio_files = main_analysis.create_audio_files_from_analysis(path, pitch_queue, report_stage, profile)
+                conn.send(("ok", [(audio_file, any(audio_file is queued for queued in pitch_queue)) for audio_file in audio_files]))
+            elif command == "pitch":
+                report_stage("pitch")
+                analysis.resolve_pending_keys(payload)
+                conn.send(("ok", [(audio_file.key, audio_file.analysis_confidence) for audio_file in payload]))
+        except BaseException as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+class AnalysisSandbox:
+    """
+    Run file analysis in a separate process that is killed when it exceeds its limits.
+
+    A file that hangs CREPE, CLAP or the decoder, or that makes the process grow past the
+    memory limit, only costs its own time budget: the process is killed, a FileFailure is
+    raised for that file, and a fresh process takes the next one.
+    """
+
+    def __init__(self, timeout=FILE_TIMEOUT_SECONDS, memory_limit_mb=FILE_MEMORY_LIMIT_MB):
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.context = multiprocessing.get_context("spawn")
+        self.stage = self.context.Array("c", STAGE_LENGTH)
+        self.process = None
+        self.conn = None
+
+    def start(self):
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(target=worker_main, args=(child_conn, self.stage), daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def kill(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.join()
+            self.conn.close()
+        self.process = None
+        self.conn = None
+
+    def close(self):
+        if self.process is not None:
+            self.conn.close()
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.kill()
+            self.process = None
+            self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.close()
+
+    def call(self, command, payload, timeout=None, target=None, heartbeat=None):
+        if self.process is None or not self.process.is_alive():
+            self.kill()
+            self.start()
+
+        if timeout is None:
+            timeout = self.timeout
+
+        self.stage.value = b"queued"
+        self.conn.send((command, payload))
+        started = time.monotonic()
+        deadline = started + timeout
+        next_heartbeat = started + HEARTBEAT_SECONDS
+
+        while True:
+            try:
+                ready = self.conn.poll(POLL_SECONDS)
+            except (EOFError, OSError):
+                ready = True
+
+            if ready:
+                try:
+                    status, result = self.conn.recv()
+                except (EOFError, OSError):
+                    stage = self.stage.value.decode()
+                    self.kill()
+                    self.record_killed(command, target, started, stage, "exited unexpectedly")
+                    raise FileFailure(stage, "Analysis process exited unexpectedly")
+
+                if status == "error":
+                    raise FileFailure(self.stage.value.decode(), result)
+                return result
+
+            stage = self.stage.value.decode()
+
+            # Keeps e.g. the queue lease of a long batch alive while the process works on it
+            if heartbeat is not None and time.monotonic() >= next_heartbeat:
+                next_heartbeat = time.monotonic() + HEARTBEAT_SECONDS
+                try:
+                    heartbeat()
+                except Exception as e:
+                    print(f"An error occurred: {str(e)}")
+
+            if time.monotonic() > deadline:
+                self.kill()
+                self.record_killed(command, target, started, stage, "timed out")
+                raise FileFailure(stage, f"Timed out after {timeout} seconds")
+
+            memory = resident_mb(self.process.pid)
+            if self.memory_limit_mb and memory is not None and memory > self.memory_limit_mb:
+                self.kill()
+                self.record_killed(command, target, started, stage, "exceeded the memory limit")
+                raise FileFailure(stage, f"Exceeded the memory limit of {self.memory_limit_mb} MB")
+
+    @staticmethod
+    def record_killed(command, target, started, stage, reason):
+        # The killed process never finishes its profile, so the slow file is recorded from here
+        profiling.record_killed(command, target, time.monotonic() - started, stage, reason)
+
+    def analyze(self, path, profile=DEFAULT_PROFILE):
+        """
+        Analyze one file with an analysis profile (see analysis_profiles.py).
+
+        Returns:
+        - list: (AudioFile, whether it still needs CREPE) pairs, one per stored sample of the
+          file. Segmented long files give several, files that are too short none.
+        """
+        return self.call("analyze", (path, profile), target=path)
+
+    def pitch(self, audio_files, heartbeat=None):
+        """
+        Pitch audio files with CREPE in one batch and set their keys and confidences.
+
+        heartbeat, if given, is called every HEARTBEAT_SECONDS while the batch runs.
+        """
+        results = self.call("pitch", audio_files, target=[audio_file.absolute_path for audio_file in audio_files],
+                            heartbeat=heartbeat)
+        for audio_file, (key, confidence) in zip(audio_files, results):
+            audio_file.key = key
+            audio_file.analysis_confidence = confidence
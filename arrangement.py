@@ -0,0 +1,220 @@
+import os
+import numpy as np
+import soundfile as sf
+import process_audio as pa
+import stem_store
+import gain_staging
+
+DEFAULT_CROSSFADE_MS = 30  # Ramp applied where a layer enters or leaves, to avoid clicks
+
+ALL_LAYERS = ["drums", "bass", "melodic", "fx", "vocals", "percussion"]
+
+DEFAULT_ARRANGEMENT = [
+    {"name": "intro", "bars": 8, "layers": ["melodic", "fx"], "fade_in_ms": 2000},
+    {"name": "verse", "bars": 16, "layers": ["drums", "bass", "melodic"]},
+    {"name": "drop", "bars": 16, "layers": ALL_LAYERS},
+    {"name": "breakdown", "bars": 8, "layers": ["melodic", "vocals", "fx"]},
+    {"name": "drop", "bars": 16, "layers": ALL_LAYERS},
+    {"name": "outro", "bars": 8, "layers": ["drums", "melodic"], "fade_out_ms": 4000},
+]
+
+def layout_sections(timeline, samplerate, tempo, beats_per_measure=4):
+    """
+    Convert a timeline measured in bars into sections with sample positions.
+
+    Bar lengths are computed the same way as in process_audio.trim_to_loop, so sections line up
+    with the loop boundaries of the prepared stems.
+
+    Parameters:
+    - timeline (list): Section dicts with "name", "bars", "layers" and optional "fade_in_ms" / "fade_out_ms".
+    - samplerate (int): Sample rate of the song.
+    - tempo (float): Tempo of the song in BPM.
+    - beats_per_measure (int, optional): Beats per bar. Defaults to 4.
+
+    Returns:
+    - list: Copies of the section dicts with "start" and "end" sample positions added.
+    """
+    samples_per_beat = int((60.0 / tempo) * samplerate)
+    samples_per_measure = samples_per_beat * beats_per_measure
+
+    sections = []
+    position = 0
+
+    for section in timeline:
+        length = int(section["bars"]) * samples_per_measure
+        sections.append({**section, "layers": set(section["layers"]), "start": position, "end": position + length})
+        position += length
+
+    return sections
+
+def layer_envelope(sections, layer, start, out, crossfade_samples):
+    """
+    Fill `out` with the gain of one layer for the block starting at song frame `start`.
+
+    The gain is 1 inside sections where the layer is active and 0 elsewhere, with linear ramps
+    of crossfade_samples where the layer enters or leaves the arrangement.
+
+    Returns:
+    - bool: False if the layer is silent for the whole block.
+    """
+    out.fill(0)
+    end = start + out.shape[0]
+    active = False
+
+    for index, section in enumerate(sections):
+        if layer not in section["layers"]:
+            continue
+
+        block_start = max(section["start"], start)
+        block_end = min(section["end"], end)
+        if block_start >= block_end:
+            continue
+
+        active = True
+        span = out[block_start - start:block_end - start]
+        span.fill(1)
+
+        if crossfade_samples > 0:
+            entering = index == 0 or layer not in sections[index - 1]["layers"]
+            leaving = index == len(sections) - 1 or layer not in sections[index + 1]["layers"]
+
+            if entering and block_start < section["start"] + crossfade_samples:
+                ramp = (np.arange(block_start, block_end) - section["start"]) / crossfade_samples
+                np.minimum(span, ramp, out=span, casting="unsafe")
+
+            if leaving and block_end > section["end"] - crossfade_samples:
+                ramp = (section["end"] - np.arange(block_start, block_end)) / crossfade_samples
+                np.minimum(span, ramp, out=span, casting="unsafe")
+
+    return active
+
+def section_fades(sections, start, out, samplerate):
+    """
+    Fill `out` with the master gain for the block starting at song frame `start`,
+    applying each section's optional "fade_in_ms" and "fade_out_ms".
+    """
+    out.fill(1)
+    end = start + out.shape[0]
+
+    for section in sections:
+        block_start = max(section["start"], start)
+        block_end = min(section["end"], end)
+        if block_start >= block_end:
+            continue
+
+        span = out[block_start - start:block_end - start]
+
+        fade_in_samples = int(section.get("fade_in_ms", 0) / 1000.0 * samplerate)
+        if fade_in_samples > 0 and block_start < section["start"] + fade_in_samples:
+            ramp = (np.arange(block_start, block_end) - section["start"]) / fade_in_samples
+            np.minimum(span, ramp, out=span, casting="unsafe")
+
+        fade_out_samples = int(section.get("fade_out_ms", 0) / 1000.0 * samplerate)
+        if fade_out_samples > 0 and block_end > section["end"] - fade_out_samples:
+            ramp = (section["end"] - np.arange(block_start, block_end)) / fade_out_samples
+            np.minimum(span, ramp, out=span, casting="unsafe")
+
+def render_arrangement(stems, timeline, samplerate, tempo, output_path, channels=2,
+                       block_size=None, crossfade_ms=DEFAULT_CROSSFADE_MS, beats_per_measure=4):
+    """
+    Render an arrangement block by block, writing each block to the output file as it is mixed.
+
+    Only one block of the song is held in memory at a time, so the length of the arrangement
+    does not affect memory use.
+
+    Parameters:
+    - stems (dict): Loop-ready audio data and linear gain per layer name, e.g. {"drums": (data, 1.0)}.
+    - timeline (list): Section dicts as accepted by layout_sections().
+    - samplerate (int): Sample rate of the stems and the output.
+    - tempo (float): Tempo of the stems in BPM.
+    - output_path (str): Path of the file to write.
+    - channels (int, optional): Number of output channels. Defaults to 2.
+    - block_size (int, optional): Frames rendered per block. Defaults to process_audio.MIX_BLOCK_SIZE.
+    - crossfade_ms (float, optional): Ramp length where a layer enters or leaves.
+    - beats_per_measure (int, optional): Beats per bar. Defaults to 4.
+
+    Returns:
+    - int: The number of frames written.
+    """
+    if block_size is None:
+        block_size = pa.MIX_BLOCK_SIZE
+
+    sections = layout_sections(timeline, samplerate, tempo, beats_per_measure)
+    total_frames = sections[-1]["end"] if sections else 0
+    crossfade_samples = int(crossfade_ms / 1000.0 * samplerate)
+
+    block = np.empty((block_size, channels), dtype=pa.MIX_DTYPE)
+    scratch = np.empty((block_size, channels), dtype=pa.MIX_DTYPE)
+    envelope = np.empty(block_size, dtype=pa.MIX_DTYPE)
+    master = np.empty(block_size, dtype=pa.MIX_DTYPE)
+
+    with sf.SoundFile(output_path, mode="w", samplerate=samplerate, channels=channels) as f:
+        for start in range(0, total_frames, block_size):
+            frames = min(block_size, total_frames - start)
+            out = block[:frames]
+            out.fill(0)
+
+            for name, (layer, gain) in stems.items():
+                layer_gain = envelope[:frames]
+                if not layer_envelope(sections, name, start, layer_gain, crossfade_samples):
+                    continue
+                layer_gain *= gain
+                pa.add_looped_layer(layer, start, out, layer_gain, scratch)
+
+            section_fades(sections, start, master[:frames], samplerate)
+            out *= master[:frames, np.newaxis]
+            gain_staging.limit_bus(out)
+
+            f.write(out)
+
+    return total_frames
+
+def render_song_arrangement(audiofile_objects, timeline=None, song_id=None, key=None):
+    """
+    Prepare stems with process_audio.prep_audio_files and render them along a timeline.
+
+    Stems are addressed in the timeline by their instrument type. If several stems share an
+    instrument type, the later ones are named "<type>_2", "<type>_3", ... and only play in
+    sections that list that name.
+
+    Parameters:
+    - audiofile_objects (list): Stretched AudioFile objects, as for process_audio.mix_audio_files.
+    - timeline (list, optional): Section dicts. Defaults to DEFAULT_ARRANGEMENT.
+    - song_id (str, optional): Suffix that keeps names unique within a batch.
+    - key (str, optional): Musical key of the song. Defaults to the key of its first keyed stem.
+
+    Returns:
+    - str: The path of the rendered song.
+    """
+    if timeline is None:
+        timeline = DEFAULT_ARRANGEMENT
+
+    raw_audio_data_list, audio_paths, target_samplerate, target_tempo, target_length, key, gains = pa.prep_audio_files(audiofile_objects, key)
+
+    stems = {}
+    for audiofile, data, gain in zip(audiofile_objects, raw_audio_data_list, gains):
+        name = audiofile.instrument_type
+        suffix = 2
+        while name in stems:
+            name = f"{audiofile.instrument_type}_{suffix}"
+            suffix += 1
+        stems[name] = (data, gain)
+
+    song_name = stem_store.new_song_name(song_id)
+    output_dir = "./output"
+    output_path = f"{output_dir}/arranged_audio_{song_name}_{key}_{target_tempo}.wav"
+
+    # Ensure the output directory exists
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    try:
+        render_arrangement(stems, timeline, target_samplerate, target_tempo, output_path)
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+
+    stem_store.write_song_manifest(song_name, output_path, audiofile_objects, gains, target_samplerate, target_tempo, key,
+                                   render={"mode": "arrangement", "timeline": timeline, "rubberband_args": pa.RUBBERBAND_ARGS,
+                                           "resample_quality": pa.RESAMPLE_QUALITY})
+
+    return output_path
@@ -1,90 +1,268 @@
+from functools import lru_cache
 import librosa
 import numpy as np
+import soundfile as sf
 import re
 import tags
 from msclap import CLAP
+import torch
 import torch.nn.functional as F
 import sys
 import utilities
 import audio_pitch_estimation as ape
+import audio_buffers
+from audio_buffers import MEMORY_BUDGET
+import gain_staging
+import key_detection
+import fingerprint
+import resampling
+import analysis_profiles
+import profiling
+from analysis_profiles import DEFAULT_PROFILE, MIN_DURATION, MAX_DURATION, SEGMENT_TARGET_SECONDS
 
 
-def analyze(audio_file_path):
+TEMPO_PROBE_SECONDS = 30.0  # Audio read to detect the tempo of a long file without one in its name
+SEGMENT_SILENCE_DB = -60.0  # Segments quieter than this are not stored
+
+def no_stage(stage):
+    pass
+
+@profiling.profiled("analyze")
+def analyze(audio_file_path, defer_pitch=False, duplicate_lookup=None, report_stage=no_stage, profile=DEFAULT_PROFILE):
+    """
+    Analyze an audio file with one of the profiles in analysis_profiles.
+
+    Files between MIN_DURATION and MAX_DURATION are analyzed whole. Longer files are streamed
+    and analyzed as segments by analyze_segments(), so their memory use does not depend on
+    their length.
+
+    Returns:
+    - list: One attribute dict per stored sample: a single one for a whole file, one per segment
+      for a long file, and none for files that are too short.
+    """
     print(audio_file_path)
-    if check_duration(audio_file_path):
-        print(f"Audio file path: {audio_file_path}")
-        return extract_audio_attributes(audio_file_path)
+    report_stage = profiling.stage_reporter(report_stage)
+    report_stage("decode")
+    duration = get_duration(audio_file_path)
+    print(duration)
+
+    if duration <= MIN_DURATION:
+        return []
+
+    if duration >= MAX_DURATION:
+        return analyze_segments(audio_file_path, defer_pitch, duplicate_lookup, report_stage, profile)
+
+    print(f"Audio file path: {audio_file_path}")
+    # The decoded file plus the copies made by the extractors
+    with MEMORY_BUDGET.reserve(audio_buffers.estimate_file_nbytes(audio_file_path, factor=3)):
+        return [extract_audio_attributes(audio_file_path, defer_pitch, duplicate_lookup, report_stage, profile)]
 
-def check_duration(audio_file_path, min_duration=3.0, max=24.0):
+def get_duration(audio_file_path):
+    """Return the duration of an audio file in seconds, read from its header only."""
+    info = sf.info(audio_file_path)
+    return info.frames / info.samplerate
+
+def check_duration(audio_file_path, min_duration=MIN_DURATION, max=MAX_DURATION):
     """
     Check the duration of an audio file to see if it falls within a specified range.
 
     Parameters:
     - audio_file_path (str): The path to the audio file to be checked.
-    - min_duration (float, optional): The minimum allowable duration in seconds (default is 6.0 seconds).
-    - max_duration (float, optional): The maximum allowable duration in seconds (default is 18.0 seconds).
+    - min_duration (float, optional): The minimum allowable duration in seconds (default is 3.0 seconds).
+    - max_duration (float, optional): The maximum allowable duration in seconds (default is 24.0 seconds).
 
     Returns:
     - bool: True if the audio file duration is within the specified range, False otherwise.
 
-    This function loads an audio file using the Librosa library and calculates its duration.
-    It then compares the duration to the specified minimum and maximum values.
-    If the duration falls within the specified range, the function returns True; otherwise, it returns False.
-    If any exceptions occur during the process, an error message is printed, and False is returned.
+    The duration is read from the file header, so the file is not decoded.
+    Files that cannot be read raise, so that the caller can record the failure instead of
+    silently skipping the file.
     """
-    check = False
+    duration = get_duration(audio_file_path)
+    return min_duration < duration < max
 
-    try:
-        # Load the audio file
-        y, sr = librosa.load(audio_file_path, sr=None)
-        
-        # Get the duration of the audio
-        duration = librosa.get_duration(y=y, sr=sr)
-        print(duration)
-        # Check if the duration is less than the threshold
-        if duration > min_duration:
-            
-            if duration < max:
-                check = True
+def tempo_from_path(file_path):
+    # Searching for tempo: Assume it is a number between 50 and 240
+    tempo_match = re.search(r"([5-9]\d|1\d\d|2[0-3]\d|240)", file_path)
+    if tempo_match:
+        return float(tempo_match.group(1))
+    return None
 
-        return check
-    
-    except Exception as e:
-        print(f"Error: {e}")
-        return False
+def segment_seconds(tempo, target=SEGMENT_TARGET_SECONDS, min_duration=MIN_DURATION, max_duration=MAX_DURATION):
+    """
+    Length of the segments of a long file: the whole number of 4/4 bars closest to `target`
+    that lies inside the duration window, or `target` itself when there is no usable tempo.
+    """
+    if not tempo or tempo <= 0:
+        return target
+
+    bar_seconds = 4 * 60.0 / tempo
+    bars = max(1, int(round(target / bar_seconds)))
+    while bars > 1 and bars * bar_seconds >= max_duration:
+        bars -= 1
+    while bars * bar_seconds <= min_duration:
+        bars += 1
+
+    if bars * bar_seconds >= max_duration:
+        return target
+    return bars * bar_seconds
+
+def analyze_segments(file_path, defer_pitch=False, duplicate_lookup=None, report_stage=no_stage, profile=DEFAULT_PROFILE):
+    """
+    Analyze a long audio file as consecutive segments, each stored as its own sample.
+
+    The tempo comes from the file name or from the first TEMPO_PROBE_SECONDS of audio, and the
+    segments are whole bars long, counted from the start of the file, so loops cut from stems
+    exported from a session line up with the grid. The file is read one segment at a time, so
+    only one segment is ever decoded. Silent segments and a tail shorter than MIN_DURATION are
+    skipped. Tempo and instrument are determined once for the whole file.
+
+    Returns:
+    - list: One attribute dict per segment, with "segment_start" and "segment_end" in frames.
+    """
+    settings = analysis_profiles.get_profile(profile)
+    probe_seconds = min(TEMPO_PROBE_SECONDS, settings["tempo_seconds"] or TEMPO_PROBE_SECONDS)
+
+    with sf.SoundFile(file_path) as f:
+        sr = f.samplerate
+        total_frames = f.frames
+        analysis_rate = settings["sample_rate"] or sr
+
+        tempo = tempo_from_path(file_path)
+        if tempo is None:
+            report_stage("tempo")
+            probe = f.read(min(total_frames, int(probe_seconds * sr)), dtype="float32", always_2d=True)
+            tempo, beats = librosa.beat.beat_track(y=probe.mean(axis=1), sr=sr)
+            tempo = float(np.atleast_1d(tempo)[0])
+            del probe
+            f.seek(0)
+
+        seconds = segment_seconds(tempo)
+        print(f"Splitting into segments of {seconds:.2f} seconds at {tempo} BPM")
+
+        segments = []
+        instrument_type = None
+        index = 0
+        start = 0
+
+        while start < total_frames:
+            end = min(total_frames, int(round((index + 1) * seconds * sr)))
+            index += 1
+
+            report_stage("decode")
+            with MEMORY_BUDGET.reserve((end - start) * f.channels * 4 * 3):
+                y = f.read(end - start, dtype="float32", always_2d=True).mean(axis=1)
+
+                level = gain_staging.rms_db(y)
+                if (end - start) / sr > MIN_DURATION and level is not None and level > SEGMENT_SILENCE_DB:
+                    if analysis_rate != sr:
+                        y = resampling.resample(y, sr, analysis_rate, "fast")
+                    attributes = extract_attributes(y, analysis_rate, file_path, defer_pitch, duplicate_lookup, report_stage,
+                                                    tempo=tempo, instrument_type=instrument_type, span=(start, end),
+                                                    source_rate=sr, profile=profile)
+                    instrument_type = attributes["instrument_type"]
+                    segments.append(attributes)
+
+            start = end
+
+    print(f"Analyzed {len(segments)} segments")
+    return segments
+
+def extract_audio_attributes(file_path, defer_pitch=False, duplicate_lookup=None, report_stage=no_stage, profile=DEFAULT_PROFILE):
+    """
+    Extract the musical attributes of a whole audio file. See extract_attributes().
+    """
+    source_rate = sf.info(file_path).samplerate
+    y, sr = librosa.load(file_path, sr=analysis_profiles.get_profile(profile)["sample_rate"])
+    return extract_attributes(y, sr, file_path, defer_pitch, duplicate_lookup, report_stage,
+                              source_rate=source_rate, profile=profile)
+
+def extract_attributes(y, sr, file_path, defer_pitch=False, duplicate_lookup=None, report_stage=no_stage,
+                       tempo=None, instrument_type=None, span=None, source_rate=None, profile=DEFAULT_PROFILE):
+    """
+    Extract the musical attributes of decoded mono audio from a file.
+
+    When defer_pitch is True, files that still need CREPE are not pitched here; they are marked
+    with attributes["pitch_pending"] so the caller can pitch many of them at once with
+    resolve_pending_keys().
+
+    duplicate_lookup, when given, is called with the acoustic fingerprint right after decoding.
+    If it returns the attributes of an already analyzed copy of the file, those are used and
+    tempo detection, CLAP and key detection are skipped.
+
+    report_stage is called with the name of each stage as it starts ("fingerprint", "tempo",
+    "instrument", "key"), so a supervisor can tell where a file hung or crashed.
+
+    tempo and instrument_type, when given, are used instead of being detected, and span is
+    the (start, end) frame span of `y` within the file when it is a segment of a longer file.
+    source_rate is the sample rate of the file when `y` was decoded at a different rate.
+
+    profile names the analysis profile (see analysis_profiles) that chooses which extractors
+    run. It is stored in attributes["analysis_profile"], together with attributes["analysis_confidence"],
+    the lower of the key and instrument confidences, so weak rows can be refined later.
+    """
+    settings = analysis_profiles.get_profile(profile)
+    source_rate = source_rate or sr
 
-def extract_audio_attributes(file_path):
     # Initialize attributes with "undetermined"
     attributes = {
         "musical_key": "undetermined",
-        "tempo": None,
-        "instrument_type": "undetermined",
+        "scale_mode": "undetermined",
+        "tempo": tempo,
+        "instrument_type": instrument_type or "undetermined",
         "length_in_samples": None,
         "sample_rate": None,
+        "loudness": None,
+        "pitch_pending": False,
+        "fingerprint": None,
+        "duplicate_of": None,
+        "segment_start": None,
+        "segment_end": None,
+        "analysis_profile": profile,
+        "analysis_confidence": None,
     }
 
-    y, sr = librosa.load(file_path, sr=None)
-
-    attributes["sample_rate"] = sr
-    attributes["length_in_samples"] = len(y)
+    if span is not None:
+        attributes["segment_start"], attributes["segment_end"] = span
 
-    # Searching for tempo: Assume it is a number between 50 and 240
-    tempo_match = re.search(r"([5-9]\d|1\d\d|2[0-3]\d|240)", file_path)
-    if tempo_match:
-        attributes["tempo"] = float(tempo_match.group(1))
+    attributes["sample_rate"] = source_rate
+    if span is not None:
+        attributes["length_in_samples"] = span[1] - span[0]
     else:
-        tempo, beats = librosa.beat.beat_track(y=y, sr=sr)
+        attributes["length_in_samples"] = int(round(len(y) * source_rate / sr))
+    # Stored so the mixer can stage gains without measuring every stem at render time
+    attributes["loudness"] = gain_staging.rms_db(y)
+    report_stage("fingerprint")
+    attributes["fingerprint"] = fingerprint.compute_fingerprint(y, sr)
+
+    if duplicate_lookup is not None:
+        inherited = duplicate_lookup(attributes["fingerprint"])
+        if inherited is not None:
+            attributes.update(inherited)
+            print(f"Duplicate of audio file {attributes['duplicate_of']}")
+            return attributes
+
+    if attributes["tempo"] is None:
+        report_stage("tempo")
+        attributes["tempo"] = tempo_from_path(file_path)
+    if attributes["tempo"] is None:
+        tempo_frames = int(settings["tempo_seconds"] * sr) if settings["tempo_seconds"] else len(y)
+        tempo, beats = librosa.beat.beat_track(y=y[:tempo_frames], sr=sr)
         attributes["tempo"] = float(tempo)
 
+    report_stage("instrument")
     instrument_tags = tags.get_instrument_tags()
     musical_key_tags = tags.get_musical_key_tags()
         
     # Check path segments for possible instrument type info
     path_segments = file_path.split("\\")
     
-    instrument_found = False
+    instrument_found = attributes["instrument_type"] != "undetermined"
+    instrument_confidence = 1.0
     for segment in path_segments:
-        
+        if instrument_found:
+            break
+
         for tag in instrument_tags:
             
             for keyword in tag["keywords"]:
@@ -96,12 +274,14 @@ def extract_audio_attributes(file_path):
                     break 
             if instrument_found:
                 break 
-        if instrument_found:
-            #print("attributes[instrument_type] != undetermined Ran")
-            break         
 
     if attributes["instrument_type"] == "undetermined":
-        attributes["instrument_type"] = utilities.time_function_execution(neural_instrument_categorize, file_path)
+        if settings["clap"]:
+            # The decoded buffer is classified, so a segment never makes CLAP load the whole file
+            attributes["instrument_type"], instrument_confidence = utilities.time_function_execution(
+                neural_instrument_categorize, y, True, sr)
+        else:
+            instrument_confidence = 0.0
 
     print(f"Music Category: {attributes['instrument_type']}")
 
@@ -115,17 +295,119 @@ def extract_audio_attributes(file_path):
             if attributes["musical_key"] != "undetermined":
                 break  # exit the outer loop once a key is found
 
-    if attributes["musical_key"] == "undetermined":
-        if attributes["instrument_type"] != "drums":
-                    crepe_dict = ape.get_pitch_dnn(file_path)
-                    avg_pitch, avg_key, octave = ape.get_average_pitch(crepe_dict)
-                    attributes["musical_key"] = avg_key
-
-    print(f"Musical Key: {attributes['musical_key']}")
+    report_stage("key")
+    key_confidence = 1.0
+    if attributes["instrument_type"] != "drums":
+        # Chroma key profiles first; CREPE only when they are inconclusive
+        detected_key, scale_mode, confidence = key_detection.detect_key(y, sr, key=attributes["musical_key"])
+
+        if attributes["musical_key"] != "undetermined":
+            attributes["scale_mode"] = scale_mode
+        elif confidence >= settings["key_confidence"] or settings["crepe_model"] is None:
+            key_confidence = max(confidence, 0.0)
+            if confidence >= settings["key_confidence"]:
+                attributes["musical_key"] = detected_key
+                attributes["scale_mode"] = scale_mode
+        elif defer_pitch:
+            # The key confidence is added once the file is pitched
+            attributes["pitch_pending"] = True
+        else:
+            crepe_dict = ape.get_pitch_dnn(file_path, (attributes["segment_start"] or 0) / source_rate,
+                                           settings["crepe_model"], settings["pitch_seconds"])
+            avg_pitch, avg_key, octave = ape.get_average_pitch(crepe_dict)
+            attributes["musical_key"] = avg_key
+            key_confidence = ape.pitch_confidence(crepe_dict)
+
+    attributes["analysis_confidence"] = min(key_confidence, instrument_confidence)
+
+    print(f"Musical Key: {attributes['musical_key']} {attributes['scale_mode']}")
 
     return attributes
 
-def neural_instrument_categorize(audio_file):
+def resolve_pending_keys(audio_files, batch_size=None):
+    """
+    Pitch audio files with CREPE in batches and store the resulting key on each of them.
+
+    Files are batched per analysis profile, which chooses the CREPE model and how much audio
+    is pitched, and their confidence is lowered to the CREPE confidence where that is lower.
+
+    Parameters:
+    - audio_files (list): AudioFile objects whose analysis was deferred with "pitch_pending". Segments
+      are pitched from their own start.
+    - batch_size (int, optional): Files per model call. Defaults to audio_pitch_estimation.PITCH_BATCH_SIZE.
+    """
+    if batch_size is None:
+        batch_size = ape.PITCH_BATCH_SIZE
+
+    by_profile = {}
+    for audio_file in audio_files:
+        by_profile.setdefault(audio_file.analysis_profile or DEFAULT_PROFILE, []).append(audio_file)
+
+    for profile, profile_files in by_profile.items():
+        settings = analysis_profiles.get_profile(profile)
+
+        for start in range(0, len(profile_files), batch_size):
+            batch = profile_files[start:start + batch_size]
+            pitches = ape.get_pitch_dnn_batch(
+                [audio_file.absolute_path for audio_file in batch],
+                model_capacity=settings["crepe_model"] or "tiny",
+                seconds=settings["pitch_seconds"],
+                offsets=[(audio_file.segment_start or 0) / audio_file.sample_rate for audio_file in batch],
+            )
+
+            for audio_file, crepe_dict in zip(batch, pitches):
+                avg_pitch, avg_key, octave = ape.get_average_pitch(crepe_dict)
+                audio_file.key = avg_key
+                confidence = ape.pitch_confidence(crepe_dict)
+                if audio_file.analysis_confidence is not None:
+                    confidence = min(audio_file.analysis_confidence, confidence)
+                audio_file.analysis_confidence = confidence
+
+# Define classes for zero-shot
+# Should be in lower case and can be more than one word
+CLAP_CLASSES = ["drums", "bass", "percussion", "fx", "melodic", "vocals"]
+CLAP_PROMPT = 'this type of musical sound is '
+
+@lru_cache(maxsize=1)
+def get_clap_model():
+    # Setting use_cuda = True will load the model on a GPU using CUDA
+    return CLAP(version = '2023', use_cuda=True)
+
+@lru_cache(maxsize=1)
+def clap_text_embeddings():
+    # compute text embeddings from natural text
+    return get_clap_model().get_text_embeddings([CLAP_PROMPT + x for x in CLAP_CLASSES])
+
+def clap_buffer_embeddings(y, sr):
+    """
+    Compute the CLAP audio embedding of decoded mono audio.
+
+    CLAP looks at a fixed-length window of audio (7 seconds for the 2023 model). Only that much
+    of the middle of the buffer is resampled to the model rate; shorter buffers are repeated to
+    fill it, as CLAP does for files.
+    """
+    clap_model = get_clap_model()
+    model_rate = clap_model.args.sampling_rate
+    window = int(clap_model.args.duration * model_rate)
+
+    # Cut the excerpt before resampling, so the work does not grow with the length of the buffer
+    source_window = int(np.ceil(window * sr / model_rate))
+    if len(y) > source_window:
+        start = (len(y) - source_window) // 2
+        y = y[start:start + source_window]
+    if sr != model_rate:
+        y = resampling.resample(y, sr, model_rate, "fast")
+
+    if len(y) < window:
+        y = np.tile(y, int(np.ceil(window / max(len(y), 1))))
+    y = np.ascontiguousarray(y[:window], dtype=np.float32)
+
+    audio = torch.from_numpy(y).reshape(1, 1, -1)
+    if clap_model.use_cuda and torch.cuda.is_available():
+        audio = audio.cuda()
+    return clap_model._get_audio_embeddings(audio)
+
+def neural_instrument_categorize(audio_file, return_confidence=False, sample_rate=None):
     """
     Categorizes a given audio file into one of the predefined musical instrument classes.
 
@@ -134,11 +416,15 @@ def neural_instrument_categorize(audio_file):
     compares them with embeddings generated from predefined class prompts.
 
     Parameters:
-    - audio_file (str): Path to the audio file to be categorized.
+    - audio_file (str | numpy.array): Path to the audio file to be categorized, or its decoded
+      mono audio.
+    - return_confidence (bool, optional): Also return the probability of the top category.
+    - sample_rate (int, optional): Sample rate of `audio_file` when it is decoded audio.
 
     Returns:
     - str: The top predicted category for the audio file, chosen from the following classes:
-      "drums", "bass", "percussion", "fx", "melodic", "vocals".
+      "drums", "bass", "percussion", "fx", "melodic", "vocals". With return_confidence, a
+      tuple of the category and its probability.
 
     Note:
     This function assumes that the CLAP model and necessary dependencies are already imported 
@@ -149,25 +435,20 @@ def neural_instrument_categorize(audio_file):
     >>> print(result)
     'drums'
     """
-    # Define classes for zero-shot
-    # Should be in lower case and can be more than one word
-    classes = ["drums", "bass", "percussion", "fx", "melodic", "vocals"]
+    classes = CLAP_CLASSES
     ground_truth = ['drums']
-    # Add prompt
-    prompt = 'this type of musical sound is '
-    class_prompts = [prompt + x for x in classes]
 
-    #Load audio files
-    audio_files = []
-    audio_files.append(audio_file)
+    # The model and the embeddings of the class prompts are loaded once per process
+    clap_model = get_clap_model()
+    text_embeddings = clap_text_embeddings()
 
-    # Setting use_cuda = True will load the model on a GPU using CUDA
-    clap_model = CLAP(version = '2023', use_cuda=True)
-
-    # compute text embeddings from natural text
-    text_embeddings = clap_model.get_text_embeddings(class_prompts)
-
-    audio_embeddings = clap_model.get_audio_embeddings(audio_files, resample=True)
+    if isinstance(audio_file, np.ndarray):
+        audio_embeddings = clap_buffer_embeddings(audio_file, sample_rate)
+    else:
+        #Load audio files
+        audio_files = []
+        audio_files.append(audio_file)
+        audio_embeddings = clap_model.get_audio_embeddings(audio_files, resample=True)
     #print(f"audio_embeddings: {audio_embeddings}")
     
     # compute the similarity between audio_embeddings and text_embeddings
@@ -183,6 +464,8 @@ def neural_instrument_categorize(audio_file):
         print(f"{classes[index]:>16s}: {100 * value.item():.2f}%") """
     
     #print(f"return: {classes[indices[0]]}")
+    if return_confidence:
+        return classes[indices[0]], float(values[0])
     return classes[indices[0]]
 
 def root_mean_square(data):
@@ -220,7 +503,11 @@ def normalized(list):
         numpy.array: Normalized audio data.
     """
     """Given an audio buffer, return it with the loudest value scaled to 1.0"""
-    return list.astype(np.float32) / float(np.amax(np.abs(list)))
+    peak = float(np.amax(np.abs(list)))
+    # One float32 copy, scaled in place
+    normalized_list = list.astype(np.float32, copy=True)
+    normalized_list /= peak
+    return normalized_list
 
 neg80point8db = 0.00009120108393559096
 bit_depth = 16
@@ -292,48 +579,73 @@ def trim_data(
 
     return data[start:end]
 
-def load_and_trim(file):
+def load_mono(file, archive=None):
+    """
+    Load an audio file as mono.
+
+    When an archive is given and `file` is a DBAudioFile id packed in it, the samples come from
+    the memory-mapped archive instead of being decoded. Mono stems are returned as zero-copy views.
+
+    Args:
+        file (str | int): Path to the audio file, or a DBAudioFile id.
+        archive (SampleArchive, optional): Packed sample archive to read from.
+
+    Returns:
+        tuple: Mono audio data and its corresponding sample rate.
+    """
+    if archive is not None and file in archive:
+        y, rate = archive.get_float(file)
+        if y.ndim > 1:
+            y = y.mean(axis=1, dtype=np.float32)
+        return y, rate
+
+    return librosa.load(file, mono=True)
+
+def load_and_trim(file, archive=None):
     """
     From https://github.com/samim23/polymath
     Load an audio file and trim the silent regions.
     
     Args:
-        file (str): Path to the audio file.
+        file (str | int): Path to the audio file, or a DBAudioFile id when reading from an archive.
+        archive (SampleArchive, optional): Packed sample archive to read from.
         
     Returns:
         tuple: Trimmed audio data and its corresponding sample rate.
     """
-    y, rate = librosa.load(file, mono=True)
+    y, rate = load_mono(file, archive)
     y = normalized(y)
     trimmed = trim_data(y)
     return trimmed, rate
 
-def get_loudness(file):
+def get_loudness(file, archive=None):
     """
     From https://github.com/samim23/polymath
     Compute the loudness of an audio file after loading and trimming.
     
     Args:
-        file (str): Path to the audio file.
+        file (str | int): Path to the audio file, or a DBAudioFile id when reading from an archive.
+        archive (SampleArchive, optional): Packed sample archive to read from.
         
     Returns:
         float: Loudness of the provided audio file.
     """
     loudness = -1
     try:
-        audio, rate = load_and_trim(file)
+        audio, rate = load_and_trim(file, archive)
         loudness = loudness_of(audio)
     except Exception as e:
         sys.stderr.write(f"Failed to run on {file}: {e}\n")
     return loudness
 
-def get_volume(file):
+def get_volume(file, archive=None):
     """
     From https://github.com/samim23/polymath
     Compute the volume, average volume, and loudness of an audio file after loading and trimming.
     
     Args:
-        file (str): Path to the audio file.
+        file (str | int): Path to the audio file, or a DBAudioFile id when reading from an archive.
+        archive (SampleArchive, optional): Packed sample archive to read from.
         
     Returns:
         tuple: Volume, average volume, and loudness of the provided audio file.
@@ -341,7 +653,7 @@ def get_volume(file):
     volume = -1
     avg_volume = -1
     try:
-        audio, rate = load_and_trim(file)
+        audio, rate = load_and_trim(file, archive)
         volume = librosa.feature.rms(y=audio)[0]
         avg_volume = np.mean(volume)
         loudness = loudness_of(audio)
@@ -0,0 +1,108 @@
+import threading
+from contextlib import contextmanager
+import numpy as np
+import soundfile as sf
+
+# Samples are decoded and processed as float32 unless a stage explicitly needs more precision.
+AUDIO_DTYPE = "float32"
+
+# Working memory the render and ingest stages may use at once; see MemoryBudget.
+MEMORY_BUDGET_BYTES = 4 * 1024 ** 3  # 4 GiB
+
+def read_audio(path, start=0, stop=None, dtype=AUDIO_DTYPE):
+    """
+    Decode an audio file in the project dtype. Mono files stay one-dimensional.
+
+    Args:
+        path (str): Path to the audio file.
+        start (int, optional): First frame to read.
+        stop (int, optional): Frame to stop reading at. Defaults to the end of the file.
+        dtype (str, optional): Sample dtype. Defaults to AUDIO_DTYPE.
+
+    Returns:
+        tuple: The audio data as a numpy array and its sample rate.
+    """
+    return sf.read(path, start=start, stop=stop, dtype=dtype)
+
+def read_audiofile(audiofile_obj, dtype=AUDIO_DTYPE):
+    """
+    Decode the samples of an AudioFile or DBAudioFile. Rows that are segments of a longer
+    file only read their own span of it.
+
+    Returns:
+        tuple: The audio data as a numpy array and its sample rate.
+    """
+    start = getattr(audiofile_obj, "segment_start", None) or 0
+    stop = getattr(audiofile_obj, "segment_end", None)
+    return read_audio(audiofile_obj.absolute_path, start, stop, dtype)
+
+def readonly(audio_data):
+    """
+    Return a read-only view of a buffer, for stages that only read it.
+    """
+    view = audio_data.view()
+    view.setflags(write=False)
+    return view
+
+def estimate_nbytes(frames, channels=1, dtype=AUDIO_DTYPE):
+    """
+    Number of bytes a decoded buffer of the given size occupies.
+    """
+    return int(frames) * int(channels) * np.dtype(dtype).itemsize
+
+def estimate_file_nbytes(path, factor=1.0, dtype=AUDIO_DTYPE):
+    """
+    Number of bytes an audio file occupies once decoded, read from its header only.
+
+    Args:
+        path (str): Path to the audio file.
+        factor (float, optional): Multiplier for the number of copies or the length change a stage makes.
+        dtype (str, optional): Sample dtype. Defaults to AUDIO_DTYPE.
+
+    Returns:
+        int: The estimated number of bytes.
+    """
+    info = sf.info(path)
+    return int(estimate_nbytes(info.frames, info.channels, dtype) * factor)
+
+class MemoryBudget:
+    """
+    Shared limit on the working memory of concurrent render and ingest tasks.
+
+    Each task reserves its estimated footprint before decoding or mixing and releases it when
+    done. Tasks that would exceed the budget wait until enough memory is released. A single
+    task larger than the whole budget still runs, but only once nothing else holds a reservation.
+    """
+
+    def __init__(self, limit_bytes=MEMORY_BUDGET_BYTES):
+        self.limit_bytes = limit_bytes
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def reserve(self, nbytes):
+        if self.limit_bytes is None:
+            yield
+            return
+
+        nbytes = min(int(nbytes), self.limit_bytes)
+
+        with self._condition:
+            while self.in_use > 0 and self.in_use + nbytes > self.limit_bytes:
+                self._condition.wait()
+            self.in_use += nbytes
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_use -= nbytes
+                self._condition.notify_all()
+
+MEMORY_BUDGET = MemoryBudget()
+
+def set_memory_budget(limit_bytes):
+    """
+    Change the shared memory budget. Pass None to disable the limit.
+    """
+    MEMORY_BUDGET.limit_bytes = limit_bytes
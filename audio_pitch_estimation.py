@@ -1,4 +1,3 @@
-import crepe
 import numpy as np
 import librosa
 from math import log2, pow
@@ -35,15 +34,95 @@ def get_average_pitch(pitch):
         octave = 0
     return average_frequency,average_key, octave
 
-def get_pitch_dnn(audio_file):
+CREPE_SAMPLE_RATE = 16000  # The rate the CREPE models expect
+CREPE_FRAME_LENGTH = 1024
+PITCH_SECONDS = 0.5  # Length of audio pitched from the start of each file
+PITCH_BATCH_SIZE = 32  # Files pitched per model call during ingest
+
+def crepe_frames(audio, step_size=10):
+    """
+    Cut 16 kHz audio into the centred, normalized 1024-sample frames CREPE expects.
+
+    Mirrors the framing done inside crepe.core.get_activation, so that frames from many
+    files can be stacked and passed to the model in one call.
+
+    Args:
+        audio (numpy.array): Mono audio data at CREPE_SAMPLE_RATE.
+        step_size (int, optional): Hop between frames in milliseconds. Defaults to 10.
+
+    Returns:
+        numpy.array: float32 frames shaped (n_frames, 1024).
+    """
+    audio = np.pad(np.asarray(audio, dtype=np.float32), CREPE_FRAME_LENGTH // 2, mode='constant')
+    hop_length = int(CREPE_SAMPLE_RATE * step_size / 1000)
+
+    frames = np.lib.stride_tricks.sliding_window_view(audio, CREPE_FRAME_LENGTH)[::hop_length].copy()
+    frames -= np.mean(frames, axis=1)[:, np.newaxis]
+    frames /= np.clip(np.std(frames, axis=1)[:, np.newaxis], 1e-8, None)
+    return frames
+
+def get_pitch_dnn_batch(audio_files, model_capacity="tiny", step_size=10, seconds=PITCH_SECONDS, offsets=None):
+    """
+    DNN pitch detection for many files with a single model prediction.
+
+    The first `seconds` of every file (or from its offset) are framed, all frames are stacked into one batch
+    for the CREPE model, and the activations are split back per file and decoded with Viterbi.
+
+    Args:
+        audio_files (list): Paths of the audio files to pitch.
+        model_capacity (str, optional): tiny|small|medium|large|full. Defaults to "tiny".
+        step_size (int, optional): Hop between frames in milliseconds. Defaults to 10.
+        seconds (float, optional): Length of audio pitched per file. Defaults to PITCH_SECONDS.
+        offsets (list, optional): Start of the pitched audio in each file in seconds, for
+            segments of longer files. Defaults to the start of every file.
+
+    Returns:
+        list: One pitch list per file, each in the format returned by get_pitch_dnn. Files
+        that could not be loaded get an empty list.
+    """
+    # Imported here so that TensorFlow is only loaded when the chroma key detector is inconclusive
+    import crepe.core
+
+    if offsets is None:
+        offsets = [0.0] * len(audio_files)
+
+    frame_batches = []
+    for audio_file, offset in zip(audio_files, offsets):
+        try:
+            audio, sr = librosa.load(audio_file, sr=CREPE_SAMPLE_RATE, mono=True, offset=offset, duration=seconds)
+            frame_batches.append(crepe_frames(audio, step_size))
+        except Exception as e:
+            print(f"An error occurred while loading {audio_file}: {str(e)}")
+            frame_batches.append(np.empty((0, CREPE_FRAME_LENGTH), dtype=np.float32))
+
+    pitches = [[] for _ in audio_files]
+    if not any(len(frames) for frames in frame_batches):
+        return pitches
+
+    model = crepe.core.build_and_load_model(model_capacity)
+    activations = model.predict(np.concatenate(frame_batches), verbose=0)
+
+    boundaries = np.cumsum([len(frames) for frames in frame_batches])[:-1]
+    for index, activation in enumerate(np.split(activations, boundaries)):
+        if len(activation) == 0:
+            continue
+
+        confidence = activation.max(axis=1)
+        cents = crepe.core.to_viterbi_cents(activation)
+        frequency = 10 * 2 ** (cents / 1200)
+        frequency[np.isnan(frequency)] = 0
+        time = np.arange(confidence.shape[0]) * step_size / 1000.0
+
+        pitches[index] = [[time[i], frequency[i], confidence[i]] for i in range(len(time))]
+
+    return pitches
+
+def get_pitch_dnn(audio_file, offset=0.0, model_capacity="tiny", seconds=PITCH_SECONDS):
     # DNN Pitch Detection
-    pitch = []
-    audio, sr = librosa.load(audio_file)
-    num =int(sr/2)
-    first_second_of_audio = audio[:num]
-    time, frequency, confidence, activation = crepe.predict(first_second_of_audio, sr, model_capacity="tiny", viterbi=True, center=True, step_size=10, verbose=1) # tiny|small|medium|large|full
-    i = 0
-    while i < len(time):
-        pitch.append([time[i],frequency[i],confidence[i]])
-        i += 1
-    return pitch
\ No newline at end of file
+    return get_pitch_dnn_batch([audio_file], model_capacity=model_capacity, seconds=seconds, offsets=[offset])[0]
+
+def pitch_confidence(pitch):
+    """Mean CREPE confidence over the frames of a pitch list, 0.0 if it is empty."""
+    if len(pitch) == 0:
+        return 0.0
+    return float(np.mean([frame[2] for frame in pitch]))
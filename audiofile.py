@@ -1,61 +1,33 @@
 class AudioFile:
-    FILE_TYPES = ["wav"]
-    MUSICAL_KEYS = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
-    SCALE_MODES = ["Major", "Minor", "Ionian", "Dorian", "Phrygian", "Lydian", "Mixolydian", "Aeolian", "Locrian"]
-    
-    @property
-    def tempo(self):
-        return self._tempo
-    
-    @tempo.setter
-    def tempo(self, new_tempo):
-        self._tempo = self._validate_number(new_tempo, minimum=0, default=None)
-        
-    @property
-    def length_in_samples(self):
-        return self._length_in_samples
-    
-    @length_in_samples.setter
-    def length_in_samples(self, new_length):
-        self._length_in_samples = self._validate_number(new_length, minimum=0, default=None)
+    FILE_TYPES = frozenset(["wav"])
+    MUSICAL_KEYS = frozenset(["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"])
+    SCALE_MODES = frozenset(["Major", "Minor", "Ionian", "Dorian", "Phrygian", "Lydian", "Mixolydian", "Aeolian", "Locrian"])
 
-    @property
-    def sample_rate(self):
-        return self._sample_rate
-    
-    @sample_rate.setter
-    def sample_rate(self, new_sample_rate):
-        self._sample_rate = self._validate_number(new_sample_rate, minimum=0, default=None)
-
-    @property
-    def key(self):
-        return self._key
-    
-    @key.setter
-    def key(self, new_key):
-        self._key = self._validate_enum(new_key, self.MUSICAL_KEYS, default="undetermined")
-
-    @property
-    def scale_mode(self):
-        return self._scale_mode
-    
-    @scale_mode.setter
-    def scale_mode(self, new_scale_mode):
-        self._scale_mode = self._validate_enum(new_scale_mode, self.SCALE_MODES, default="undetermined")
+    # Slots instead of a per-instance dict; ingest holds many of these at once. Attributes are
+    # plain slots: values are checked once by validate() where rows enter the database, not on
+    # every assignment.
+    __slots__ = (
+        "filename", "file_type", "absolute_path", "directory_path", "key", "scale_mode", "tempo",
+        "genre", "instrument_type", "length_in_samples", "sample_rate", "loudness", "audio_data",
+        "source_id", "source_path", "stretch_factor", "prerendered", "fingerprint", "duplicate_of",
+        "segment_start", "segment_end", "analysis_profile", "analysis_confidence",
+    )
 
-    @property
-    def file_type(self):
-        return self._file_type
-    
-    @file_type.setter
-    def file_type(self, new_file_type):
-        self._file_type = self._validate_enum(new_file_type, self.FILE_TYPES)
+    # Attributes stored in the columns of the same name in the audiofiles table
+    ROW_FIELDS = (
+        "filename", "file_type", "absolute_path", "directory_path", "key", "genre", "scale_mode", "tempo",
+        "instrument_type", "length_in_samples", "sample_rate", "loudness", "duplicate_of",
+        "segment_start", "segment_end", "analysis_profile", "analysis_confidence",
+    )
 
     def __init__(self, filename, file_type, absolute_path, directory_path, 
                  key="undetermined", scale_mode="undetermined", 
                  tempo=None, genre="undetermined", 
                  instrument_type="undetermined", 
-                 length_in_samples=None, sample_rate=None):
+                 length_in_samples=None, sample_rate=None, loudness=None, audio_data=None,
+                 source_id=None, source_path=None, stretch_factor=None, prerendered=False,
+                 fingerprint=None, duplicate_of=None, segment_start=None, segment_end=None,
+                 analysis_profile=None, analysis_confidence=None):
         self.filename = filename
         self.file_type = file_type
         self.absolute_path = absolute_path
@@ -67,14 +39,50 @@ class AudioFile:
         self.instrument_type = instrument_type
         self.length_in_samples = length_in_samples
         self.sample_rate = sample_rate
+        self.loudness = loudness
+        # Decoded samples carried between render stages so they never touch disk
+        self.audio_data = audio_data
+        # Provenance of rendered stems: the DBAudioFile they came from and how they were stretched
+        self.source_id = source_id
+        self.source_path = source_path
+        self.stretch_factor = stretch_factor
+        # Already trimmed, faded and stretched at ingest, so the mixer uses it as is
+        self.prerendered = prerendered
+        # Acoustic fingerprint from ingest, and the id of the DBAudioFile this file is a copy of
+        self.fingerprint = fingerprint
+        self.duplicate_of = duplicate_of
+        # Frame span within absolute_path for segments of a long file; None means the whole file
+        self.segment_start = segment_start
+        self.segment_end = segment_end
+        # Analysis profile the attributes came from and how sure it was of them (see analysis_profiles.py)
+        self.analysis_profile = analysis_profile
+        self.analysis_confidence = analysis_confidence
     
+    def validate(self):
+        """
+        Check the values stored in the database, replacing an unknown key or scale mode with
+        "undetermined".
+
+        :raises ValueError: If the file type is unknown or a number is negative.
+        :raises TypeError: If a number is not an int or float.
+        :return: The AudioFile itself.
+        """
+        self.file_type = self._validate_enum(self.file_type, self.FILE_TYPES)
+        self.key = self._validate_enum(self.key, self.MUSICAL_KEYS, default="undetermined")
+        self.scale_mode = self._validate_enum(self.scale_mode, self.SCALE_MODES, default="undetermined")
+        self.tempo = self._validate_number(self.tempo, minimum=0, default=None)
+        self.length_in_samples = self._validate_number(self.length_in_samples, minimum=0, default=None)
+        self.sample_rate = self._validate_number(self.sample_rate, minimum=0, default=None)
+        self.loudness = self._validate_number(self.loudness, default=None)
+        return self
+
     @staticmethod
     def _validate_enum(value, valid_options, default=None):
         """
         Validates if the value is among the valid options.
         
         :param value: The value to validate.
-        :param valid_options: A list of valid options.
+        :param valid_options: A frozenset of valid options.
         :param default: The default value to return if validation fails.
         :raises ValueError: If value is not valid and no default is provided.
         :return: The validated value or default.
@@ -82,7 +90,7 @@ class AudioFile:
         if value not in valid_options:
             if default is not None:
                 return default
-            raise ValueError(f"Invalid value: {value}. Expected one of: {', '.join(valid_options)}.")
+            raise ValueError(f"Invalid value: {value}. Expected one of: {', '.join(sorted(valid_options))}.")
         return value
 
     @staticmethod
@@ -106,6 +114,15 @@ class AudioFile:
             return default
         return value
 
+    def to_row(self):
+        """
+        Returns the insert parameters of the audiofiles table for this file, so it can be
+        written with a Core insert instead of through an ORM object. Call validate() first.
+
+        :return: A dict of column names and values.
+        """
+        return {field: getattr(self, field) for field in self.ROW_FIELDS}
+
     def __str__(self):
         """
         Returns a string representation of the AudioFile object.
@@ -1,12 +1,44 @@
 # database_setup.py
 
-from sqlalchemy import create_engine
+import os
+from sqlalchemy import create_engine, inspect, text
 from sqlalchemy.orm import sessionmaker
 from dbaudiofile import Base  # Import the Base from models.py
 
-DATABASE_URL = "sqlite:///audiofile.db"  # Use your actual DB URL
+# Point every ingest worker at the same database (e.g. postgresql://host/db) to share one job queue
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///audiofile.db")
+SQLITE_BUSY_TIMEOUT = 30  # Seconds a SQLite connection waits for another process's write lock
 
-engine = create_engine(DATABASE_URL)
+def add_missing_columns(engine):
+    """
+    Add columns that were introduced in the models after the database was created.
+
+    create_all() only creates missing tables, so an existing database would otherwise lack
+    new columns. New columns are added as nullable, together with any indexes on them.
+    """
+    inspector = inspect(engine)
+
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
+                for index in table.indexes:
+                    if column.name in index.columns:
+                        index.create(connection, checkfirst=True)
+
+connect_args = {"timeout": SQLITE_BUSY_TIMEOUT} if DATABASE_URL.startswith("sqlite") else {}
+engine = create_engine(DATABASE_URL, connect_args=connect_args)
 Base.metadata.create_all(engine)  # Ensure tables are created
+add_missing_columns(engine)
 
 Session = sessionmaker(bind=engine)
@@ -1,6 +1,6 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float
+from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, LargeBinary
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, relationship
 
 Base = declarative_base()
 
@@ -19,3 +19,86 @@ class DBAudioFile(Base):
     instrument_type = Column(String)
     length_in_samples = Column(Integer)
     sample_rate = Column(Integer)
+    loudness = Column(Float)  # RMS level in dBFS, measured at ingest
+    duplicate_of = Column(Integer, ForeignKey('audiofiles.id'), index=True)  # Original this file is an acoustic copy of
+    segment_start = Column(Integer)  # Frame span within absolute_path for segments of a long file
+    segment_end = Column(Integer)
+    analysis_profile = Column(String, index=True)  # fast | balanced | accurate (see analysis_profiles.py)
+    analysis_confidence = Column(Float, index=True)  # Lower of the key and instrument confidences
+
+    # Loop-ready renders on the tempo grid, loaded together with the row (see prerender.py)
+    prerendered_stems = relationship("DBPrerenderedStem", back_populates="audiofile", lazy="selectin",
+                                     cascade="all, delete-orphan")
+
+    # Acoustic fingerprint and its hash index, used to find duplicates at ingest (see fingerprint.py)
+    fingerprint = relationship("DBAudioFingerprint", uselist=False, cascade="all, delete-orphan")
+    fingerprint_hashes = relationship("DBFingerprintHash", cascade="all, delete-orphan")
+
+class DBPrerenderedStem(Base):
+    __tablename__ = 'prerendered_stems'
+
+    id = Column(Integer, primary_key=True)
+    audiofile_id = Column(Integer, ForeignKey('audiofiles.id'), index=True)
+    tempo = Column(Float)
+    sample_rate = Column(Integer)
+    length_in_samples = Column(Integer)
+    loudness = Column(Float)
+    absolute_path = Column(String)
+
+    audiofile = relationship("DBAudioFile", back_populates="prerendered_stems")
+
+class DBAudioFingerprint(Base):
+    __tablename__ = 'audio_fingerprints'
+
+    audiofile_id = Column(Integer, ForeignKey('audiofiles.id'), primary_key=True)
+    frames = Column(Integer)
+    words = Column(LargeBinary)  # One little-endian uint32 per 16 ms frame
+
+class DBFingerprintHash(Base):
+    __tablename__ = 'fingerprint_hashes'
+
+    id = Column(Integer, primary_key=True)
+    hash = Column(Integer, index=True)  # A fingerprint word, stored as a signed 32-bit integer
+    audiofile_id = Column(Integer, ForeignKey('audiofiles.id'), index=True)
+    offset = Column(Integer)  # Frame of the word within the fingerprint
+
+class DBIngestJob(Base):
+    __tablename__ = 'ingest_jobs'
+
+    # One row per file to analyze, shared by every ingest worker (see job_queue.py)
+    id = Column(Integer, primary_key=True)
+    absolute_path = Column(String, unique=True, index=True)
+    status = Column(String, index=True, default="pending")  # pending | leased | done | failed
+    lease_owner = Column(String)  # Claim token of the worker holding the lease
+    lease_expires = Column(Float)  # Unix time after which the lease can be reclaimed
+    attempts = Column(Integer, default=0)
+    error = Column(String)
+    updated_at = Column(Float)
+
+class DBIngestFailure(Base):
+    __tablename__ = 'ingest_failures'
+
+    # Files whose analysis failed, kept until a retry succeeds (see ingest_failures.py)
+    id = Column(Integer, primary_key=True)
+    absolute_path = Column(String, unique=True, index=True)
+    stage = Column(String)  # decode | fingerprint | tempo | instrument | key | pitch | commit
+    error = Column(String)
+    attempts = Column(Integer, default=0)
+    last_attempt = Column(Float)  # Unix time
+
+class DBAudioHeader(Base):
+    __tablename__ = 'audio_headers'
+
+    # Facts read from the file header alone, before any audio is decoded (see prescan.py)
+    id = Column(Integer, primary_key=True)
+    absolute_path = Column(String, unique=True, index=True)
+    size = Column(Integer)
+    mtime_ns = Column(Integer)  # With size, tells whether the file changed since it was scanned
+    format = Column(String)  # e.g. WAV
+    subtype = Column(String)  # e.g. PCM_24
+    sample_rate = Column(Integer, index=True)
+    channels = Column(Integer)
+    frames = Column(Integer)
+    duration = Column(Float, index=True)  # Seconds
+    error = Column(String)  # Set instead of the audio facts when the header could not be read
+    scanned_at = Column(Float)  # Unix time
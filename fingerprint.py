@@ -0,0 +1,244 @@
+import argparse
+from functools import lru_cache
+import numpy as np
+from sqlalchemy import insert
+import resampling
+from dbaudiofile import DBAudioFile, DBAudioFingerprint, DBFingerprintHash
+
+FINGERPRINT_SAMPLE_RATE = 8000
+FRAME_LENGTH = 2048  # 256 ms at FINGERPRINT_SAMPLE_RATE
+HOP_LENGTH = 128  # 16 ms; small enough that any trim lands within a few ms of a frame
+BAND_EDGES = np.geomspace(300.0, 2000.0, 34)  # 33 log-spaced bands give 32 bits per frame
+
+INDEX_STRIDE = 8  # Every n-th frame of a stored fingerprint goes into the hash index
+MAX_BIT_ERROR_RATE = 0.2  # Aligned fingerprints differing in fewer bits than this are duplicates
+MIN_OVERLAP = 0.9  # Aligned frames must cover this fraction of the longer fingerprint
+QUERY_CHUNK_SIZE = 500
+MAX_CANDIDATES = 10  # Alignments verified per lookup, in order of their number of matching words
+
+@lru_cache(maxsize=1)
+def band_matrix():
+    """Return the (bins, bands) matrix that sums FFT power into the fingerprint bands."""
+    frequencies = np.fft.rfftfreq(FRAME_LENGTH, d=1.0 / FINGERPRINT_SAMPLE_RATE)
+    band_index = np.digitize(frequencies, BAND_EDGES) - 1
+
+    matrix = np.zeros((frequencies.shape[0], len(BAND_EDGES) - 1), dtype=np.float32)
+    for band in range(len(BAND_EDGES) - 1):
+        matrix[band_index == band, band] = 1.0
+
+    matrix.setflags(write=False)
+    return matrix
+
+def compute_fingerprint(audio_data, sample_rate):
+    """
+    Compute a fingerprint of audio data as one 32-bit word per 16 ms frame.
+
+    Each bit is the sign of the change in energy difference between two neighbouring bands
+    from one frame to the next (Haitsma & Kalker). Signs of energy differences do not change
+    with gain, are robust to lossy re-encoding and do not depend on the file name, and
+    because a word describes only its own frame, a trimmed copy matches at an offset.
+
+    Args:
+        audio_data (numpy.array): Audio data, mono or shaped (frames, channels).
+        sample_rate (int): Sample rate of the audio data.
+
+    Returns:
+        numpy.array: uint32 words, one per frame. Empty for audio shorter than two frames.
+    """
+    if audio_data.ndim > 1:
+        audio_data = audio_data.mean(axis=1)
+
+    audio_data = resampling.resample(np.asarray(audio_data, dtype=np.float32), sample_rate, FINGERPRINT_SAMPLE_RATE, "fast")
+    if audio_data.shape[0] < FRAME_LENGTH + HOP_LENGTH:
+        return np.empty(0, dtype=np.uint32)
+
+    frames = np.lib.stride_tricks.sliding_window_view(audio_data, FRAME_LENGTH)[::HOP_LENGTH]
+    window = np.hanning(FRAME_LENGTH).astype(np.float32)
+    power = np.square(np.abs(np.fft.rfft(frames * window, axis=1)))
+
+    energy = power @ band_matrix()
+
+    band_difference = energy[:, :-1] - energy[:, 1:]
+    bits = (band_difference[1:] - band_difference[:-1]) > 0
+
+    return np.packbits(bits, axis=1, bitorder="little").view("<u4").ravel()
+
+def bit_error_rate(a, b):
+    return np.unpackbits(np.bitwise_xor(a, b).view(np.uint8)).mean()
+
+def compare(query, stored, offset):
+    """
+    Compare two fingerprints with stored frame `offset` aligned to query frame 0.
+
+    Returns:
+    - float: The bit error rate of the aligned frames, or None if they overlap too little.
+    """
+    query_start = max(0, -offset)
+    stored_start = max(0, offset)
+    overlap = min(len(query) - query_start, len(stored) - stored_start)
+
+    if overlap < MIN_OVERLAP * max(len(query), len(stored)):
+        return None
+
+    return bit_error_rate(query[query_start:query_start + overlap], stored[stored_start:stored_start + overlap])
+
+def find_duplicate(session, words, exclude_path=None):
+    """
+    Find an audio file in the database that sounds the same as a fingerprint.
+
+    Candidates and their alignment come from exact word matches in the hash index; each one
+    is then verified by the bit error rate over the aligned fingerprints.
+
+    Parameters:
+    - session (Session): An open database session.
+    - words (numpy.array): Fingerprint from compute_fingerprint().
+    - exclude_path (str, optional): Path whose own row is not a match, e.g. when a file is re-analyzed.
+
+    Returns:
+    - DBAudioFile: The original of the best match, or None.
+    """
+    if len(words) == 0:
+        return None
+
+    query_hashes = words.view("<i4")
+    positions = {}
+    for frame, value in enumerate(query_hashes.tolist()):
+        positions.setdefault(value, frame)
+
+    votes = {}
+    values = list(positions)
+    for start in range(0, len(values), QUERY_CHUNK_SIZE):
+        rows = session.query(DBFingerprintHash.audiofile_id, DBFingerprintHash.hash, DBFingerprintHash.offset).filter(
+            DBFingerprintHash.hash.in_(values[start:start + QUERY_CHUNK_SIZE])
+        )
+        for audiofile_id, value, offset in rows:
+            candidate = (audiofile_id, offset - positions[value])
+            votes[candidate] = votes.get(candidate, 0) + 1
+
+    excluded_ids = set()
+    if exclude_path is not None:
+        excluded_ids = {audiofile_id for (audiofile_id,) in session.query(DBAudioFile.id).filter_by(absolute_path=exclude_path)}
+
+    best_id = None
+    best_error = MAX_BIT_ERROR_RATE
+    stored_words = {}
+
+    for audiofile_id, offset in sorted(votes, key=votes.get, reverse=True)[:MAX_CANDIDATES]:
+        if audiofile_id in excluded_ids:
+            continue
+
+        if audiofile_id not in stored_words:
+            stored = session.get(DBAudioFingerprint, audiofile_id)
+            stored_words[audiofile_id] = None if stored is None else np.frombuffer(stored.words, dtype="<u4")
+
+        if stored_words[audiofile_id] is None:
+            continue
+
+        error = compare(words, stored_words[audiofile_id], offset)
+        if error is not None and error < best_error:
+            best_id, best_error = audiofile_id, error
+
+    if best_id is None:
+        return None
+
+    match = session.get(DBAudioFile, best_id)
+    if match is not None and match.duplicate_of is not None:
+        return session.get(DBAudioFile, match.duplicate_of)
+    return match
+
+def fingerprint_rows(words):
+    """
+    Build the fingerprint and hash index rows for a new DBAudioFile.
+
+    Returns:
+    - tuple: A DBAudioFingerprint and a list of DBFingerprintHash, to attach to the row.
+    """
+    words = np.asarray(words, dtype="<u4")
+    hashes = words.view("<i4")
+
+    fingerprint = DBAudioFingerprint(frames=len(words), words=words.tobytes())
+    index = [DBFingerprintHash(hash=int(hashes[frame]), offset=frame) for frame in range(0, len(words), INDEX_STRIDE)]
+    return fingerprint, index
+
+def insert_fingerprints(session, fingerprints):
+    """
+    Insert the fingerprints and hash index rows of newly inserted audio files with two
+    executemany statements, without building ORM objects.
+
+    Parameters:
+    - session (Session): An open database session. The caller commits.
+    - fingerprints (list): (audiofile id, fingerprint words) pairs. Empty fingerprints are skipped.
+    """
+    fingerprint_params = []
+    hash_params = []
+
+    for audiofile_id, words in fingerprints:
+        if words is None or len(words) == 0:
+            continue
+
+        words = np.asarray(words, dtype="<u4")
+        fingerprint_params.append({"audiofile_id": audiofile_id, "frames": len(words), "words": words.tobytes()})
+        hash_params.extend(
+            {"hash": value, "audiofile_id": audiofile_id, "offset": frame * INDEX_STRIDE}
+            for frame, value in enumerate(words[::INDEX_STRIDE].view("<i4").tolist())
+        )
+
+    if fingerprint_params:
+        session.execute(insert(DBAudioFingerprint.__table__), fingerprint_params)
+    if hash_params:
+        session.execute(insert(DBFingerprintHash.__table__), hash_params)
+
+def inherited_attributes(match):
+    """Return the analysis results a duplicate takes over from its original."""
+    return {
+        "musical_key": match.key,
+        "scale_mode": match.scale_mode,
+        "tempo": match.tempo,
+        "instrument_type": match.instrument_type,
+        "duplicate_of": match.id,
+        "analysis_profile": match.analysis_profile,
+        "analysis_confidence": match.analysis_confidence,
+    }
+
+def backfill_fingerprints():
+    """
+    Fingerprint every audio file in the database that has no fingerprint yet, oldest first,
+    and link the ones that turn out to be copies of an earlier file.
+    """
+    import audio_buffers
+    from database_setup import Session
+
+    session = Session()
+    try:
+        audio_files = session.query(DBAudioFile).filter(~DBAudioFile.fingerprint.has()).order_by(DBAudioFile.id).all()
+        print(f"Fingerprinting {len(audio_files)} audio files")
+
+        for audio_file in audio_files:
+            try:
+                audio_data, samplerate = audio_buffers.read_audiofile(audio_file)
+                words = compute_fingerprint(audio_data, samplerate)
+
+                match = find_duplicate(session, words, audio_file.absolute_path)
+                if match is not None and audio_file.duplicate_of is None:
+                    audio_file.duplicate_of = match.id
+
+                if len(words) > 0:
+                    audio_file.fingerprint, audio_file.fingerprint_hashes = fingerprint_rows(words)
+                session.flush()
+            except Exception as e:
+                print(f"An error occurred while fingerprinting {audio_file.absolute_path}: {str(e)}")
+
+        session.commit()
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+        session.rollback()
+    finally:
+        session.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Acoustic fingerprints for duplicate detection.")
+    parser.add_argument("--backfill", action="store_true", help="Fingerprint rows ingested without one and link duplicates.")
+    args = parser.parse_args()
+
+    if args.backfill:
+        backfill_fingerprints()
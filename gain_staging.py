@@ -0,0 +1,149 @@
+import argparse
+import numpy as np
+
+# Target RMS level in dB for each instrument type. Each layer is gained so that its stored
+# loudness lands on its instrument's target, which sets the balance of the mix.
+INSTRUMENT_TARGET_DB = {
+    "drums": -16.0,
+    "bass": -19.0,
+    "melodic": -22.0,
+    "vocals": -21.0,
+    "percussion": -26.0,
+    "fx": -27.0,
+    "undetermined": -24.0,
+}
+DEFAULT_TARGET_DB = -24.0
+MAX_GAIN_DB = 24.0  # Limit on boost or cut applied to a single layer
+LIMITER_CEILING_DB = -1.0
+LIMITER_WINDOW = 256  # Frames per gain-reduction step of the bus limiter
+
+def db_to_gain(db_amount):
+    return 10 ** (db_amount / 20)
+
+def rms_db(audio_data):
+    """
+    Measure the RMS level of audio data in dB relative to full scale.
+
+    Args:
+        audio_data (numpy.array): Input audio data as a numpy array.
+
+    Returns:
+        float: The RMS level in dB, or None for silent audio.
+    """
+    rms = float(np.sqrt(np.mean(np.square(audio_data, dtype=np.float64))))
+    if rms == 0:
+        return None
+    return 20 * np.log10(rms)
+
+def compute_layer_gains(audiofile_objects, layers=None, targets=None):
+    """
+    Compute one linear gain per layer from the loudness stored for each audio file.
+
+    A layer with no stored loudness (rows ingested before loudness was recorded) is measured
+    from its audio data instead, when `layers` is given; otherwise it is left at unity gain.
+
+    Args:
+        audiofile_objects (list): AudioFile or DBAudioFile objects, one per layer.
+        layers (list, optional): Audio data per layer, used only for layers without stored loudness.
+        targets (dict, optional): Target level per instrument type. Defaults to INSTRUMENT_TARGET_DB.
+
+    Returns:
+        numpy.array: float32 gain vector with one entry per layer.
+    """
+    if targets is None:
+        targets = INSTRUMENT_TARGET_DB
+
+    gains = np.ones(len(audiofile_objects), dtype=np.float32)
+
+    for index, audiofile in enumerate(audiofile_objects):
+        loudness = getattr(audiofile, "loudness", None)
+        if loudness is None and layers is not None:
+            loudness = rms_db(layers[index])
+        if loudness is None:
+            continue
+
+        target_db = targets.get(audiofile.instrument_type, DEFAULT_TARGET_DB)
+        gain_db = np.clip(target_db - loudness, -MAX_GAIN_DB, MAX_GAIN_DB)
+        gains[index] = db_to_gain(gain_db)
+
+    return gains
+
+def limit_bus(audio_data, ceiling_db=LIMITER_CEILING_DB, window=LIMITER_WINDOW):
+    """
+    Keep the peaks of a mixed bus under a ceiling, in place.
+
+    Gain reduction is computed per window of frames and interpolated between window centres.
+    Each window also takes its neighbours' reduction, so the interpolated gain never lets a
+    sample exceed the ceiling. Audio that is already under the ceiling is left untouched.
+
+    Args:
+        audio_data (numpy.array): Mixed audio data, (frames,) or (frames, channels).
+        ceiling_db (float, optional): Peak ceiling in dBFS. Defaults to LIMITER_CEILING_DB.
+        window (int, optional): Frames per gain step. Defaults to LIMITER_WINDOW.
+
+    Returns:
+        numpy.array: The same array, limited.
+    """
+    frames = audio_data.shape[0]
+    if frames == 0:
+        return audio_data
+
+    ceiling = db_to_gain(ceiling_db)
+
+    magnitude = np.abs(audio_data)
+    if magnitude.ndim > 1:
+        magnitude = magnitude.max(axis=1)
+
+    starts = np.arange(0, frames, window)
+    window_peaks = np.maximum.reduceat(magnitude, starts)
+    if window_peaks.max() <= ceiling:
+        return audio_data
+
+    window_gains = np.minimum(1.0, ceiling / np.maximum(window_peaks, 1e-12))
+    padded = np.pad(window_gains, 1, mode="edge")
+    window_gains = np.minimum(np.minimum(padded[:-2], padded[1:-1]), padded[2:])
+
+    centers = (starts + np.minimum(starts + window, frames)) / 2
+    gain = np.interp(np.arange(frames), centers, window_gains).astype(audio_data.dtype)
+
+    if audio_data.ndim > 1:
+        audio_data *= gain[:, np.newaxis]
+    else:
+        audio_data *= gain
+
+    return audio_data
+
+def backfill_loudness():
+    """
+    Measure and store the loudness of every audio file in the database that has none yet.
+    """
+    import audio_buffers
+    from dbaudiofile import DBAudioFile
+    from database_setup import Session
+
+    session = Session()
+    try:
+        audio_files = session.query(DBAudioFile).filter(DBAudioFile.loudness.is_(None)).all()
+        print(f"Measuring loudness of {len(audio_files)} audio files")
+
+        for audio_file in audio_files:
+            try:
+                audio_data, samplerate = audio_buffers.read_audiofile(audio_file)
+                audio_file.loudness = rms_db(audio_data)
+            except Exception as e:
+                print(f"An error occurred while measuring {audio_file.absolute_path}: {str(e)}")
+
+        session.commit()
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+        session.rollback()
+    finally:
+        session.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gain staging utilities.")
+    parser.add_argument("--backfill", action="store_true", help="Store loudness for rows ingested without it.")
+    args = parser.parse_args()
+
+    if args.backfill:
+        backfill_loudness()
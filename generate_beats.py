@@ -1,7 +1,15 @@
 import read_database as read
 import process_audio as pa
+import arrangement
+import audio_buffers
 import random
 import tags
+import argparse
+import profiling
+import prescan
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_TEMPO = 90
 
 def generate_attributes(key=None, tempo_min=None, tempo_max=None):
     if key == None:
@@ -55,20 +63,217 @@ def generate_attributes(key=None, tempo_min=None, tempo_max=None):
     
     return attributes
 
-attributes = generate_attributes()
+def select_song_stems(attributes):
+    """
+    Pick one matching audio file from the database for each layer description.
 
-print(f"Attributes: {attributes}")
+    Parameters:
+    - attributes (list): Layer descriptions as returned by generate_attributes().
 
-song = []
+    Returns:
+    - list: The selected DBAudioFile objects; layers without a match are skipped.
+    """
+    song = []
+    sounds = set()  # Originals already used, so no sound is picked twice under another name
 
-for dict in attributes:
-    my_dbaudiofile = read.get_audiofile_by_instrument_tempo_key(dict)
-    
-    if my_dbaudiofile is not None:
-        song.append(my_dbaudiofile)
-    else:
-        print(f"No matching audio file found. {dict}")
+    for dict in attributes:
+        my_dbaudiofile = read.get_audiofile_by_instrument_tempo_key(dict, exclude_sounds=sounds)
+        
+        if my_dbaudiofile is not None:
+            song.append(my_dbaudiofile)
+            sounds.add(my_dbaudiofile.duplicate_of or my_dbaudiofile.id)
+        else:
+            print(f"No matching audio file found. {dict}")
+
+    return song
+
+def plan_songs(count, keys=None, tempos=None):
+    """
+    Select the stems for every song of a batch before any audio is processed.
+
+    Keys and tempos are cycled through in order, so `count=6, keys=["C", "D"], tempos=[90, 120, 140]`
+    covers every combination once.
+
+    Parameters:
+    - count (int): Number of songs to plan.
+    - keys (list, optional): Musical keys to cycle through. A random key is chosen per song when omitted.
+    - tempos (list, optional): Target tempos to cycle through. Defaults to DEFAULT_TEMPO.
+
+    Returns:
+    - list: One dict per song with "key", "tempo" and "stems".
+    """
+    plans = []
+
+    for index in range(count):
+        key = keys[index % len(keys)] if keys else None
+        tempo = tempos[index % len(tempos)] if tempos else DEFAULT_TEMPO
+
+        attributes = generate_attributes(key)
+        stems = select_song_stems(attributes)
+
+        if not stems:
+            print(f"Skipping song {index}: no stems matched {attributes}")
+            continue
+
+        plans.append({"key": key, "tempo": tempo, "stems": stems})
+
+    return plans
+
+def stretch_planned_stems(plans, max_workers=None, sample_rate=None):
+    """
+    Stretch each distinct stem once per target tempo, no matter how many songs use it.
+
+    Parameters:
+    - plans (list): Song plans from plan_songs().
+    - max_workers (int, optional): Number of stems stretched concurrently.
+    - sample_rate (int, optional): Resample every stem to this rate while stretching it.
+
+    Returns:
+    - dict: Stretched AudioFile objects keyed by (DBAudioFile id, tempo). Failed stems are left out.
+    """
+    stretched = {}
+
+    for tempo in sorted({plan["tempo"] for plan in plans}):
+        distinct_stems = {}
+        for plan in plans:
+            if plan["tempo"] == tempo:
+                for stem in plan["stems"]:
+                    distinct_stems.setdefault(stem.id, stem)
+
+        stems = list(distinct_stems.values())
+        print(f"Stretching {len(stems)} distinct stems to {tempo} BPM")
+
+        results = pa.stretch_audiofiles_to_tempo(stems, tempo, max_workers=max_workers, keep_failed=True,
+                                                 target_sample_rate=sample_rate)
+
+        for stem, stretched_file in zip(stems, results):
+            if stretched_file is not None:
+                stretched[(stem.id, tempo)] = stretched_file
+
+    return stretched
+
+def batch_sample_rate(plans):
+    """
+    Choose the sample rate a batch is mixed at, so that the fewest stems are resampled.
+
+    A stem prerendered at its song's tempo counts at the rate of the prerender; the others
+    count at the rate in their prescanned header (see prescan.sample_rate_plan).
 
-song_timestretched = pa.stretch_audiofiles_to_tempo(song, 90)
-song_audiofile_path = pa.mix_audio_files(song_timestretched)
-print(f"Here is the path to your new song: {song_audiofile_path}")
\ No newline at end of file
+    Returns:
+    - int: The sample rate, or None if no stem has a prerender or a prescanned header.
+    """
+    prerendered_rates = []
+    unrendered_paths = set()
+
+    for plan in plans:
+        for stem in plan["stems"]:
+            prerendered = pa.find_prerendered_stem(stem, plan["tempo"])
+            if prerendered is not None:
+                prerendered_rates.append(prerendered.sample_rate)
+            else:
+                unrendered_paths.add(stem.absolute_path)
+
+    header_rate, rates = prescan.sample_rate_plan(list(unrendered_paths))
+    rates.update(prerendered_rates)
+
+    if not rates:
+        return None
+
+    sample_rate = rates.most_common(1)[0][0]
+    print(f"Mixing at {sample_rate} Hz; {sum(rates.values()) - rates[sample_rate]} of {sum(rates.values())} stems are resampled")
+    return sample_rate
+
+def generate_batch(count, keys=None, tempos=None, workers=None, arrange=False, sample_rate=None):
+    """
+    Generate a batch of songs that share decoded and stretched stems.
+
+    All selections are planned first, every distinct stem is stretched once per tempo,
+    and the mixes are rendered concurrently from the shared in-memory stems.
+
+    Parameters:
+    - count (int): Number of songs to generate.
+    - keys (list, optional): Musical keys to cycle through.
+    - tempos (list, optional): Target tempos to cycle through.
+    - workers (int, optional): Number of songs mixed, and stems stretched, concurrently.
+    - arrange (bool, optional): Render each song along arrangement.DEFAULT_ARRANGEMENT instead of looping the full mix.
+    - sample_rate (int, optional): Output sample rate; stems are resampled to it while being stretched.
+      Defaults to the rate that needs the fewest stems resampled, see batch_sample_rate().
+
+    Returns:
+    - list: Paths of the generated songs.
+    """
+    plans = plan_songs(count, keys, tempos)
+    if sample_rate is None:
+        sample_rate = batch_sample_rate(plans)
+    stretched = stretch_planned_stems(plans, max_workers=workers, sample_rate=sample_rate)
+
+    def render(indexed_plan):
+        index, plan = indexed_plan
+        song_timestretched = [stretched[(stem.id, plan["tempo"])] for stem in plan["stems"]
+                              if (stem.id, plan["tempo"]) in stretched]
+        if not song_timestretched:
+            return None
+        try:
+            if arrange:
+                return arrangement.render_song_arrangement(song_timestretched, song_id=f"{index:04d}", key=plan["key"])
+            return pa.mix_audio_files(song_timestretched, song_id=f"{index:04d}", key=plan["key"])
+        except Exception as e:
+            print(f"An error occurred while mixing song {index}: {str(e)}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        song_paths = [path for path in executor.map(render, enumerate(plans)) if path is not None]
+
+    return song_paths
+
+def generate_song(key=None, tempo=DEFAULT_TEMPO, arrange=False, sample_rate=None):
+    attributes = generate_attributes(key)
+
+    print(f"Attributes: {attributes}")
+
+    song = select_song_stems(attributes)
+
+    # The mix runs at the first stem's rate, so resample the others while they are stretched.
+    # A stem prerendered at this tempo sets the rate, so the other prerendered stems need no DSP.
+    if sample_rate is None and song:
+        prerendered = pa.find_prerendered_stem(song[0], tempo)
+        sample_rate = prerendered.sample_rate if prerendered is not None else song[0].sample_rate
+
+    song_timestretched = pa.stretch_audiofiles_to_tempo(song, tempo, target_sample_rate=sample_rate)
+
+    if arrange:
+        return arrangement.render_song_arrangement(song_timestretched, key=key)
+    return pa.mix_audio_files(song_timestretched, key=key)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate song ideas from the analyzed samples.")
+    parser.add_argument("--count", type=int, default=1, help="Number of songs to generate.")
+    parser.add_argument("--keys", nargs="+", help="Musical keys to cycle through, e.g. C D# A.")
+    parser.add_argument("--tempos", nargs="+", type=float, help="Target tempos to cycle through.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of parallel workers in batch mode.")
+    parser.add_argument("--arrange", action="store_true", help="Render songs along an intro/verse/drop/breakdown/outro timeline.")
+    parser.add_argument("--sample-rate", type=int, default=None, help="Output sample rate; stems are resampled while being stretched.")
+    parser.add_argument("--memory-budget-mb", type=int, default=None, help="Working memory shared by concurrent stretch and mix workers.")
+    parser.add_argument("--sample-archive", default=None, metavar="DIRECTORY", help="Read stems from this packed sample archive (see sample_archive.py).")
+    parser.add_argument("--capture-profiles", default=None, metavar="DIRECTORY", help="Save sampling profiles of the slowest stretches and mixes to this directory.")
+    args = parser.parse_args()
+
+    if args.capture_profiles:
+        profiling.enable(args.capture_profiles)
+
+    if args.sample_archive:
+        pa.set_sample_archive(args.sample_archive)
+
+    if args.memory_budget_mb is not None:
+        audio_buffers.set_memory_budget(args.memory_budget_mb * 1024 ** 2)
+
+    if args.count == 1:
+        key = args.keys[0] if args.keys else None
+        tempo = args.tempos[0] if args.tempos else DEFAULT_TEMPO
+        song_audiofile_path = generate_song(key, tempo, args.arrange, args.sample_rate)
+        print(f"Here is the path to your new song: {song_audiofile_path}")
+    else:
+        song_paths = generate_batch(args.count, args.keys, args.tempos, args.workers, args.arrange, args.sample_rate)
+        print(f"Generated {len(song_paths)} songs:")
+        for path in song_paths:
+            print(path)
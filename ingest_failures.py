@@ -0,0 +1,59 @@
+import time
+from dbaudiofile import DBIngestFailure
+from database_setup import Session
+
+def record_failure(path, stage, error, session=None):
+    """
+    Record that analyzing a file failed, or count another failed attempt.
+
+    Parameters:
+    - path (str): The path of the audio file.
+    - stage (str): The stage the file was in when it failed.
+    - error (str): Description of the error.
+    - session (Session, optional): Session to record in; the caller then commits. By default
+      the failure is committed on its own session.
+    """
+    own_session = session is None
+    if own_session:
+        session = Session()
+
+    try:
+        failure = session.query(DBIngestFailure).filter_by(absolute_path=path).first()
+        if failure is None:
+            failure = DBIngestFailure(absolute_path=path, attempts=0)
+            session.add(failure)
+
+        failure.stage = stage
+        failure.error = str(error)[:2000]
+        failure.attempts = (failure.attempts or 0) + 1
+        failure.last_attempt = time.time()
+
+        if own_session:
+            session.commit()
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+        if own_session:
+            session.rollback()
+    finally:
+        if own_session:
+            session.close()
+
+    print(f"Failed at {stage}: {path}: {error}")
+
+def clear_failures(session, paths):
+    """Forget earlier failures of files that were analyzed successfully. The caller commits."""
+    if paths:
+        session.query(DBIngestFailure).filter(DBIngestFailure.absolute_path.in_(paths)).delete(synchronize_session=False)
+
+def failed_paths(max_attempts=None):
+    """
+    Return the paths of all recorded failures, optionally only those tried fewer than max_attempts times.
+    """
+    session = Session()
+    try:
+        query = session.query(DBIngestFailure.absolute_path).order_by(DBIngestFailure.id)
+        if max_attempts is not None:
+            query = query.filter(DBIngestFailure.attempts < max_attempts)
+        return [path for (path,) in query]
+    finally:
+        session.close()
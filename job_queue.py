@@ -0,0 +1,214 @@
+import os
+import socket
+import time
+import uuid
+from sqlalchemy import and_, func, or_
+import ingest_failures
+from dbaudiofile import DBIngestJob
+
+LEASE_SECONDS = 600  # How long a claimed batch stays reserved without a heartbeat
+MAX_ATTEMPTS = 3  # Claims of one file before it is marked failed (e.g. it keeps crashing workers)
+ENQUEUE_CHUNK_SIZE = 500  # Paths checked against the table per query
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def new_claim_token(worker_id=None):
+    """
+    Return a token that identifies one claim. Rows are leased to the token rather than to the
+    worker, so a worker can always tell its current batch apart from an earlier, expired one.
+    """
+    return f"{worker_id or default_worker_id()}:{uuid.uuid4().hex}"
+
+def enqueue_paths(session, paths):
+    """
+    Add a pending job for every path that is not queued yet.
+
+    Parameters:
+    - session (Session): An open database session. The caller commits.
+    - paths (list): Absolute paths of the audio files to analyze.
+
+    Returns:
+    - int: The number of jobs added.
+    """
+    now = time.time()
+    added = 0
+
+    for start in range(0, len(paths), ENQUEUE_CHUNK_SIZE):
+        chunk = list(dict.fromkeys(paths[start:start + ENQUEUE_CHUNK_SIZE]))
+        existing = {
+            path for (path,) in
+            session.query(DBIngestJob.absolute_path).filter(DBIngestJob.absolute_path.in_(chunk))
+        }
+
+        new_jobs = [
+            {"absolute_path": path, "status": PENDING, "attempts": 0, "updated_at": now}
+            for path in chunk if path not in existing
+        ]
+        if new_jobs:
+            session.bulk_insert_mappings(DBIngestJob, new_jobs)
+            added += len(new_jobs)
+
+    return added
+
+def claimable(now):
+    """Filter for jobs that are pending or whose lease has expired."""
+    return and_(
+        DBIngestJob.attempts < MAX_ATTEMPTS,
+        or_(
+            DBIngestJob.status == PENDING,
+            and_(DBIngestJob.status == LEASED, DBIngestJob.lease_expires < now),
+        ),
+    )
+
+def claim_batch(session, token, batch_size=10, lease_seconds=LEASE_SECONDS):
+    """
+    Atomically lease up to batch_size claimable jobs to `token` and commit.
+
+    Candidates are selected first and then leased with a single conditional UPDATE that repeats
+    the claimable filter. The database applies that UPDATE under its write lock, so when several
+    workers race for the same rows each row ends up with exactly one of them, on SQLite as on
+    any other backend.
+
+    Jobs whose lease expired are released first: back to pending, or failed once they were
+    claimed MAX_ATTEMPTS times. Each expiry is recorded in ingest_failures, since the worker
+    that held the lease crashed or hung without reporting anything.
+
+    Parameters:
+    - session (Session): An open database session.
+    - token (str): Claim token from new_claim_token().
+    - batch_size (int, optional): Maximum number of jobs to claim. Defaults to 10.
+    - lease_seconds (float, optional): Lease length. Defaults to LEASE_SECONDS.
+
+    Returns:
+    - list: The claimed DBIngestJob rows. Empty when no work is left.
+    """
+    now = time.time()
+
+    release_expired(session, now)
+
+    candidate_ids = [
+        job_id for (job_id,) in
+        session.query(DBIngestJob.id).filter(claimable(now)).order_by(DBIngestJob.id).limit(batch_size)
+    ]
+    if not candidate_ids:
+        session.commit()
+        return []
+
+    session.query(DBIngestJob).filter(DBIngestJob.id.in_(candidate_ids), claimable(now)).update({
+        "status": LEASED,
+        "lease_owner": token,
+        "lease_expires": now + lease_seconds,
+        "attempts": DBIngestJob.attempts + 1,
+        "updated_at": now,
+    }, synchronize_session=False)
+    session.commit()
+
+    return session.query(DBIngestJob).filter(DBIngestJob.lease_owner == token, DBIngestJob.status == LEASED).all()
+
+def release_expired(session, now):
+    """
+    Release the jobs whose lease expired and record each expiry. Files whose leases expired
+    MAX_ATTEMPTS times are failed rather than handed out again. The caller commits.
+
+    Each job is released with its own conditional UPDATE, so when several workers claim at
+    once only one of them records a given expiry.
+
+    Returns:
+    - int: The number of jobs released.
+    """
+    expired = session.query(DBIngestJob.id, DBIngestJob.absolute_path, DBIngestJob.attempts, DBIngestJob.lease_owner).filter(
+        DBIngestJob.status == LEASED,
+        DBIngestJob.lease_expires < now,
+    ).all()
+
+    released = 0
+    for job_id, path, attempts, lease_owner in expired:
+        exhausted = attempts >= MAX_ATTEMPTS
+        error = "Lease expired too many times" if exhausted else "Lease expired"
+
+        if session.query(DBIngestJob).filter(
+            DBIngestJob.id == job_id,
+            DBIngestJob.status == LEASED,
+            DBIngestJob.lease_expires < now,
+        ).update({"status": FAILED if exhausted else PENDING, "lease_owner": None, "lease_expires": None,
+                  "error": error, "updated_at": now}, synchronize_session=False) != 1:
+            continue
+
+        ingest_failures.record_failure(path, "lease expired",
+                                       f"{error} (held by {lease_owner}, attempt {attempts} of {MAX_ATTEMPTS})", session)
+        released += 1
+
+    return released
+
+def heartbeat(session, token, lease_seconds=LEASE_SECONDS):
+    """
+    Extend the lease of every job still held by `token` and commit.
+
+    Returns:
+    - int: The number of jobs whose lease was extended.
+    """
+    now = time.time()
+    extended = session.query(DBIngestJob).filter(
+        DBIngestJob.lease_owner == token,
+        DBIngestJob.status == LEASED,
+    ).update({"lease_expires": now + lease_seconds, "updated_at": now}, synchronize_session=False)
+    session.commit()
+    return extended
+
+def complete(session, job_id, token):
+    """
+    Mark a job done if `token` still holds its lease. The caller commits, so the results of
+    the job can be written in the same transaction and only when this returns True.
+
+    Returns:
+    - bool: False if the lease was lost to another worker, whose results then count instead.
+    """
+    return session.query(DBIngestJob).filter(
+        DBIngestJob.id == job_id,
+        DBIngestJob.lease_owner == token,
+        DBIngestJob.status == LEASED,
+    ).update({"status": DONE, "lease_expires": None, "error": None, "updated_at": time.time()},
+             synchronize_session=False) == 1
+
+def fail(session, job_id, token, error, commit=True):
+    """
+    Mark a job failed if `token` still holds its lease, and commit unless commit is False.
+
+    Returns:
+    - bool: False if the lease was lost to another worker.
+    """
+    failed = session.query(DBIngestJob).filter(
+        DBIngestJob.id == job_id,
+        DBIngestJob.lease_owner == token,
+        DBIngestJob.status == LEASED,
+    ).update({"status": FAILED, "lease_expires": None, "error": str(error), "updated_at": time.time()},
+             synchronize_session=False) == 1
+    if commit:
+        session.commit()
+    return failed
+
+def requeue(session, paths):
+    """
+    Make the failed jobs of the given files claimable again. The caller commits.
+
+    Returns:
+    - int: The number of jobs requeued.
+    """
+    requeued = 0
+    for start in range(0, len(paths), ENQUEUE_CHUNK_SIZE):
+        requeued += session.query(DBIngestJob).filter(
+            DBIngestJob.absolute_path.in_(paths[start:start + ENQUEUE_CHUNK_SIZE]),
+            DBIngestJob.status == FAILED,
+        ).update({"status": PENDING, "attempts": 0, "lease_owner": None, "updated_at": time.time()},
+                 synchronize_session=False)
+    return requeued
+
+def status_counts(session):
+    """Return the number of jobs in each state."""
+    return dict(session.query(DBIngestJob.status, func.count(DBIngestJob.id)).group_by(DBIngestJob.status))
@@ -0,0 +1,203 @@
+import argparse
+from functools import lru_cache
+import numpy as np
+
+PITCH_CLASSES = ["C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B"]
+SCALE_MODES = ["Major", "Minor"]
+
+# Krumhansl-Kessler key profiles, starting on the tonic
+MAJOR_PROFILE = [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88]
+MINOR_PROFILE = [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]
+
+N_FFT = 4096
+HOP_LENGTH = 2048
+MIN_FREQUENCY = 55.0  # A1; the bass register below the N_FFT band is analyzed with a longer FFT
+MAX_FREQUENCY = 5000.0
+SEMITONE_WIDTH = 2 ** (1 / 12) - 1  # Width of a semitone relative to its frequency
+CONFIDENCE_THRESHOLD = 0.6  # Below this correlation, callers should fall back to CREPE
+
+def resolved_frequency(sample_rate, n_fft):
+    """Return the lowest frequency at which FFT bins of n_fft are no wider than a semitone."""
+    return sample_rate / n_fft / SEMITONE_WIDTH
+
+def low_band_n_fft(sample_rate):
+    """
+    Return the FFT size of the bass band: the smallest power-of-two multiple of N_FFT whose bins
+    resolve semitones down to MIN_FREQUENCY (16384 at 44.1 kHz).
+    """
+    factor = resolved_frequency(sample_rate, N_FFT) / MIN_FREQUENCY
+    return N_FFT * 2 ** max(0, int(np.ceil(np.log2(factor))))
+
+@lru_cache(maxsize=16)
+def chroma_filter(sample_rate, n_fft=N_FFT, min_frequency=MIN_FREQUENCY, max_frequency=MAX_FREQUENCY):
+    """
+    Build the matrix that folds STFT magnitude bins into 12 pitch classes.
+
+    Each bin between min_frequency (inclusive) and max_frequency (exclusive) is assigned to the
+    pitch class nearest to its centre frequency. Cached, since every file at a given sample
+    rate uses the same ones.
+
+    Returns:
+        numpy.array: float32 matrix shaped (12, n_fft // 2 + 1).
+    """
+    frequencies = np.fft.rfftfreq(n_fft, d=1.0 / sample_rate)
+    in_range = (frequencies >= min_frequency) & (frequencies < max_frequency)
+
+    weights = np.zeros((12, frequencies.shape[0]), dtype=np.float32)
+    bins = np.flatnonzero(in_range)
+    # MIDI note 60 is C4, so note number modulo 12 is the pitch class with C = 0
+    notes = np.rint(69 + 12 * np.log2(frequencies[bins] / 440.0)).astype(int)
+    weights[notes % 12, bins] = 1.0
+
+    weights.setflags(write=False)
+    return weights
+
+@lru_cache(maxsize=1)
+def key_profiles():
+    """
+    Return the 24 major and minor key profiles, z-normalized, as one (24, 12) matrix.
+
+    Rows 0-11 are the major keys C..B and rows 12-23 the minor keys C..B.
+    """
+    profiles = []
+    for profile in (MAJOR_PROFILE, MINOR_PROFILE):
+        for tonic in range(12):
+            profiles.append(np.roll(profile, tonic))
+
+    profiles = np.array(profiles, dtype=np.float64)
+    profiles -= profiles.mean(axis=1, keepdims=True)
+    profiles /= profiles.std(axis=1, keepdims=True)
+
+    profiles.setflags(write=False)
+    return profiles
+
+def band_chroma(audio_data, sample_rate, n_fft, hop_length, min_frequency, max_frequency):
+    """
+    Compute the pitch-class energy of one frequency band, summed over all frames.
+
+    Frames are taken as strided views and transformed in one batched FFT, so the whole
+    file is processed without a Python loop over frames.
+    """
+    frames = np.lib.stride_tricks.sliding_window_view(audio_data, n_fft)[::hop_length]
+    window = np.hanning(n_fft).astype(np.float32)
+    magnitudes = np.abs(np.fft.rfft(frames * window, axis=1))
+
+    return chroma_filter(sample_rate, n_fft, min_frequency, max_frequency) @ magnitudes.sum(axis=0)
+
+def chroma_vector(audio_data, sample_rate):
+    """
+    Compute the pitch-class energy of audio data, summed over all frames.
+
+    Below the frequency where N_FFT bins get wider than a semitone (about 180 Hz at 44.1 kHz),
+    bass energy would spread into neighbouring pitch classes, so that band is analyzed with
+    the longer FFT of low_band_n_fft(). Its hop grows by the same factor, which keeps the two
+    bands on the same scale.
+
+    Args:
+        audio_data (numpy.array): Audio data, mono or shaped (frames, channels).
+        sample_rate (int): Sample rate of the audio data.
+
+    Returns:
+        numpy.array: 12 pitch-class energies, or None if the audio is shorter than one frame.
+    """
+    if audio_data.ndim > 1:
+        audio_data = audio_data.mean(axis=1)
+
+    audio_data = np.asarray(audio_data, dtype=np.float32)
+    if audio_data.shape[0] < N_FFT:
+        return None
+
+    split_frequency = max(MIN_FREQUENCY, resolved_frequency(sample_rate, N_FFT))
+    chroma = band_chroma(audio_data, sample_rate, N_FFT, HOP_LENGTH, split_frequency, MAX_FREQUENCY)
+
+    # Files shorter than one long frame keep only the upper band
+    low_n_fft = low_band_n_fft(sample_rate)
+    if split_frequency > MIN_FREQUENCY and audio_data.shape[0] >= low_n_fft:
+        low_hop_length = HOP_LENGTH * low_n_fft // N_FFT
+        chroma += band_chroma(audio_data, sample_rate, low_n_fft, low_hop_length, MIN_FREQUENCY, split_frequency)
+
+    return chroma
+
+def detect_key(audio_data, sample_rate, key=None):
+    """
+    Estimate the key and scale mode of audio data by correlating its chroma with key profiles.
+
+    Args:
+        audio_data (numpy.array): Audio data, mono or shaped (frames, channels).
+        sample_rate (int): Sample rate of the audio data.
+        key (str, optional): A tonic already known (e.g. from the file name). Only its major and
+            minor profiles are then considered, which yields the scale mode alone.
+
+    Returns:
+        tuple: The key (e.g. "F#"), the scale mode ("Major" or "Minor") and a confidence, the
+        Pearson correlation of the best profile in [-1, 1]. Returns ("undetermined",
+        "undetermined", 0.0) for silent or too-short audio.
+    """
+    chroma = chroma_vector(audio_data, sample_rate)
+    if chroma is None or not np.any(chroma):
+        return "undetermined", "undetermined", 0.0
+
+    chroma = chroma - chroma.mean()
+    spread = chroma.std()
+    if spread == 0:
+        return "undetermined", "undetermined", 0.0
+
+    correlations = key_profiles() @ (chroma / spread) / 12
+
+    if key in PITCH_CLASSES:
+        tonic = PITCH_CLASSES.index(key)
+        candidates = [tonic, tonic + 12]
+        best = candidates[int(np.argmax(correlations[candidates]))]
+    else:
+        best = int(np.argmax(correlations))
+
+    return PITCH_CLASSES[best % 12], SCALE_MODES[best // 12], float(correlations[best])
+
+def backfill_scale_modes():
+    """
+    Detect and store the scale mode of every pitched audio file in the database that has none.
+
+    Keys that are already stored are kept; only the mode is detected for them. Files without a
+    key get one as well when the detection is confident.
+    """
+    import audio_buffers
+    from dbaudiofile import DBAudioFile
+    from database_setup import Session
+
+    session = Session()
+    try:
+        audio_files = (
+            session.query(DBAudioFile)
+            .filter(DBAudioFile.instrument_type != "drums")
+            .filter((DBAudioFile.scale_mode.is_(None)) | (DBAudioFile.scale_mode == "undetermined"))
+            .all()
+        )
+        print(f"Detecting the scale mode of {len(audio_files)} audio files")
+
+        for audio_file in audio_files:
+            try:
+                audio_data, samplerate = audio_buffers.read_audiofile(audio_file)
+                key, scale_mode, confidence = detect_key(audio_data, samplerate, key=audio_file.key)
+
+                if audio_file.key in PITCH_CLASSES:
+                    audio_file.scale_mode = scale_mode
+                elif confidence >= CONFIDENCE_THRESHOLD:
+                    audio_file.key = key
+                    audio_file.scale_mode = scale_mode
+            except Exception as e:
+                print(f"An error occurred while detecting {audio_file.absolute_path}: {str(e)}")
+
+        session.commit()
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+        session.rollback()
+    finally:
+        session.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chroma-based key and scale mode detection.")
+    parser.add_argument("--backfill", action="store_true", help="Store scale modes for rows ingested without one.")
+    args = parser.parse_args()
+
+    if args.backfill:
+        backfill_scale_modes()
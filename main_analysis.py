@@ -1,38 +1,63 @@
+import argparse
+from sqlalchemy import and_, insert, or_
 import audio_analysis as analysis
 import os
+import job_queue
+import fingerprint
+import ingest_failures
+import prescan
+import analysis_sandbox
+import analysis_profiles
+import profiling
+from analysis_profiles import DEFAULT_PROFILE
+from analysis_sandbox import AnalysisSandbox, FileFailure
 from audiofile import AudioFile
 from dbaudiofile import DBAudioFile
 from database_setup import Session
 
 directory_path = r"/path/to/your/audio/samples"
 
-def get_audio_filepaths(directory_path, file_extensions=[". wav"]):
+def find_duplicate_attributes(words, exclude_path=None):
     """
-    Retrieves all file paths with specified extensions in the given directory and its subdirectories.
+    Look up an acoustic fingerprint in the database.
 
     Parameters:
-    - directory_path (str): The path to the directory to be searched.
-    - file_extensions (list of str, optional): A list of file extensions to be searched for (default is [".wav"]).
+    - words (numpy.array): Fingerprint of the file being analyzed.
+    - exclude_path (str, optional): Path whose own row must not count as a match, for re-analysis.
 
     Returns:
-    - list of str: The paths to all files with the specified extensions in the directory structure.
-    """
-    audio_filepaths = []
-    
-    # Walk through root, dirs, and files in the directory
-    for root, dirs, files in os.walk(directory_path):
-        for file in files:
-            # Check if file ends with one of the desired extensions
-            if any(file.lower().endswith(ext) for ext in file_extensions):
-                # Construct full path to the audio file and append to list
-                audio_filepaths.append(os.path.join(root, file))
-    print(f"Total number of audio files found: {len(audio_filepaths)}")
-    return audio_filepaths
-
-def create_audio_file_from_analysis(audio_file_path):
-    attributes = analysis.analyze(audio_file_path)
-
-    if attributes:
+    - dict: Attributes to inherit from the matching original, or None.
+    """
+    session = Session()
+    try:
+        match = fingerprint.find_duplicate(session, words, exclude_path)
+        return None if match is None else fingerprint.inherited_attributes(match)
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+        return None
+    finally:
+        session.close()
+
+def create_audio_files_from_analysis(audio_file_path, pitch_queue=None, report_stage=analysis.no_stage, profile=DEFAULT_PROFILE):
+    """
+    Analyze an audio file and build AudioFiles from its attributes.
+
+    Parameters:
+    - audio_file_path (str): The path of the audio file.
+    - pitch_queue (list, optional): When given, files that need CREPE are not pitched here but
+      appended to this list, to be pitched in batches with audio_analysis.resolve_pending_keys().
+    - report_stage (callable, optional): Called with the name of each analysis stage as it starts.
+    - profile (str, optional): Analysis profile, see analysis_profiles.py.
+
+    Returns:
+    - list: One AudioFile for a file inside the duration window, one per segment for a longer
+      file, and none for a file that is too short.
+    """
+    audio_files = []
+
+    for attributes in analysis.analyze(audio_file_path, defer_pitch=pitch_queue is not None,
+                                       duplicate_lookup=lambda words: find_duplicate_attributes(words, audio_file_path),
+                                       report_stage=report_stage, profile=profile):
         # Extracting directory and file info
         directory_path, filename = os.path.split(audio_file_path)
         file_name, file_type = os.path.splitext(filename)
@@ -44,44 +69,71 @@ def create_audio_file_from_analysis(audio_file_path):
             absolute_path=audio_file_path,
             directory_path=directory_path,
             key=attributes["musical_key"],
+            scale_mode=attributes["scale_mode"],
             tempo=attributes["tempo"],
             instrument_type=attributes["instrument_type"],
             length_in_samples=attributes["length_in_samples"],
             sample_rate=attributes["sample_rate"],
+            loudness=attributes["loudness"],
+            fingerprint=attributes["fingerprint"],
+            duplicate_of=attributes["duplicate_of"],
+            segment_start=attributes["segment_start"],
+            segment_end=attributes["segment_end"],
+            analysis_profile=attributes["analysis_profile"],
+            analysis_confidence=attributes["analysis_confidence"],
         )
-        return audio_file
 
-def create_db_audiofile(audio_file):
+        if attributes["pitch_pending"]:
+            pitch_queue.append(audio_file)
+
+        audio_files.append(audio_file)
+
+    return audio_files
+
+def insert_audio_files(session, audio_files):
     """
-    Converts an AudioFile object into a DBAudioFile object.
-    
-    Parameters:
-        audio_file (AudioFile): The AudioFile object to convert.
-    
+    Insert audio files and their fingerprints with executemany Core inserts, without
+    building ORM objects. Each file is validated here, once, on its way into the database.
+    The caller commits.
+
     Returns:
-        DBAudioFile: A corresponding DBAudioFile object.
-    """
-    return DBAudioFile(
-        filename=audio_file.filename,
-        file_type=audio_file.file_type,
-        absolute_path=audio_file.absolute_path,
-        directory_path=audio_file.directory_path,
-        key=audio_file.key,
-        genre=audio_file.genre,
-        scale_mode=audio_file.scale_mode,
-        tempo=audio_file.tempo,
-        instrument_type=audio_file.instrument_type,
-        length_in_samples=audio_file.length_in_samples,
-        sample_rate=audio_file.sample_rate,
-    )
+    - list: The ids of the new rows, in the order of audio_files.
+    """
+    if not audio_files:
+        return []
+
+    table = DBAudioFile.__table__
+    ids = session.execute(
+        insert(table).returning(table.c.id, sort_by_parameter_order=True),
+        [audio_file.validate().to_row() for audio_file in audio_files],
+    ).scalars().all()
+
+    fingerprint.insert_fingerprints(session, [(audiofile_id, audio_file.fingerprint) for audiofile_id, audio_file in zip(ids, audio_files)])
+    return ids
 
 def commit_audio_files_to_db(audio_files):
+    """
+    Insert audio files in one batch. If the batch fails, they are inserted again each in its
+    own savepoint, so a bad row is recorded as a failure instead of discarding the whole batch.
+    """
     session = Session()
 
     try:
-        for audio_file in audio_files:
-            my_db_audiofile = create_db_audiofile(audio_file)
-            session.add(my_db_audiofile)
+        committed_paths = []
+        try:
+            with session.begin_nested():
+                insert_audio_files(session, audio_files)
+            committed_paths = [audio_file.absolute_path for audio_file in audio_files]
+        except Exception:
+            for audio_file in audio_files:
+                try:
+                    with session.begin_nested():
+                        insert_audio_files(session, [audio_file])
+                    committed_paths.append(audio_file.absolute_path)
+                except Exception as e:
+                    ingest_failures.record_failure(audio_file.absolute_path, "commit", e, session)
+
+        ingest_failures.clear_failures(session, committed_paths)
         session.commit()
     except Exception as e:
         print(f"An error occurred: {str(e)}")
@@ -89,26 +141,291 @@ def commit_audio_files_to_db(audio_files):
     finally:
         session.close()
 
-audio_files_buffer = []
 BUFFER_SIZE = 100  # The number of files to commit at a time
+WORKER_BATCH_SIZE = 20  # The number of files a queue worker claims at a time
+
+def analyze_isolated(sandbox, path, pitch_queue, profile=DEFAULT_PROFILE):
+    """
+    Analyze one file in the sandbox, recording it as failed if it errors, hangs or crashes.
+
+    Returns:
+    - list: The AudioFiles of the file (one per segment for long files). Empty if it was rejected or failed.
+    """
+    try:
+        results = sandbox.analyze(path, profile)
+    except FileFailure as e:
+        ingest_failures.record_failure(path, e.stage, e.error)
+        return []
 
-file_extensions = [".wav"]  # Add or remove desired audio file extensions
-audio_paths = get_audio_filepaths(directory_path, file_extensions)
+    pitch_queue.extend(audio_file for audio_file, pitch_pending in results if pitch_pending)
+    return [audio_file for audio_file, pitch_pending in results]
 
-remaining_files = len(audio_paths)
+def pitch_isolated(sandbox, pitch_queue, heartbeat=None):
+    """
+    Pitch the queued files in one sandboxed batch. If the batch fails, the files are pitched
+    one at a time so that only the culprit is recorded as failed. heartbeat, if given, is
+    called regularly while the batch runs and after each file pitched on its own.
+
+    Returns:
+    - set: Paths of the files that failed.
+    """
+    if not pitch_queue:
+        return set()
+
+    try:
+        sandbox.pitch(pitch_queue, heartbeat)
+        return set()
+    except FileFailure:
+        pass
+
+    failed_paths = set()
+    for audio_file in pitch_queue:
+        try:
+            sandbox.pitch([audio_file], heartbeat)
+        except FileFailure as e:
+            ingest_failures.record_failure(audio_file.absolute_path, e.stage, e.error)
+            failed_paths.add(audio_file.absolute_path)
+
+        if heartbeat is not None:
+            heartbeat()
 
-for path in audio_paths:
-    audio_file = create_audio_file_from_analysis(path)
-    remaining_files = remaining_files - 1
-    if audio_file is not None:
-        audio_files_buffer.append(audio_file)
+    return failed_paths
 
-    print(f"Files remaining: {remaining_files}")
+def ingest_paths(audio_paths, sandbox, profile=DEFAULT_PROFILE):
+    """
+    Analyze audio files in a sandboxed process and commit them to the database in batches.
+    """
+    audio_files_buffer = []
+    pitch_queue = []  # Files of the buffer that still need CREPE, pitched together before each commit
 
-    if len(audio_files_buffer) >= BUFFER_SIZE:
-        commit_audio_files_to_db(audio_files_buffer)
+    def flush():
+        failed_paths = pitch_isolated(sandbox, pitch_queue)
+        commit_audio_files_to_db([audio_file for audio_file in audio_files_buffer if audio_file.absolute_path not in failed_paths])
+        pitch_queue.clear()
         audio_files_buffer.clear()
 
-# Don't forget to commit the last batch if there are any left
-if audio_files_buffer:
-    commit_audio_files_to_db(audio_files_buffer)
+    remaining_files = len(audio_paths)
+
+    for path in audio_paths:
+        audio_files_buffer.extend(analyze_isolated(sandbox, path, pitch_queue, profile))
+        remaining_files = remaining_files - 1
+
+        print(f"Files remaining: {remaining_files}")
+
+        if len(audio_files_buffer) >= BUFFER_SIZE:
+            flush()
+
+    # Don't forget to commit the last batch if there are any left
+    if audio_files_buffer:
+        flush()
+
+def ingest_directory(directory_path, file_extensions, sandbox, profile=DEFAULT_PROFILE):
+    """
+    Analyze every audio file in a directory tree and commit it to the database, in one process.
+
+    Headers are prescanned first, so files that are too short are skipped without being decoded.
+    """
+    audio_paths = prescan.prescan_directory(directory_path, file_extensions)
+    print(f"Ingest estimate: {prescan.estimate_ingest_cost(audio_paths)}")
+    ingest_paths(prescan.analyzable_paths(audio_paths), sandbox, profile)
+
+def retry_failed(sandbox, max_attempts=None, profile=DEFAULT_PROFILE):
+    """
+    Analyze only the files recorded as failed. Files that succeed leave the failures table.
+    """
+    audio_paths = ingest_failures.failed_paths(max_attempts)
+    print(f"Retrying {len(audio_paths)} failed audio files")
+
+    # Queue jobs of these files are made claimable again as well
+    session = Session()
+    try:
+        job_queue.requeue(session, audio_paths)
+        session.commit()
+    finally:
+        session.close()
+
+    ingest_paths(audio_paths, sandbox, profile)
+
+def upgrade_candidates(profile):
+    """
+    Find the files whose rows an upgrade to `profile` should refine: rows analyzed with a
+    cheaper profile whose confidence is below that profile's "upgrade_below". Rows from before
+    profiles were recorded count as "balanced" and are refined when their key or instrument
+    is undetermined. Copies of other files are left out, since they inherit from their original.
+
+    Returns:
+    - list: Absolute paths of the files to analyze again.
+    """
+    conditions = []
+    for name in analysis_profiles.cheaper_profiles(profile):
+        conditions.append(and_(
+            DBAudioFile.analysis_profile == name,
+            or_(DBAudioFile.analysis_confidence.is_(None),
+                DBAudioFile.analysis_confidence < analysis_profiles.PROFILES[name]["upgrade_below"]),
+        ))
+        if name == "balanced":
+            conditions.append(and_(
+                DBAudioFile.analysis_profile.is_(None),
+                or_(DBAudioFile.instrument_type == "undetermined",
+                    and_(DBAudioFile.instrument_type != "drums", DBAudioFile.key == "undetermined")),
+            ))
+
+    if not conditions:
+        return []
+
+    session = Session()
+    try:
+        return [path for (path,) in session.query(DBAudioFile.absolute_path)
+                .filter(DBAudioFile.duplicate_of.is_(None), or_(*conditions))
+                .distinct().order_by(DBAudioFile.absolute_path)]
+    finally:
+        session.close()
+
+def upgrade_rows(sandbox, profile="accurate"):
+    """
+    Analyze low-confidence rows again with a more expensive profile and update them in place.
+    """
+    import watch_ingest
+
+    audio_paths = upgrade_candidates(profile)
+    print(f"Upgrading {len(audio_paths)} audio files to the {profile} profile")
+
+    for start in range(0, len(audio_paths), BUFFER_SIZE):
+        watch_ingest.analyze_paths(audio_paths[start:start + BUFFER_SIZE], sandbox, profile)
+        print(f"Files remaining: {max(0, len(audio_paths) - start - BUFFER_SIZE)}")
+
+def enqueue_directory(directory_path, file_extensions):
+    """
+    Add every audio file in a directory tree to the shared ingest queue. Files whose prescanned
+    header shows they are too short are not queued.
+    """
+    audio_paths = prescan.analyzable_paths(prescan.prescan_directory(directory_path, file_extensions))
+
+    session = Session()
+    try:
+        added = job_queue.enqueue_paths(session, audio_paths)
+        session.commit()
+        print(f"Queued {added} new audio files")
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+        session.rollback()
+    finally:
+        session.close()
+
+def commit_claimed_audio_files(results, token):
+    """
+    Insert the analyzed files of a claimed batch and mark their jobs done, in one transaction.
+
+    A file whose lease was lost in the meantime is skipped, since the worker that reclaimed it
+    inserts it instead.
+
+    Parameters:
+    - results (list): (job id, path, list of AudioFiles) triples. An empty list marks files analysis rejected.
+    - token (str): The claim token the batch was leased to.
+    """
+    session = Session()
+
+    try:
+        committed_paths = []
+        for job_id, path, audio_files in results:
+            try:
+                with session.begin_nested():
+                    if job_queue.complete(session, job_id, token) and audio_files:
+                        insert_audio_files(session, audio_files)
+                        committed_paths.append(path)
+            except Exception as e:
+                ingest_failures.record_failure(path, "commit", e, session)
+                job_queue.fail(session, job_id, token, e, commit=False)
+
+        ingest_failures.clear_failures(session, committed_paths)
+        session.commit()
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+        session.rollback()
+    finally:
+        session.close()
+
+def run_worker(sandbox, worker_id=None, batch_size=WORKER_BATCH_SIZE, lease_seconds=job_queue.LEASE_SECONDS,
+               profile=DEFAULT_PROFILE):
+    """
+    Claim batches from the shared ingest queue and analyze them until the queue is empty.
+
+    Any number of workers on any host can run against the same database. The lease of a batch
+    is renewed after every file and while the batch is pitched; if a worker dies, its files are
+    reclaimed once the lease expires, and the expiry is recorded in ingest_failures.
+    """
+    session = Session()
+
+    try:
+        while True:
+            token = job_queue.new_claim_token(worker_id)
+            jobs = [(job.id, job.absolute_path) for job in job_queue.claim_batch(session, token, batch_size, lease_seconds)]
+            if not jobs:
+                break
+
+            results = []
+            pitch_queue = []
+
+            def renew():
+                job_queue.heartbeat(session, token, lease_seconds)
+
+            for job_id, path in jobs:
+                try:
+                    analyzed = sandbox.analyze(path, profile)
+                    results.append((job_id, path, [audio_file for audio_file, pitch_pending in analyzed]))
+                    pitch_queue.extend(audio_file for audio_file, pitch_pending in analyzed if pitch_pending)
+                except FileFailure as e:
+                    ingest_failures.record_failure(path, e.stage, e.error)
+                    job_queue.fail(session, job_id, token, e)
+
+                renew()
+
+            failed_paths = pitch_isolated(sandbox, pitch_queue, renew)
+            for job_id, path, audio_files in results:
+                if path in failed_paths:
+                    job_queue.fail(session, job_id, token, "Pitch estimation failed")
+            results = [result for result in results if result[1] not in failed_paths]
+
+            commit_claimed_audio_files(results, token)
+
+            print(f"Queue: {job_queue.status_counts(session)}")
+    finally:
+        session.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Analyze audio samples and store them in the database.")
+    parser.add_argument("--directory", default=directory_path, help="Root directory of the audio samples.")
+    parser.add_argument("--enqueue", action="store_true", help="Add the files of the directory to the shared ingest queue.")
+    parser.add_argument("--worker", action="store_true", help="Process files from the shared ingest queue.")
+    parser.add_argument("--worker-id", default=None, help="Name of this worker. Defaults to host:pid.")
+    parser.add_argument("--batch-size", type=int, default=WORKER_BATCH_SIZE, help="Files claimed per batch.")
+    parser.add_argument("--lease-seconds", type=float, default=job_queue.LEASE_SECONDS, help="Lease length of a claimed batch.")
+    parser.add_argument("--retry-failed", action="store_true", help="Only analyze files recorded as failed.")
+    parser.add_argument("--max-attempts", type=int, default=None, help="With --retry-failed, skip files that failed this often.")
+    parser.add_argument("--profile", default=DEFAULT_PROFILE, choices=analysis_profiles.PROFILE_ORDER, help="Analysis profile.")
+    parser.add_argument("--upgrade", action="store_true", help="Refine low-confidence rows of cheaper profiles with --profile.")
+    parser.add_argument("--timeout", type=float, default=analysis_sandbox.FILE_TIMEOUT_SECONDS, help="Seconds allowed per file.")
+    parser.add_argument("--memory-limit-mb", type=float, default=analysis_sandbox.FILE_MEMORY_LIMIT_MB, help="Memory allowed for the analysis process.")
+    parser.add_argument("--capture-profiles", default=None, metavar="DIRECTORY", help="Save sampling profiles of the slowest files to this directory.")
+    args = parser.parse_args()
+
+    if args.capture_profiles:
+        profiling.enable(args.capture_profiles)  # Before the sandbox starts, so its process profiles too
+
+    file_extensions = [".wav"]  # Add or remove desired audio file extensions
+
+    with AnalysisSandbox(args.timeout, args.memory_limit_mb) as sandbox:
+        if args.retry_failed:
+            retry_failed(sandbox, args.max_attempts, args.profile)
+
+        if args.enqueue:
+            enqueue_directory(args.directory, file_extensions)
+
+        if args.worker:
+            run_worker(sandbox, args.worker_id, args.batch_size, args.lease_seconds, args.profile)
+
+        if args.upgrade:
+            upgrade_rows(sandbox, args.profile)
+
+        if not args.enqueue and not args.worker and not args.retry_failed and not args.upgrade:
+            ingest_directory(args.directory, file_extensions, sandbox, args.profile)
@@ -0,0 +1,149 @@
+import argparse
+import os
+import soundfile as sf
+import process_audio as pa
+import audio_buffers
+import resampling
+import gain_staging
+from audiofile import AudioFile
+from dbaudiofile import DBAudioFile, DBPrerenderedStem
+from database_setup import Session
+
+PROJECT_SAMPLE_RATE = 44100
+TEMPO_GRID = [80, 90, 100, 120, 140]
+TARGET_RMS_DB = -20.0  # Loudness every prerendered stem is normalized to, in dB RMS
+PRERENDER_DIR = "./prerendered"
+BATCH_SIZE = 50  # The number of audio files prerendered per database commit
+
+def normalize_loudness(audio_data, target_db=TARGET_RMS_DB):
+    """
+    Scale audio data so that its RMS level equals target_db.
+
+    Args:
+        audio_data (numpy.array): Input audio data as a numpy array.
+        target_db (float, optional): The desired RMS level in dB. Defaults to TARGET_RMS_DB.
+
+    Returns:
+        numpy.array: The scaled audio data. Silent input is returned unchanged.
+    """
+    current_db = gain_staging.rms_db(audio_data)
+    if current_db is None:
+        return audio_data
+
+    gain = gain_staging.db_to_gain(target_db - current_db)
+    return (audio_data * gain).astype(audio_data.dtype, copy=False)
+
+def prerender_audiofile(dbaudiofile, tempos=None, sample_rate=PROJECT_SAMPLE_RATE, output_dir=PRERENDER_DIR):
+    """
+    Render an audio file into canonical loop form at every tempo of the grid.
+
+    The source is resampled to the project sample rate and loudness-normalized once. For each
+    grid tempo it is then stretched, trimmed to whole bars and faded, exactly as
+    process_audio.prep_audio_files would do at generation time, and written as a float WAV.
+
+    Parameters:
+    - dbaudiofile (DBAudioFile): The audio file to prerender.
+    - tempos (list, optional): Grid tempos. Defaults to TEMPO_GRID.
+    - sample_rate (int, optional): Project sample rate. Defaults to PROJECT_SAMPLE_RATE.
+    - output_dir (str, optional): Root of the managed store. Defaults to PRERENDER_DIR.
+
+    Returns:
+    - list: New DBPrerenderedStem rows, not yet added to a session.
+    """
+    if tempos is None:
+        tempos = TEMPO_GRID
+
+    y, sr = audio_buffers.read_audiofile(dbaudiofile)
+    y = resampling.resample(y, sr, sample_rate, pa.RESAMPLE_QUALITY)
+    y = normalize_loudness(y)
+
+    source = AudioFile(
+        filename=dbaudiofile.filename,
+        file_type="wav",
+        absolute_path=dbaudiofile.absolute_path,
+        directory_path=dbaudiofile.directory_path,
+        key=dbaudiofile.key,
+        tempo=dbaudiofile.tempo,
+        instrument_type=dbaudiofile.instrument_type,
+        length_in_samples=len(y),
+        sample_rate=sample_rate,
+        audio_data=y,
+    )
+
+    stem_dir = os.path.join(output_dir, str(dbaudiofile.id))
+    os.makedirs(stem_dir, exist_ok=True)
+
+    rows = []
+    for tempo in tempos:
+        # The renders are stored here, so they stay out of the render cache and its working set
+        stretched = pa.time_stretch_audiofile(source, dbaudiofile.tempo, tempo, cache=False)
+        if stretched is None:
+            continue
+
+        loop = pa.trim_to_loop(stretched.audio_data, sample_rate, tempo, 4)
+        loop = pa.fade_out(loop, 20, sample_rate)
+
+        path = os.path.abspath(os.path.join(stem_dir, f"{tempo:g}.wav"))
+        sf.write(path, loop, sample_rate, subtype="FLOAT")
+
+        rows.append(DBPrerenderedStem(
+            audiofile_id=dbaudiofile.id,
+            tempo=float(tempo),
+            sample_rate=sample_rate,
+            length_in_samples=loop.shape[0],
+            loudness=gain_staging.rms_db(loop),
+            absolute_path=path,
+        ))
+
+    return rows
+
+def prerender_library(tempos=None, sample_rate=PROJECT_SAMPLE_RATE, force=False):
+    """
+    Prerender every audio file in the database that has no renders on the grid yet.
+
+    Parameters:
+    - tempos (list, optional): Grid tempos. Defaults to TEMPO_GRID.
+    - sample_rate (int, optional): Project sample rate. Defaults to PROJECT_SAMPLE_RATE.
+    - force (bool, optional): Replace existing renders as well.
+    """
+    if tempos is None:
+        tempos = TEMPO_GRID
+
+    session = Session()
+    try:
+        query = session.query(DBAudioFile).filter(DBAudioFile.tempo > 0)
+        if not force:
+            query = query.filter(~DBAudioFile.prerendered_stems.any())
+
+        audio_files = query.all()
+        remaining_files = len(audio_files)
+        print(f"Prerendering {remaining_files} audio files at {tempos} BPM")
+
+        for index, dbaudiofile in enumerate(audio_files, start=1):
+            try:
+                rows = prerender_audiofile(dbaudiofile, tempos, sample_rate)
+                dbaudiofile.prerendered_stems = rows
+            except Exception as e:
+                print(f"An error occurred while prerendering {dbaudiofile.absolute_path}: {str(e)}")
+
+            remaining_files = remaining_files - 1
+            print(f"Files remaining: {remaining_files}")
+
+            if index % BATCH_SIZE == 0:
+                session.commit()
+
+        session.commit()
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+        session.rollback()
+    finally:
+        session.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prerender loop-ready stems on a tempo grid.")
+    parser.add_argument("--tempos", nargs="+", type=float, default=TEMPO_GRID, help="Grid tempos in BPM.")
+    parser.add_argument("--sample-rate", type=int, default=PROJECT_SAMPLE_RATE, help="Project sample rate.")
+    parser.add_argument("--force", action="store_true", help="Replace existing renders.")
+    args = parser.parse_args()
+
+    prerender_library(args.tempos, args.sample_rate, args.force)
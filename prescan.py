@@ -0,0 +1,225 @@
+import argparse
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import soundfile as sf
+import utilities
+from analysis_profiles import MIN_DURATION, MAX_DURATION, SEGMENT_TARGET_SECONDS
+from dbaudiofile import DBAudioHeader
+from database_setup import Session
+
+PRESCAN_THREADS = 64  # Header reads in flight; mostly waiting on I/O, so far more than the number of cores
+PRESCAN_CHUNK_SIZE = 1000  # Paths scanned and written per transaction
+DECODED_BYTES_PER_SAMPLE = 4  # float32
+
+def read_header(path, known=None):
+    """
+    Read the facts of an audio file from its header, without decoding any audio.
+
+    Parameters:
+    - path (str): Path to the audio file.
+    - known (tuple, optional): (size, mtime_ns) stored by an earlier scan. If the file still
+      matches, the header is not read again.
+
+    Returns:
+    - dict: Column values for DBAudioHeader, or None if the file is unchanged or gone.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    if known is not None and known == (stat.st_size, stat.st_mtime_ns):
+        return None
+
+    header = {
+        "absolute_path": path,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "format": None,
+        "subtype": None,
+        "sample_rate": None,
+        "channels": None,
+        "frames": None,
+        "duration": None,
+        "error": None,
+        "scanned_at": time.time(),
+    }
+
+    try:
+        info = sf.info(path)
+        header.update({
+            "format": info.format,
+            "subtype": info.subtype,
+            "sample_rate": info.samplerate,
+            "channels": info.channels,
+            "frames": info.frames,
+            "duration": info.frames / info.samplerate,
+        })
+    except Exception as e:
+        header["error"] = str(e)[:2000]
+
+    return header
+
+def prescan_paths(paths, threads=PRESCAN_THREADS):
+    """
+    Read the headers of audio files in parallel and store them in the audio_headers table.
+
+    Files already scanned with the same size and mtime are skipped, so scanning a library
+    again only reads the headers of new and changed files.
+
+    Parameters:
+    - paths (list): Absolute paths of the audio files.
+    - threads (int, optional): Header reads in flight. Defaults to PRESCAN_THREADS.
+
+    Returns:
+    - int: The number of headers read.
+    """
+    session = Session()
+    scanned = 0
+
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            for start in range(0, len(paths), PRESCAN_CHUNK_SIZE):
+                chunk = list(dict.fromkeys(paths[start:start + PRESCAN_CHUNK_SIZE]))
+                existing = {
+                    path: (header_id, (size, mtime_ns)) for header_id, path, size, mtime_ns in
+                    session.query(DBAudioHeader.id, DBAudioHeader.absolute_path, DBAudioHeader.size, DBAudioHeader.mtime_ns)
+                    .filter(DBAudioHeader.absolute_path.in_(chunk))
+                }
+
+                new_headers = []
+                changed_headers = []
+                for header in executor.map(lambda path: read_header(path, existing.get(path, (None, None))[1]), chunk):
+                    if header is None:
+                        continue
+                    if header["absolute_path"] in existing:
+                        header["id"] = existing[header["absolute_path"]][0]
+                        changed_headers.append(header)
+                    else:
+                        new_headers.append(header)
+
+                session.bulk_insert_mappings(DBAudioHeader, new_headers)
+                session.bulk_update_mappings(DBAudioHeader, changed_headers)
+                session.commit()
+
+                scanned += len(new_headers) + len(changed_headers)
+                print(f"Scanned {min(start + PRESCAN_CHUNK_SIZE, len(paths))} of {len(paths)} audio files")
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+        session.rollback()
+    finally:
+        session.close()
+
+    return scanned
+
+def prescan_directory(directory_path, file_extensions=[".wav"], threads=PRESCAN_THREADS):
+    """
+    Scan the headers of every audio file in a directory tree.
+
+    Returns:
+    - list: The absolute paths of the audio files found.
+    """
+    audio_paths = [os.path.abspath(path) for path in utilities.get_audio_filepaths(directory_path, file_extensions)]
+    start = time.monotonic()
+    scanned = prescan_paths(audio_paths, threads)
+    print(f"Read {scanned} headers in {time.monotonic() - start:.1f} seconds")
+    return audio_paths
+
+def query_headers(session, paths):
+    """Yield the stored headers of the given paths."""
+    for start in range(0, len(paths), PRESCAN_CHUNK_SIZE):
+        yield from session.query(DBAudioHeader).filter(DBAudioHeader.absolute_path.in_(paths[start:start + PRESCAN_CHUNK_SIZE]))
+
+def analyzable_paths(paths, min_duration=MIN_DURATION):
+    """
+    Drop the files that analysis would reject for being too short, using the stored headers.
+
+    Files without a header, and files whose header could not be read, are kept, so that
+    analysis records why they fail.
+
+    Returns:
+    - list: The paths worth sending to analysis, in their original order.
+    """
+    session = Session()
+    try:
+        too_short = {
+            header.absolute_path for header in query_headers(session, paths)
+            if header.duration is not None and header.duration <= min_duration
+        }
+    finally:
+        session.close()
+
+    if too_short:
+        print(f"Skipping {len(too_short)} audio files shorter than {min_duration} seconds")
+    return [path for path in paths if path not in too_short]
+
+def sample_rate_plan(paths):
+    """
+    Choose the mix sample rate that needs the fewest stems resampled.
+
+    Returns:
+    - tuple: The chosen sample rate (None if no header is known) and a Counter of the number
+      of stems at each sample rate.
+    """
+    session = Session()
+    try:
+        rates = Counter(header.sample_rate for header in query_headers(session, paths) if header.sample_rate)
+    finally:
+        session.close()
+
+    if not rates:
+        return None, rates
+    return rates.most_common(1)[0][0], rates
+
+def estimate_ingest_cost(paths):
+    """
+    Estimate the work of ingesting audio files from their stored headers.
+
+    Returns:
+    - dict: Number of files that are too short, analyzed whole, segmented or unreadable, the
+      expected number of rows, hours of audio to decode and decoded gigabytes.
+    """
+    session = Session()
+    try:
+        cost = {"too_short": 0, "whole": 0, "segmented": 0, "unreadable": 0, "unscanned": 0, "rows": 0,
+                "audio_hours": 0.0, "decoded_gb": 0.0}
+        seen = 0
+
+        for header in query_headers(session, paths):
+            seen += 1
+            if header.error is not None or header.duration is None:
+                cost["unreadable"] += 1
+                continue
+
+            if header.duration <= MIN_DURATION:
+                cost["too_short"] += 1
+                continue
+
+            if header.duration >= MAX_DURATION:
+                cost["segmented"] += 1
+                cost["rows"] += int(header.duration // SEGMENT_TARGET_SECONDS)
+            else:
+                cost["whole"] += 1
+                cost["rows"] += 1
+
+            cost["audio_hours"] += header.duration / 3600
+            cost["decoded_gb"] += header.frames * header.channels * DECODED_BYTES_PER_SAMPLE / 1e9
+
+        cost["unscanned"] = len(set(paths)) - seen
+        return cost
+    finally:
+        session.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Read audio file headers into the database before analysis.")
+    parser.add_argument("--directory", required=True, help="Root directory of the audio samples.")
+    parser.add_argument("--threads", type=int, default=PRESCAN_THREADS, help="Header reads in flight.")
+    args = parser.parse_args()
+
+    audio_paths = prescan_directory(args.directory, threads=args.threads)
+
+    target_rate, rates = sample_rate_plan(audio_paths)
+    print(f"Sample rates: {dict(rates)}; mixing at {target_rate} resamples {sum(rates.values()) - rates[target_rate]} stems")
+    print(f"Ingest estimate: {estimate_ingest_cost(audio_paths)}")
@@ -0,0 +1,359 @@
+import argparse
+import json
+import struct
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import generate_beats
+import gain_staging
+import process_audio as pa
+import read_database as read
+
+PREVIEW_SAMPLE_RATE = 44100
+PREVIEW_CHANNELS = 2
+PREVIEW_BLOCK_FRAMES = 2048  # About 46 ms at 44.1 kHz; changes are heard from the next block on
+PREVIEW_LEAD_SECONDS = 0.25  # Audio sent ahead of real time, so the first block goes out at once
+PREVIEW_CACHE_LAYERS = 32  # Stretched stems kept in memory for swapping back and forth
+
+def wav_stream_header(sample_rate, channels):
+    """
+    Header of a 16-bit PCM WAV stream of unknown length. The sizes are set to the maximum, which
+    players treat as "until the connection closes".
+    """
+    byte_rate = sample_rate * channels * 2
+    return (
+        b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVE"
+        + b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, sample_rate, byte_rate, channels * 2, 16)
+        + b"data" + struct.pack("<I", 0xFFFFFFFF - 36)
+    )
+
+class PreviewMix:
+    """
+    The layers of the song being previewed, shared by every stream.
+
+    Each layer is a stem stretched to the preview tempo and kept in memory. Streams mix the
+    current layers block by block with process_audio.add_looped_layer, so replacing one layer
+    or all of them only changes what the next block reads; nothing else is rendered again.
+    Stems are stretched in the background, and a layer joins the mix as soon as it is ready.
+    """
+
+    def __init__(self, sample_rate=PREVIEW_SAMPLE_RATE, max_workers=None):
+        self.sample_rate = sample_rate
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or pa.STRETCH_WORKERS)
+        self.tempo = generate_beats.DEFAULT_TEMPO  # Tempo of the layers being played
+        self.render_tempo = self.tempo  # Tempo new layers are stretched to; differs while a tempo change is in flight
+        self.key = None
+        self.layers = {}  # Instrument type -> {"audiofile": DBAudioFile, "data": numpy.array, "gain": float}
+        self.pending = {}  # Instrument type -> the stem being stretched for it
+        self.staged = {}  # Layers at render_tempo that join the mix together with the tempo change
+        self.generation = 0  # Bumped by every song or tempo change, so stale renders are dropped
+        self.cache = OrderedDict()
+        self.cache_lock = threading.Lock()
+
+    def render_layer(self, audiofile, tempo):
+        """
+        Stretch a stem to `tempo` at the preview sample rate, trimmed to whole bars like
+        process_audio.prep_audio_files does, and compute its gain.
+
+        Returns:
+        - tuple: The float32 audio data and the linear gain.
+        """
+        cache_key = (audiofile.id, tempo)
+        with self.cache_lock:
+            if cache_key in self.cache:
+                self.cache.move_to_end(cache_key)
+                return self.cache[cache_key]
+
+        stretched = pa.load_prerendered_stem(audiofile, tempo, self.sample_rate)
+        if stretched is None:
+            stretched = pa.time_stretch_audiofile(audiofile, audiofile.tempo, tempo, cache=pa.RENDER_CACHE,
+                                                  target_sample_rate=self.sample_rate)
+        if stretched is None:
+            raise ValueError(f"{audiofile.filename} could not be stretched")
+
+        data, samplerate = pa.load_audio(stretched)
+        if not getattr(stretched, "prerendered", False):
+            data = pa.trim_to_loop(data, samplerate, tempo, 4)
+            data = pa.fade_out(data, 20, samplerate)
+
+        # The stretched stem carries the loudness of what is mixed: a prerendered stem is already normalized
+        gain = float(gain_staging.compute_layer_gains([stretched], [data])[0])
+
+        with self.cache_lock:
+            self.cache[cache_key] = (data, gain)
+            while len(self.cache) > PREVIEW_CACHE_LAYERS:
+                self.cache.popitem(last=False)
+        return data, gain
+
+    def start_layer(self, audiofile, tempo, generation):
+        instrument_type = audiofile.instrument_type
+        self.pending[instrument_type] = audiofile
+
+        def render():
+            try:
+                data, gain = self.render_layer(audiofile, tempo)
+            except Exception as e:
+                print(f"An error occurred while preparing {audiofile.filename}: {str(e)}")
+                with self.lock:
+                    if self.pending.get(instrument_type) is audiofile:
+                        del self.pending[instrument_type]
+                return
+
+            with self.lock:
+                if generation == self.generation and self.pending.get(instrument_type) is audiofile:
+                    del self.pending[instrument_type]
+                    layer = {"audiofile": audiofile, "data": data, "gain": gain}
+                    # A layer at a tempo that is not playing yet waits for the rest of the tempo change
+                    if tempo == self.tempo:
+                        self.layers[instrument_type] = layer
+                    elif tempo == self.render_tempo:
+                        self.staged[instrument_type] = layer
+
+        self.executor.submit(render)
+
+    def load_song(self, key=None, tempo=None):
+        """
+        Select a new set of stems with the same queries as generate_beats and start stretching them.
+        """
+        stems = generate_beats.select_song_stems(generate_beats.generate_attributes(key))
+
+        with self.lock:
+            self.generation += 1
+            self.tempo = float(tempo or self.tempo)
+            self.render_tempo = self.tempo
+            self.key = key or next((stem.key for stem in stems if stem.instrument_type != "drums"), None)
+            self.layers = {}
+            self.pending = {}
+            self.staged = {}
+            for stem in stems:
+                self.start_layer(stem, self.tempo, self.generation)
+
+    def swap_layer(self, instrument_type):
+        """
+        Replace the stem of one layer with another match. The other layers keep playing untouched.
+
+        Returns:
+        - bool: False if no other stem matches.
+        """
+        with self.lock:
+            sounds = {layer["audiofile"].duplicate_of or layer["audiofile"].id for layer in self.layers.values()}
+            key = self.key
+
+        attributes = [attribute for attribute in generate_beats.generate_attributes(key)
+                      if attribute["instrument_type"] == instrument_type]
+        if not attributes:
+            return False
+
+        stem = read.get_audiofile_by_instrument_tempo_key(attributes[0], exclude_sounds=sounds)
+        if stem is None:
+            return False
+
+        with self.lock:
+            self.start_layer(stem, self.render_tempo, self.generation)
+        return True
+
+    def set_tempo(self, tempo):
+        """
+        Stretch the current stems to a new tempo in the background. The old tempo keeps playing
+        until every layer is ready, and then all of them change together.
+
+        Layers swapped while the stems are being stretched are rendered at the new tempo and
+        join at the same moment, instead of being overwritten by the re-rendered old stem.
+        """
+        tempo = float(tempo)
+        with self.lock:
+            self.generation += 1
+            generation = self.generation
+            self.render_tempo = tempo
+            self.staged = {}
+            snapshot = dict(self.layers)
+
+            # Stems still being stretched for the old tempo are included, at the new one
+            stems = {instrument_type: layer["audiofile"] for instrument_type, layer in snapshot.items()}
+            stems.update(self.pending)
+            self.pending = {}
+
+        def restretch():
+            try:
+                rendered = dict(zip(stems, self.executor.map(lambda stem: self.render_layer(stem, tempo), stems.values())))
+            except Exception as e:
+                print(f"An error occurred while changing the tempo: {str(e)}")
+                with self.lock:
+                    if generation == self.generation:
+                        self.render_tempo = self.tempo
+                        self.staged = {}
+                return
+
+            with self.lock:
+                if generation != self.generation:
+                    return
+
+                # Layers that changed since the snapshot are newer than their re-rendered copies
+                layers = {instrument_type: layer for instrument_type, layer in self.layers.items()
+                          if layer is not snapshot.get(instrument_type)}
+                for instrument_type, (data, gain) in rendered.items():
+                    if instrument_type not in layers:
+                        layers[instrument_type] = {"audiofile": stems[instrument_type], "data": data, "gain": gain}
+
+                # Swaps that finished during the re-render are already at the new tempo
+                layers.update(self.staged)
+
+                self.staged = {}
+                self.tempo = tempo
+                self.layers = layers
+
+        threading.Thread(target=restretch, daemon=True).start()
+
+    def snapshot(self):
+        with self.lock:
+            return self.tempo, [(layer["data"], layer["gain"]) for layer in self.layers.values()]
+
+    def state(self):
+        with self.lock:
+            return {
+                "tempo": self.tempo,
+                "render_tempo": self.render_tempo,
+                "key": self.key,
+                "sample_rate": self.sample_rate,
+                "layers": {
+                    instrument_type: {"id": layer["audiofile"].id, "filename": layer["audiofile"].filename}
+                    for instrument_type, layer in self.layers.items()
+                },
+                "pending": sorted(self.pending),
+            }
+
+    def stream(self, write, block_frames=PREVIEW_BLOCK_FRAMES):
+        """
+        Mix the current layers block by block and pass each block to `write` as 16-bit PCM
+        bytes, paced to real time with PREVIEW_LEAD_SECONDS of lead, until `write` raises.
+        """
+        block = np.empty((block_frames, PREVIEW_CHANNELS), dtype=pa.MIX_DTYPE)
+        scratch = np.empty_like(block)
+
+        position = 0
+        stream_tempo = None
+        sent_frames = 0
+        started = time.monotonic()
+
+        while True:
+            tempo, layers = self.snapshot()
+
+            # Keep the place in the bar when the tempo changes
+            if stream_tempo is not None and tempo != stream_tempo:
+                position = int(position * stream_tempo / tempo)
+            stream_tempo = tempo
+
+            block.fill(0)
+            for data, gain in layers:
+                pa.add_looped_layer(data, position, block, gain, scratch)
+            gain_staging.limit_bus(block)
+
+            write((np.clip(block, -1.0, 1.0) * 32767).astype("<i2").tobytes())
+            position += block_frames
+            sent_frames += block_frames
+
+            ahead = sent_frames / self.sample_rate - (time.monotonic() - started)
+            if ahead > PREVIEW_LEAD_SECONDS:
+                time.sleep(ahead - PREVIEW_LEAD_SECONDS)
+
+class PreviewRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET  /stream           Endless WAV stream of the mix
+    GET  /state            Tempo, key and current layers as JSON
+    POST /song  {"key", "tempo"}   Select new stems
+    POST /swap  {"instrument_type"} Replace one layer
+    POST /tempo {"tempo"}          Change the tempo
+    """
+
+    def send_json(self, payload, status=200):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        mix = self.server.mix
+
+        if self.path == "/state":
+            self.send_json(mix.state())
+        elif self.path == "/stream":
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/wav")
+            self.send_header("Cache-Control", "no-store")
+            self.end_headers()
+
+            def write(data):
+                self.wfile.write(data)
+                self.wfile.flush()
+
+            try:
+                write(wav_stream_header(mix.sample_rate, PREVIEW_CHANNELS))
+                mix.stream(write)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        else:
+            self.send_json({"error": f"Unknown path: {self.path}"}, 404)
+
+    def do_POST(self):
+        mix = self.server.mix
+
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+
+            if self.path == "/song":
+                mix.load_song(body.get("key"), body.get("tempo"))
+            elif self.path == "/swap":
+                if not mix.swap_layer(body["instrument_type"]):
+                    self.send_json({"error": f"No other stem matches {body['instrument_type']}"}, 404)
+                    return
+            elif self.path == "/tempo":
+                mix.set_tempo(body["tempo"])
+            else:
+                self.send_json({"error": f"Unknown path: {self.path}"}, 404)
+                return
+        except Exception as e:
+            self.send_json({"error": f"An error occurred: {str(e)}"}, 400)
+            return
+
+        self.send_json(mix.state())
+
+def serve(host="127.0.0.1", port=8765, key=None, tempo=None):
+    """
+    Run the preview server until interrupted, starting with a song in `key` at `tempo`.
+    """
+    mix = PreviewMix()
+    mix.load_song(key, tempo)
+
+    server = ThreadingHTTPServer((host, port), PreviewRequestHandler)
+    server.daemon_threads = True
+    server.mix = mix
+
+    print(f"Preview at http://{host}:{port}/stream")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        mix.executor.shutdown(wait=False, cancel_futures=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stream a live preview of generated songs.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on.")
+    parser.add_argument("--key", default=None, help="Musical key of the first song. Random when omitted.")
+    parser.add_argument("--tempo", type=float, default=generate_beats.DEFAULT_TEMPO, help="Tempo of the first song.")
+    parser.add_argument("--sample-archive", default=None, metavar="DIRECTORY", help="Read stems from this packed sample archive (see sample_archive.py).")
+    args = parser.parse_args()
+
+    if args.sample_archive:
+        pa.set_sample_archive(args.sample_archive)
+
+    serve(args.host, args.port, args.key, args.tempo)
@@ -3,10 +3,27 @@ import pyrubberband as pyrb
 import numpy as np
 import os
 from audiofile import AudioFile
-import resampy
-from datetime import datetime
-import shutil
-import audio_analysis as aa
+import stem_store
+from concurrent.futures import ThreadPoolExecutor
+from render_cache import RenderCache, content_hash, buffer_hash
+import resampling
+import audio_buffers
+from audio_buffers import MEMORY_BUDGET
+import gain_staging
+import sample_archive
+import profiling
+
+TEMP_DIR = "./temp"
+KEEP_TEMP_FILES = False  # Write intermediate stems to TEMP_DIR for debugging
+RUBBERBAND_ARGS = None  # Extra rubberband command line options, e.g. {"--crisp": "5"}
+RENDER_CACHE = RenderCache()  # Set to None to disable caching of stretched and resampled stems
+STRETCH_WORKERS = os.cpu_count() or 1
+RESAMPLE_QUALITY = resampling.DEFAULT_QUALITY  # "fast", "balanced" or "best"
+SAMPLE_ARCHIVE = None  # A sample_archive.SampleArchive to read stems from instead of decoding their files
+PRERENDER_TEMPO_TOLERANCE = 1e-6  # BPM within which a prerendered stem counts as being at the target tempo
+MIX_DTYPE = np.dtype(audio_buffers.AUDIO_DTYPE)
+MIX_BLOCK_SIZE = 65536  # Frames per block when mixing and writing
+SONG_REPEATS = 3  # Times the mixed loop is repeated in the output file
 
 def multiplication_factor(a: float, b: float) -> float:
     """
@@ -26,235 +43,528 @@ def multiplication_factor(a: float, b: float) -> float:
     
     return b / a
 
-def reduce_rms(audio_data, db_amount):
+def set_sample_archive(archive_dir):
     """
-    Decrease the amplitude of the audio data to achieve -3dB RMS.
-    
+    Read stems packed in the archive at archive_dir (see sample_archive.py) instead of
+    decoding their files. None turns the archive off.
+    """
+    global SAMPLE_ARCHIVE
+    SAMPLE_ARCHIVE = None if archive_dir is None else sample_archive.SampleArchive(archive_dir)
+
+def load_audio(audiofile_obj):
+    """
+    Return the samples of an audio file, preferring a buffer already held in memory.
+
+    In-memory buffers are returned as read-only views, since they may be shared between songs.
+    Files are decoded as float32 and mono files stay mono.
+
     Args:
-        audio_data (numpy.array): Input audio data as a numpy array.
-        
+        audiofile_obj (AudioFile | DBAudioFile): The audio file to load.
+
     Returns:
-        numpy.array: Modified audio data with reduced RMS.
+        tuple: The audio data as a numpy array and its sample rate.
     """
-    
-    # Calculate the current RMS
-    current_rms = aa.root_mean_square(audio_data)
-    
-    # Calculate the desired RMS
-    desired_rms = current_rms * 10**(db_amount/20)
-    
-    # Calculate the scale factor
-    scale_factor = desired_rms / current_rms
-    
-    # Scale the audio data
-    adjusted_audio_data = audio_data * scale_factor
-    
-    return adjusted_audio_data
+    audio_data = getattr(audiofile_obj, "audio_data", None)
+    if audio_data is not None:
+        return audio_buffers.readonly(audio_data), audiofile_obj.sample_rate
+
+    # Packed stems are memory-mapped views, no decoding needed
+    if SAMPLE_ARCHIVE is not None and SAMPLE_ARCHIVE.is_current(audiofile_obj):
+        return SAMPLE_ARCHIVE.get_float(audiofile_obj.id)
+
+    return audio_buffers.read_audiofile(audiofile_obj)
+
+def get_samplerate(audiofile_obj):
+    """
+    Return the sample rate of an audio file without decoding it.
+    """
+    if getattr(audiofile_obj, "audio_data", None) is not None:
+        return audiofile_obj.sample_rate
+
+    if SAMPLE_ARCHIVE is not None and SAMPLE_ARCHIVE.is_current(audiofile_obj):
+        return SAMPLE_ARCHIVE.sample_rate(audiofile_obj.id)
+
+    return sf.info(audiofile_obj.absolute_path).samplerate
+
+def write_temp_file(audio_data, samplerate, filename):
+    """
+    Write an intermediate buffer to the temp directory for debugging.
+
+    Args:
+        audio_data (numpy.array): The audio data to write.
+        samplerate (int): The sample rate of the audio data.
+        filename (str): The file name without extension.
+
+    Returns:
+        str: The absolute path of the written file.
+    """
+    # Ensure the output directory exists
+    if not os.path.exists(TEMP_DIR):
+        os.makedirs(TEMP_DIR)
+
+    relative_path = f"{TEMP_DIR}/{filename}.wav"
+    sf.write(relative_path, audio_data, samplerate)
+
+    return os.path.abspath(relative_path)
+
+@profiling.profiled("stretch", lambda audiofile_obj, *args, **kwargs: audiofile_obj.absolute_path)
+def time_stretch_audiofile(audiofile_obj, current_tempo, target_tempo, keep_temp_file=None, cache=None, target_sample_rate=None):
+    """
+    Time-stretch an audio file to a new tempo, optionally resampling it in the same step.
+
+    Resampling here, before rubberband, means a stem goes through the DSP stage and the render
+    cache once, instead of being stretched and then resampled separately when mixed.
+
+    Args:
+        audiofile_obj (AudioFile | DBAudioFile): The audio file to stretch.
+        current_tempo (float): The tempo of the audio file.
+        target_tempo (float): The desired tempo.
+        keep_temp_file (bool, optional): Write the stretched buffer to the temp directory. Defaults to KEEP_TEMP_FILES.
+        cache (RenderCache, optional): Cache to look up and store the result in. Defaults to RENDER_CACHE; False disables caching.
+        target_sample_rate (int, optional): Sample rate of the stretched stem. Defaults to the source rate.
+
+    Returns:
+        AudioFile: The stretched audio file holding its samples in memory, or None if an error occurred.
+    """
+    if keep_temp_file is None:
+        keep_temp_file = KEEP_TEMP_FILES
+    if cache is None:
+        cache = RENDER_CACHE
 
-def time_stretch_audiofile(audiofile_obj, current_tempo, target_tempo):
-    output_dir = "./temp"
     factor = multiplication_factor(current_tempo,target_tempo)
 
     try:
-        y, sr = sf.read(audiofile_obj.absolute_path)
+        y_stretch = None
+        source_sr = get_samplerate(audiofile_obj)
+        sr = target_sample_rate or source_sr
 
-        y_stretch = pyrb.time_stretch(y, sr, factor)
+        if cache:
+            resample_params = {}
+            if sr != source_sr:
+                resample_params = {"target_sample_rate": sr, "resample_quality": RESAMPLE_QUALITY}
+            cache_key = cache.make_key(content_hash(audiofile_obj, SAMPLE_ARCHIVE), "time_stretch",
+                                       factor=round(factor, 9), sample_rate=source_sr, rbargs=RUBBERBAND_ARGS,
+                                       **resample_params)
+            y_stretch = cache.get(cache_key)
 
-        new_filename = f"{audiofile_obj.filename}_stretched"
+        if y_stretch is None:
+            # Decoded input, resampled copy and stretched output are alive at the same time
+            frames = getattr(audiofile_obj, "length_in_samples", None) or sf.info(audiofile_obj.absolute_path).frames
+            working_bytes = audio_buffers.estimate_nbytes(frames, 2) * (2 + 1 / factor) * (sr / source_sr)
+
+            with MEMORY_BUDGET.reserve(working_bytes):
+                y, source_sr = load_audio(audiofile_obj)
 
-        # Ensure the output directory exists
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
+                if sr != source_sr:
+                    y = resampling.resample(y, source_sr, sr, RESAMPLE_QUALITY)
 
-        relative_path = f"{output_dir}/{new_filename}.wav"
+                y_stretch = pyrb.time_stretch(y, sr, factor, rbargs=RUBBERBAND_ARGS)
+                y_stretch = y_stretch.astype(audio_buffers.AUDIO_DTYPE, copy=False)
 
-        sf.write(relative_path, y_stretch, sr)
+            if cache:
+                cache.put(cache_key, y_stretch)
 
-        current_directory = os.getcwd()
+        y_stretch = np.asarray(y_stretch, dtype=audio_buffers.AUDIO_DTYPE)
+
+        # Stretched stems may be shared by several songs; stages that modify samples must copy first
+        y_stretch.setflags(write=False)
+
+        new_filename = f"{audiofile_obj.filename}_stretched"
+
+        # The stretched stem lives in memory; it only points at a file on disk when a debug copy is kept
+        absolute_path = audiofile_obj.absolute_path
+        directory_path = audiofile_obj.directory_path
+
+        if keep_temp_file:
+            absolute_path = write_temp_file(y_stretch, sr, new_filename)
+            directory_path = os.path.dirname(absolute_path)
 
         return AudioFile(
                 filename=new_filename,
                 file_type="wav",
-                absolute_path=f"{current_directory}/{relative_path}",
-                directory_path=f"{current_directory}",
+                absolute_path=absolute_path,
+                directory_path=directory_path,
                 key=audiofile_obj.key,
                 tempo=target_tempo,
                 instrument_type=audiofile_obj.instrument_type,
                 length_in_samples=len(y_stretch),
                 sample_rate=sr,
+                loudness=getattr(audiofile_obj, "loudness", None),
+                audio_data=y_stretch,
+                source_id=getattr(audiofile_obj, "id", getattr(audiofile_obj, "source_id", None)),
+                source_path=getattr(audiofile_obj, "source_path", None) or audiofile_obj.absolute_path,
+                stretch_factor=factor,
+                segment_start=getattr(audiofile_obj, "segment_start", None),
+                segment_end=getattr(audiofile_obj, "segment_end", None),
             )
     except Exception as e:
         print(f"An error occurred: {str(e)}")
         return None
 
-def resample_audio(filepath, target_sample_rate, new_filename):
-    output_dir = "./temp"
-    
-    try:
-        # Read the audio file
-        y, sr = sf.read(filepath)
+def find_prerendered_stem(audiofile_obj, target_tempo, target_sample_rate=None):
+    """
+    Return the DBPrerenderedStem of an audio file at the target tempo, or None if there is none.
+
+    Args:
+        audiofile_obj (DBAudioFile): The audio file, with its prerendered_stems loaded.
+        target_tempo (float): The desired tempo, matched within PRERENDER_TEMPO_TOLERANCE.
+        target_sample_rate (int, optional): The desired sample rate. Any rate is accepted when omitted.
+    """
+    for stem in getattr(audiofile_obj, "prerendered_stems", None) or []:
+        if abs(stem.tempo - target_tempo) > PRERENDER_TEMPO_TOLERANCE:
+            continue
+        if target_sample_rate is not None and stem.sample_rate != target_sample_rate:
+            continue
+        return stem
+
+    return None
+
+def load_prerendered_stem(audiofile_obj, target_tempo, target_sample_rate=None):
+    """
+    Return the loop-ready render of an audio file at the target tempo, if one was made at ingest.
+
+    Args:
+        audiofile_obj (DBAudioFile): The audio file, with its prerendered_stems loaded.
+        target_tempo (float): The desired tempo.
+        target_sample_rate (int, optional): The desired sample rate. Any rate is accepted when omitted.
+
+    Returns:
+        AudioFile: The prerendered stem holding its samples in memory, or None if there is none.
+    """
+    stem = find_prerendered_stem(audiofile_obj, target_tempo, target_sample_rate)
+
+    if stem is not None and os.path.exists(stem.absolute_path):
+        y, sr = audio_buffers.read_audio(stem.absolute_path)
+        y.setflags(write=False)
+
+        return AudioFile(
+                filename=f"{audiofile_obj.filename}_prerendered",
+                file_type="wav",
+                absolute_path=stem.absolute_path,
+                directory_path=os.path.dirname(stem.absolute_path),
+                key=audiofile_obj.key,
+                tempo=target_tempo,
+                instrument_type=audiofile_obj.instrument_type,
+                length_in_samples=len(y),
+                sample_rate=sr,
+                loudness=stem.loudness,
+                audio_data=y,
+                source_id=audiofile_obj.id,
+                source_path=audiofile_obj.absolute_path,
+                stretch_factor=multiplication_factor(audiofile_obj.tempo, target_tempo),
+                prerendered=True,
+                segment_start=audiofile_obj.segment_start,
+                segment_end=audiofile_obj.segment_end,
+            )
+
+    return None
+
+def resample_audio(audio_data, samplerate, target_sample_rate, new_filename=None, keep_temp_file=None, cache=None, source_hash=None):
+    """
+    Resample an audio buffer to the target sample rate.
+
+    Args:
+        audio_data (numpy.array): The audio data to resample.
+        samplerate (int): The sample rate of the audio data.
+        target_sample_rate (int): The desired sample rate.
+        new_filename (str, optional): Name used for the debug copy in the temp directory.
+        keep_temp_file (bool, optional): Write the resampled buffer to the temp directory. Defaults to KEEP_TEMP_FILES.
+        cache (RenderCache, optional): Cache to look up and store the result in. Defaults to RENDER_CACHE; False disables caching.
+        source_hash (str, optional): Content hash of audio_data if already known; computed from the buffer otherwise.
 
+    Returns:
+        numpy.array: The resampled audio data, or None if an error occurred.
+    """
+    if keep_temp_file is None:
+        keep_temp_file = KEEP_TEMP_FILES
+    if cache is None:
+        cache = RENDER_CACHE
+
+    try:
         # If the sample rate is already the target, no need to resample
-        if sr == target_sample_rate:
-            return filepath
+        if samplerate == target_sample_rate:
+            return audio_data
 
-        # Resample the audio to the target sample rate
-        y_resampled = resampy.resample(y, sr, target_sample_rate)
+        y_resampled = None
 
-        # Ensure the output directory exists
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
+        if cache:
+            if source_hash is None:
+                source_hash = buffer_hash(audio_data)
+            cache_key = cache.make_key(source_hash, "resample", sample_rate=samplerate, target_sample_rate=target_sample_rate,
+                                       resample_quality=RESAMPLE_QUALITY)
+            y_resampled = cache.get(cache_key)
 
-        temp_path = f"{output_dir}/{new_filename}"
-        # Write the resampled audio to the output path
-        sf.write(temp_path, y_resampled, target_sample_rate)
+        if y_resampled is None:
+            # Resample the audio to the target sample rate
+            y_resampled = resampling.resample(audio_data, samplerate, target_sample_rate, RESAMPLE_QUALITY)
 
-        return temp_path
+            if cache:
+                cache.put(cache_key, y_resampled)
+
+        if keep_temp_file and new_filename:
+            write_temp_file(y_resampled, target_sample_rate, new_filename)
+
+        return y_resampled
     
     except Exception as e:
         print(f"An error occurred: {str(e)}")
         return None
 
-def stretch_audiofiles_to_tempo(audiofiles, target_tempo):
+def stretch_audiofiles_to_tempo(audiofiles, target_tempo, cache=None, max_workers=None, keep_failed=False, target_sample_rate=None):
+    """
+    Time-stretch audio files to a common tempo, several stems at a time.
+
+    Rubberband runs as an external process for each stem, so a thread pool keeps the cores busy
+    while the workers wait on it. A stem that fails to stretch is reported and left out; the
+    remaining stems are still returned.
+
+    Args:
+        audiofiles (list): AudioFile or DBAudioFile objects to stretch.
+        target_tempo (float): The tempo to stretch every stem to.
+        cache (RenderCache, optional): Cache passed through to time_stretch_audiofile.
+        max_workers (int, optional): Number of stems stretched concurrently. Defaults to STRETCH_WORKERS.
+        keep_failed (bool, optional): Put None in place of failed stems so the result lines up with the input.
+        target_sample_rate (int, optional): Resample every stem to this rate as part of the stretch.
+
+    Returns:
+        list: The stretched AudioFile objects in input order, without the stems that failed.
+    """
+    if max_workers is None:
+        max_workers = STRETCH_WORKERS
+
+    def stretch(audiofile):
+        # Stems rendered on the tempo grid at ingest need no DSP at all
+        prerendered = load_prerendered_stem(audiofile, target_tempo, target_sample_rate)
+        if prerendered is not None:
+            return prerendered
+
+        return time_stretch_audiofile(audiofile, audiofile.tempo, target_tempo, cache=cache,
+                                      target_sample_rate=target_sample_rate)
+
     stretched_files = []
 
-    
-    for audiofile in audiofiles:
-        try:
-            current_tempo = audiofile.tempo
-            stretched_file = time_stretch_audiofile(audiofile, current_tempo, target_tempo)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(audiofiles)))) as executor:
+        futures = [executor.submit(stretch, audiofile) for audiofile in audiofiles]
+
+        # Collect in submission order so layers keep their position in the song
+        for audiofile, future in zip(audiofiles, futures):
+            try:
+                stretched_file = future.result()
+            except Exception as e:
+                print(f"An error occurred while stretching {audiofile.filename}: {str(e)}")
+                stretched_file = None
+
+            if stretched_file is None:
+                print(f"Skipping {audiofile.filename}: it could not be stretched.")
+                if keep_failed:
+                    stretched_files.append(None)
+                continue
+
             stretched_files.append(stretched_file)
-        except Exception as e:
-            print(f"An error occurred: {str(e)}")
-            return None
 
     return stretched_files
 
-def mix_audio_files(audiofile_objects):
-    raw_audio_data_list, audio_paths, target_samplerate, target_tempo, target_length, key = prep_audio_files(audiofile_objects)
+def add_looped_layer(layer, position, out, gain=1.0, scratch=None):
+    """
+    Add a looping layer into a block of the mix, in place.
+
+    out[0] corresponds to frame `position` of the song. The layer repeats from the start of the
+    song, so the frame read for song frame n is n modulo the layer length.
+
+    Args:
+        layer (numpy.array): Audio data, mono (frames,) or multichannel (frames, channels).
+        position (int): Song frame at which the block starts.
+        out (numpy.array): Block of the mix to add into, shape (frames, channels).
+        gain (float | numpy.array, optional): Scalar gain or a per-frame gain with one entry per frame of out.
+        scratch (numpy.array, optional): Work buffer at least as large as out. Allocated when omitted.
+    """
+    layer_length = layer.shape[0]
+    if layer_length == 0:
+        return
+
+    if scratch is None:
+        scratch = np.empty_like(out)
+
+    total_frames = out.shape[0]
+    done = 0
+
+    while done < total_frames:
+        # Wrap around the layer instead of tiling it
+        offset = (position + done) % layer_length
+        frames = min(total_frames - done, layer_length - offset)
+
+        source = layer[offset:offset + frames]
+        if source.ndim == 1:
+            source = source[:, np.newaxis]
+
+        block_gain = gain if np.ndim(gain) == 0 else gain[done:done + frames, np.newaxis]
+
+        block = scratch[:frames]
+        np.multiply(source, block_gain, out=block)
+        out[done:done + frames] += block
+
+        done += frames
+
+def mix_layers(layers, target_length, gains=None, channels=2, block_size=None):
+    """
+    Sum audio layers into one float32 buffer of target_length frames.
+
+    Every layer is accumulated block by block into a single preallocated buffer. Layers shorter
+    than target_length wrap around by indexing modulo their length, and each layer's gain is
+    applied in the same pass, so no tiled or scaled copies of a layer are ever made. Mono layers
+    are spread across all output channels.
+
+    Args:
+        layers (list): Audio data arrays, mono (frames,) or multichannel (frames, channels).
+        target_length (int): Number of frames in the mix.
+        gains (list, optional): Linear gain per layer. Defaults to unity gain.
+        channels (int, optional): Number of output channels. Defaults to 2.
+        block_size (int, optional): Frames processed per step. Defaults to MIX_BLOCK_SIZE.
+
+    Returns:
+        numpy.array: The mixed float32 audio data with shape (target_length, channels).
+    """
+    if block_size is None:
+        block_size = MIX_BLOCK_SIZE
+    if gains is None:
+        gains = [1.0] * len(layers)
+
+    audio_data = np.zeros((target_length, channels), dtype=MIX_DTYPE)
+    scratch = np.empty((block_size, channels), dtype=MIX_DTYPE)
+
+    for start in range(0, target_length, block_size):
+        block = audio_data[start:start + block_size]
+
+        for layer, gain in zip(layers, gains):
+            add_looped_layer(layer, start, block, gain, scratch)
+
+    return audio_data
+
+def write_repeated(output_path, audio_data, samplerate, repeats=1, block_size=None):
+    """
+    Write audio data to a file several times back to back, streaming it in blocks.
+
+    Args:
+        output_path (str): Path of the file to write.
+        audio_data (numpy.array): The audio data to write.
+        samplerate (int): The sample rate of the audio data.
+        repeats (int, optional): Number of times the audio data is repeated. Defaults to 1.
+        block_size (int, optional): Frames written per call. Defaults to MIX_BLOCK_SIZE.
+    """
+    if block_size is None:
+        block_size = MIX_BLOCK_SIZE
+
+    channels = audio_data.shape[1] if audio_data.ndim > 1 else 1
+
+    with sf.SoundFile(output_path, mode="w", samplerate=samplerate, channels=channels) as f:
+        for _ in range(repeats):
+            for start in range(0, audio_data.shape[0], block_size):
+                f.write(audio_data[start:start + block_size])
+
+@profiling.profiled("mix", lambda audiofile_objects, *args, **kwargs: [audiofile.absolute_path for audiofile in audiofile_objects])
+def mix_audio_files(audiofile_objects, song_id=None, key=None):
+    raw_audio_data_list, audio_paths, target_samplerate, target_tempo, target_length, key, gains = prep_audio_files(audiofile_objects, key)
     
     columns = 2    # For stereo audio signal
 
-    # Initialize audio_data with the desired length and channels
-    audio_data = np.zeros((target_length, columns))
-    
-    # mix subsequent audio files
-    for new_data in raw_audio_data_list:
-        # Check if new_data is shorter than the target_length
-        if new_data.shape[0] < target_length:
-       
-            # Calculate the amount to repeat the new_data
-            difference = target_length - new_data.shape[0]
-          
-            repeat_times = (difference // new_data.shape[0]) + 1
-      
-            repeated_data = np.tile(new_data, (repeat_times, 1))
-      
-            # Trim the repeated_data to match the target_length
-            new_data = repeated_data[:target_length, :]
-
-        # If new_data is longer than the target_length, trim it
-        elif new_data.shape[0] > target_length:
-            new_data = new_data[:target_length, :]
-
-        # Perform element-wise addition
-        audio_data = audio_data + new_data
-
-    audio_data = np.tile(audio_data, (3, 1))
-    
-    now = datetime.now()
-    formatted_date = now.strftime('%Y%m%d%H%M%S')
+    song_name = stem_store.new_song_name(song_id)
     output_dir = "./output"
-    output_path = f"{output_dir}/mixed_audio_{formatted_date}_{key}_{target_tempo}.wav"
+    output_path = f"{output_dir}/mixed_audio_{song_name}_{key}_{target_tempo}.wav"
 
     # Ensure the output directory exists
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    try: 
-        sf.write(output_path, audio_data, target_samplerate)
-    except Exception as e:
-        print(f"An error occurred: {str(e)}")
+    with MEMORY_BUDGET.reserve(audio_buffers.estimate_nbytes(target_length, columns, MIX_DTYPE)):
+        audio_data = mix_layers(raw_audio_data_list, target_length, gains, channels=columns)
+        gain_staging.limit_bus(audio_data)
+
+        try: 
+            write_repeated(output_path, audio_data, target_samplerate, repeats=SONG_REPEATS)
+        except Exception as e:
+            print(f"An error occurred: {str(e)}")
+
+        del audio_data
     
-    copy_audio_files(audio_paths, formatted_date)
+    stem_store.write_song_manifest(song_name, output_path, audiofile_objects, gains, target_samplerate, target_tempo, key,
+                                   render={"mode": "loop", "repeats": SONG_REPEATS, "rubberband_args": RUBBERBAND_ARGS,
+                                           "resample_quality": RESAMPLE_QUALITY})
 
     return output_path
 
-def prep_audio_files(audiofile_objects):
+def song_key(audiofile_objects):
+    """
+    Return the musical key of a song: the key of its first stem that has one.
+
+    Drums and other unpitched stems are stored as "undetermined" and are passed over.
+    """
+    for audiofile in audiofile_objects:
+        key = getattr(audiofile, "key", None)
+        if key not in (None, "undetermined"):
+            return key
+    return "undetermined"
+
+def prep_audio_files(audiofile_objects, key=None):
+    """
+    Load, resample, trim and level the stems of a song for mixing.
+
+    Args:
+        audiofile_objects (list): Stretched AudioFile objects, any number of them.
+        key (str, optional): Musical key of the song, e.g. from its plan. Defaults to song_key().
+
+    Returns:
+        tuple: The audio data of each stem, their paths, the sample rate, the tempo, the
+        length of the longest stem in frames, the key and the gain of each stem.
+
+    Raises:
+        ValueError: If the list is empty or a stem could not be resampled.
+    """
     audio_paths = []
     raw_audio_data = []
 
     if not audiofile_objects:
         raise ValueError("The list of audio file objects is empty.")
 
-    try:
-        data, samplerate = sf.read(audiofile_objects[0].absolute_path)
-        target_samplerate = samplerate
-        target_tempo = audiofile_objects[0].tempo
-        
-        key = audiofile_objects[2].key
+    if key is None:
+        key = song_key(audiofile_objects)
 
-        audio_paths.append(audiofile_objects[0].absolute_path)
+    data, samplerate = load_audio(audiofile_objects[0])
+    target_samplerate = samplerate
+    target_tempo = audiofile_objects[0].tempo
 
-        # Ensure it's stereo (if it's not, make it stereo)
-        if len(data.shape) == 1:
-            data = np.stack((data, data), axis=-1)
+    audio_paths.append(audiofile_objects[0].absolute_path)
 
+    # Mono stems stay mono; the mixer spreads them across the stereo bus
+    if not getattr(audiofile_objects[0], "prerendered", False):
         data = trim_to_loop(data, target_samplerate, target_tempo, 4)
         data = fade_out(data, 20, target_samplerate)
-        raw_audio_data.append(data)
-        target_length = data.shape[0]
+    raw_audio_data.append(data)
+    target_length = data.shape[0]
 
-        # Resample and read audio files
-        for audiofile in audiofile_objects[1:]:
-            new_data, new_samplerate = sf.read(audiofile.absolute_path)
+    # Resample and read audio files
+    for audiofile in audiofile_objects[1:]:
+        new_data, new_samplerate = load_audio(audiofile)
 
-            if new_samplerate != target_samplerate:
-                resampled_path = resample_audio(audiofile.absolute_path, target_samplerate, f"{audiofile.filename}_resampled.wav")
-                new_data, new_samplerate = sf.read(resampled_path)
-                audio_paths.append(resampled_path)
-            else:
-                audio_paths.append(audiofile.absolute_path)
+        if new_samplerate != target_samplerate:
+            new_data = resample_audio(new_data, new_samplerate, target_samplerate, f"{audiofile.filename}_resampled")
+            if new_data is None:
+                raise ValueError(f"{audiofile.filename} could not be resampled to {target_samplerate} Hz.")
 
-            if len(new_data.shape) == 1:
-                new_data = np.stack((new_data, new_data), axis=-1)
+        audio_paths.append(audiofile.absolute_path)
 
+        if not getattr(audiofile, "prerendered", False) or new_samplerate != target_samplerate:
             new_data = trim_to_loop(new_data, target_samplerate, target_tempo, 4)
             new_data = fade_out(new_data, 20, target_samplerate)
 
-            if audiofile.instrument_type != "drums" or "percussion":
-                new_data = reduce_rms(new_data, -8)
-        
-            if audiofile.instrument_type == "percussion":
-                new_data = reduce_rms(new_data, -10)
-
-            raw_audio_data.append(new_data)
+        raw_audio_data.append(new_data)
 
-            if new_data.shape[0] > target_length:
-                target_length = new_data.shape[0]
+        if new_data.shape[0] > target_length:
+            target_length = new_data.shape[0]
 
-        return raw_audio_data, audio_paths, target_samplerate, target_tempo, target_length, key
-    
-    except Exception as e:
-        print(f"An error occurred: {str(e)}")
-        return None
+    # Levels come from the loudness stored at ingest and are applied by the mixer in the same pass that sums the layers
+    gains = gain_staging.compute_layer_gains(audiofile_objects, raw_audio_data)
 
-def copy_audio_files(audio_paths, new_directory_name):
-    output_dir = f"./output/{new_directory_name}"
-    
-    # Ensure the output directory exists
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    
-    try:
-        # Copy each audio file to the output directory
-        for path in audio_paths:
-            if os.path.exists(path):
-                shutil.copy(path, output_dir)
-            else:
-                print(f"File {path} does not exist.")
-    except Exception as e:
-        print(f"An error occurred: {str(e)}")
+    return raw_audio_data, audio_paths, target_samplerate, target_tempo, target_length, key, gains
 
 def fade_out(audio_data, fade_duration_ms, samplerate):
     """
@@ -292,6 +602,10 @@ def fade_out(audio_data, fade_duration_ms, samplerate):
     if audio_data.ndim > 1:
         fade = fade[:, np.newaxis]
 
+    # Never modify a shared read-only buffer in place
+    if not audio_data.flags.writeable:
+        audio_data = audio_data.copy()
+
     # Apply the fade to the end of the audio data
     audio_data[-fade_samples:] *= fade
     
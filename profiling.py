@@ -0,0 +1,428 @@
+import atexit
+import functools
+import glob
+import heapq
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+import numpy as np
+import soundfile as sf
+
+# Profiling is off unless enable() is called or PROFILE_DIR is set in the environment. The
+# environment variable also reaches the analysis processes started by analysis_sandbox.
+PROFILE_DIR = os.environ.get("PROFILE_DIR")
+if PROFILE_DIR is not None:
+    # The first process that profiles owns the run and merges the summaries of its children
+    os.environ.setdefault("PROFILE_OWNER", str(os.getpid()))
+SAMPLE_INTERVAL = 0.005  # Seconds between stack samples of the threads inside a profiled call
+KEEP_PERCENTILE = 95.0  # Calls slower than this percentile of their kind keep their full profile
+MIN_CALLS = 20  # Calls of a kind timed before the percentile is trusted; until then MIN_SECONDS decides
+MIN_SECONDS = 1.0  # Calls faster than this never keep their profile
+DURATION_WINDOW = 2000  # Most recent durations per kind that the percentile is taken over
+THRESHOLD_REFRESH = 50  # Calls of a kind between recomputations of its keep threshold
+MAX_STACK_DEPTH = 64
+TOP_STACKS = 50  # Collapsed stacks saved per kept profile
+TOP_FUNCTIONS = 25
+SUMMARY_SIZE = 10  # Slowest calls listed in the report at exit
+
+class CallProfile:
+    """Samples and stage marks of one profiled call."""
+
+    def __init__(self, kind, target):
+        self.kind = kind
+        self.target = target
+        self.started = time.perf_counter()
+        self.stages = []  # (stage, seconds since the call started)
+        self.stacks = Counter()
+        self.sample_count = 0
+
+    def stage_seconds(self, ended):
+        """Return the time spent in each stage reported with mark_stage()."""
+        seconds = {}
+        marks = self.stages + [(None, ended - self.started)]
+        for (stage, start), (_, end) in zip(marks, marks[1:]):
+            seconds[stage] = seconds.get(stage, 0.0) + end - start
+        return seconds
+
+    def function_shares(self):
+        """Fraction of the samples in which each function was on the stack."""
+        functions = Counter()
+        for stack, count in self.stacks.items():
+            for function in set(stack):
+                functions[function] += count
+        total = max(self.sample_count, 1)
+        return {function: count / total for function, count in functions.most_common(TOP_FUNCTIONS)}
+
+class SamplingProfiler:
+    """
+    Sample the stacks of threads inside profiled calls from a background thread.
+
+    Only threads with an active call are looked at, and nothing is traced between samples, so
+    the profiled code runs at full speed.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active = {}  # Thread id -> stack of CallProfile, innermost last
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+
+            # Samples are added under the lock, so a call stops changing once pop() returns it
+            with self.lock:
+                if not self.active:
+                    continue
+
+                frames = sys._current_frames()
+                for thread_id, stack in self.active.items():
+                    frame = frames.get(thread_id)
+                    if stack and frame is not None:
+                        call = stack[-1]
+                        call.stacks[collapse(frame)] += 1
+                        call.sample_count += 1
+
+    def push(self, call):
+        with self.lock:
+            self.active.setdefault(threading.get_ident(), []).append(call)
+
+    def pop(self):
+        with self.lock:
+            stack = self.active.get(threading.get_ident())
+            call = stack.pop()
+            if not stack:
+                del self.active[threading.get_ident()]
+            return call
+
+    def current(self):
+        with self.lock:
+            stack = self.active.get(threading.get_ident())
+            return stack[-1] if stack else None
+
+def collapse(frame):
+    """Return a stack as a tuple of "module:function" names, outermost first."""
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{os.path.splitext(os.path.basename(code.co_filename))[0]}:{code.co_name}")
+        frame = frame.f_back
+    return tuple(reversed(names))
+
+def header_metadata(target):
+    """Return the header facts of an audio file, or None if `target` is not one."""
+    if not isinstance(target, str) or not os.path.isfile(target):
+        return None
+    try:
+        info = sf.info(target)
+    except Exception as e:
+        return {"error": str(e)}
+    return {
+        "format": info.format,
+        "subtype": info.subtype,
+        "sample_rate": info.samplerate,
+        "channels": info.channels,
+        "frames": info.frames,
+        "duration": info.duration,
+        "size": os.path.getsize(target),
+    }
+
+PROFILER = SamplingProfiler()
+durations = {}  # Kind -> deque of the durations of its most recent calls in this process
+call_counts = Counter()  # Kind -> calls finished in this process
+longest = {}  # Kind -> duration of its slowest call in this process
+thresholds = {}  # Kind -> duration above which a call keeps its profile
+slowest = []  # Heap of (seconds, sequence, kind, target, profile path, note) of the slowest calls
+results_lock = threading.Lock()
+profile_count = 0
+call_sequence = itertools.count()  # Breaks ties between equally slow calls in the heap
+
+def enabled():
+    return PROFILE_DIR is not None
+
+def is_owner():
+    """Whether this process started the profiled run and merges the summaries at exit."""
+    return os.environ.get("PROFILE_OWNER") == str(os.getpid())
+
+def enable(directory, percentile=None, min_seconds=None):
+    """
+    Start profiling calls decorated with profiled(), keeping profiles in `directory`.
+
+    Parameters:
+    - directory (str): Directory for kept profiles and the summary report.
+    - percentile (float, optional): Latency percentile above which profiles are kept.
+    - min_seconds (float, optional): Calls faster than this never keep their profile.
+    """
+    global PROFILE_DIR, KEEP_PERCENTILE, MIN_SECONDS
+    PROFILE_DIR = directory
+    if percentile is not None:
+        KEEP_PERCENTILE = percentile
+    if min_seconds is not None:
+        MIN_SECONDS = min_seconds
+
+    # Processes started from here on profile too, and leave their summaries to this one
+    os.environ["PROFILE_DIR"] = directory
+    os.environ["PROFILE_OWNER"] = str(os.getpid())
+    os.makedirs(directory, exist_ok=True)
+    PROFILER.start()
+
+def mark_stage(stage):
+    """Record that the innermost profiled call of this thread entered a new stage."""
+    call = PROFILER.current() if enabled() else None
+    if call is not None:
+        call.stages.append((stage, time.perf_counter() - call.started))
+
+def stage_reporter(report_stage):
+    """Wrap a report_stage callback so that stage changes are also marked in the profile."""
+    if not enabled():
+        return report_stage
+
+    def report(stage):
+        mark_stage(stage)
+        report_stage(stage)
+
+    return report
+
+def should_keep(kind, seconds):
+    """
+    Decide whether a call that just finished keeps its profile. Called with results_lock held,
+    after the call was added to durations.
+
+    The threshold is only recomputed every THRESHOLD_REFRESH calls, over at most DURATION_WINDOW
+    durations, so finishing a call stays cheap however long the run.
+    """
+    if seconds < MIN_SECONDS:
+        return False
+    if call_counts[kind] < MIN_CALLS:
+        return True
+    if kind not in thresholds or call_counts[kind] % THRESHOLD_REFRESH == 0:
+        thresholds[kind] = float(np.percentile(durations[kind], KEEP_PERCENTILE))
+    return seconds >= thresholds[kind]
+
+def record(kind, target, seconds, details, keep=None, note=None):
+    """
+    Count a finished call and save its profile if it is kept.
+
+    Parameters:
+    - kind (str): Name of the calls, e.g. "analyze".
+    - target: The file or files the call worked on.
+    - seconds (float): Duration of the call.
+    - details (callable): Returns the profile fields beyond kind, target, seconds and header.
+      Only called when the profile is kept.
+    - keep (bool, optional): Keep the profile regardless of should_keep().
+    - note (str, optional): Shown next to the call in the summary, e.g. why it was killed.
+    """
+    global profile_count
+
+    with results_lock:
+        durations.setdefault(kind, deque(maxlen=DURATION_WINDOW)).append(seconds)
+        call_counts[kind] += 1
+        longest[kind] = max(longest.get(kind, 0.0), seconds)
+
+        if keep is None:
+            keep = should_keep(kind, seconds)
+        if keep:
+            profile_count += 1
+            path = os.path.join(PROFILE_DIR, f"{kind}-{os.getpid()}-{profile_count}.json")
+        else:
+            path = None
+
+        entry = (seconds, next(call_sequence), kind, str(target), path, note)
+        if len(slowest) < SUMMARY_SIZE:
+            heapq.heappush(slowest, entry)
+        else:
+            heapq.heappushpop(slowest, entry)
+
+    if not keep:
+        return
+
+    report = {
+        "kind": kind,
+        "target": target if isinstance(target, (str, list)) else str(target),
+        "seconds": seconds,
+        "header": header_metadata(target),
+        **details(),
+    }
+
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+    except Exception as e:
+        print(f"An error occurred while saving the profile of {target}: {str(e)}")
+
+def finish(call):
+    """
+    Record a profiled call that has been popped. Runs in the wrapper's finally block, so it
+    never raises: that would replace the call's return value or its exception.
+    """
+    ended = time.perf_counter()
+
+    try:
+        record(call.kind, call.target, ended - call.started, lambda: {
+            "stages": call.stage_seconds(ended),
+            "samples": call.sample_count,
+            "sample_interval": PROFILER.interval,
+            "functions": call.function_shares(),
+            "stacks": {";".join(stack): count for stack, count in call.stacks.most_common(TOP_STACKS)},
+        })
+    except Exception as e:
+        print(f"An error occurred while recording the profile of {call.target}: {str(e)}")
+
+def record_killed(kind, target, seconds, stage, reason):
+    """
+    Record a call whose process was killed before it could finish, e.g. by the analysis_sandbox
+    timeout or memory limit. The killed process never reports such calls itself, so the
+    supervisor does. The profile is always kept, with the stage the call was in.
+    """
+    if not enabled():
+        return
+
+    record(kind, target, seconds, lambda: {"killed": reason, "stages": {stage: seconds}}, keep=True, note=reason)
+
+def profiled(kind, describe=None):
+    """
+    Decorator that profiles every call of a function while profiling is enabled.
+
+    Parameters:
+    - kind (str): Name of the calls in reports, e.g. "analyze" or "stretch".
+    - describe (callable, optional): Called with the function's arguments to name the file or
+      files the call worked on. Defaults to the first argument.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+
+            PROFILER.start()
+            try:
+                target = describe(*args, **kwargs) if describe else (args[0] if args else None)
+            except Exception:
+                target = None
+
+            call = CallProfile(kind, target)
+            PROFILER.push(call)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                PROFILER.pop()
+                finish(call)
+
+        return wrapper
+    return decorator
+
+def kind_statistics(seconds, calls, slowest_seconds):
+    return {
+        "calls": calls,
+        "p50": float(np.percentile(seconds, 50)),
+        "p95": float(np.percentile(seconds, 95)),
+        "p99": float(np.percentile(seconds, 99)),
+        "max": slowest_seconds,
+    }
+
+def summary():
+    """
+    Return the slowest calls of this process and the latency percentiles of each kind, taken
+    over the most recent DURATION_WINDOW calls.
+    """
+    with results_lock:
+        return {
+            "pid": os.getpid(),
+            "kinds": {
+                kind: kind_statistics(seconds, call_counts[kind], longest[kind])
+                for kind, seconds in durations.items()
+            },
+            "durations": {kind: list(seconds) for kind, seconds in durations.items()},
+            "slowest": [
+                {"seconds": seconds, "kind": kind, "target": target, "profile": path, "note": note}
+                for seconds, sequence, kind, target, path, note in sorted(slowest, reverse=True)
+            ],
+        }
+
+def merge_summaries(directory=None, owner=None):
+    """
+    Combine the summaries written by every process of a run into one report.
+
+    Parameters:
+    - directory (str, optional): Directory of the summaries. Defaults to PROFILE_DIR.
+    - owner (str, optional): Process id of the process that started the run. Defaults to PROFILE_OWNER.
+
+    Returns:
+    - dict: The merged report, also written to summary-<owner>.json.
+    """
+    directory = directory or PROFILE_DIR
+    owner = owner or os.environ.get("PROFILE_OWNER")
+
+    all_durations = {}
+    calls = Counter()
+    slowest_seconds = {}
+    entries = []
+
+    for path in sorted(glob.glob(os.path.join(directory, f"summary-{owner}-*.json"))):
+        try:
+            with open(path) as f:
+                report = json.load(f)
+        except Exception as e:
+            print(f"An error occurred while reading {path}: {str(e)}")
+            continue
+
+        for kind, seconds in report.get("durations", {}).items():
+            all_durations.setdefault(kind, []).extend(seconds)
+        for kind, statistics in report.get("kinds", {}).items():
+            calls[kind] += statistics["calls"]
+            slowest_seconds[kind] = max(slowest_seconds.get(kind, 0.0), statistics["max"])
+        entries.extend(report.get("slowest", []))
+
+    merged = {
+        "owner": owner,
+        "kinds": {
+            kind: kind_statistics(seconds, calls[kind], slowest_seconds[kind])
+            for kind, seconds in all_durations.items() if seconds
+        },
+        "slowest": sorted(entries, key=lambda entry: entry["seconds"], reverse=True)[:SUMMARY_SIZE],
+    }
+
+    try:
+        with open(os.path.join(directory, f"summary-{owner}.json"), "w") as f:
+            json.dump(merged, f, indent=2)
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+
+    return merged
+
+@atexit.register
+def report_at_exit():
+    if not enabled():
+        return
+
+    if durations:
+        try:
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            with open(os.path.join(PROFILE_DIR, f"summary-{os.environ.get('PROFILE_OWNER')}-{os.getpid()}.json"), "w") as f:
+                json.dump(summary(), f, indent=2)
+        except Exception as e:
+            print(f"An error occurred: {str(e)}")
+
+    # Child processes have exited by now; the process that started the run reports for all of them
+    if not is_owner():
+        return
+
+    report = merge_summaries()
+    if not report["slowest"]:
+        return
+
+    print("Slowest calls:")
+    for entry in report["slowest"]:
+        note = f"  ({entry['note']})" if entry.get("note") else ""
+        print(f"  {entry['seconds']:8.2f} s  {entry['kind']:<8} {entry['target']}{note}")
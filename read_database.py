@@ -35,13 +35,14 @@ def get_total_audio_files_count():
         session.close()
 
 
-def get_audiofile_by_instrument_tempo_key(attribute_dict):
+def get_audiofile_by_instrument_tempo_key(attribute_dict, exclude_sounds=None):
     """
     Retrieve a DBAudioFile with a specified instrument_type, within a specified tempo range, and within a specified key range.
 
     Parameters:
     Parameters:
     - attribute_dict (dict): A dictionary containing 'instrument_type', 'tempo_min', 'tempo_max', 'key_rang'.
+    - exclude_sounds (set, optional): Ids of original audio files whose copies must not be returned.
 
     Returns:
     - DBAudioFile: The retrieved DBAudioFile instance, or None if no matching instance was found.
@@ -57,14 +58,18 @@ def get_audiofile_by_instrument_tempo_key(attribute_dict):
     session = Session()
     try:
         # Query the database for a DBAudioFile with the specified instrument_type, tempo range, and key range
-        audio_file = (
+        query = (
             session.query(DBAudioFile)
             .filter_by(instrument_type=attribute_dict["instrument_type"])
             .filter(DBAudioFile.tempo.between(attribute_dict["tempo_min"], attribute_dict["tempo_max"]))
             .filter(DBAudioFile.key.in_(attribute_dict["key_range"]))
-            .order_by(func.random())
-            .first()
         )
+
+        if exclude_sounds:
+            # Originals and their acoustic duplicates share the id of the original
+            query = query.filter(func.coalesce(DBAudioFile.duplicate_of, DBAudioFile.id).notin_(exclude_sounds))
+
+        audio_file = query.order_by(func.random()).first()
         return audio_file
     except Exception as e:
         print(f"An error occurred: {str(e)}")
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import numpy as np
+import utilities
+
+DEFAULT_CACHE_DIR = "./cache/render"
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3  # 2 GiB
+
+def buffer_hash(audio_data):
+    """
+    Compute the SHA-256 digest of an audio buffer's samples, shape and dtype.
+
+    Args:
+        audio_data (numpy.array): The audio data to hash.
+
+    Returns:
+        str: Hex digest of the buffer.
+    """
+    audio_data = np.ascontiguousarray(audio_data)
+    sha = hashlib.sha256()
+    sha.update(f"{audio_data.dtype.str}{audio_data.shape}".encode())
+    sha.update(audio_data.reshape(-1).view(np.uint8))
+    return sha.hexdigest()
+
+def content_hash(audiofile_obj, archive=None):
+    """
+    Identify the audio behind an AudioFile or DBAudioFile by content rather than by name.
+
+    Args:
+        audiofile_obj (AudioFile | DBAudioFile): The audio file to identify.
+        archive (SampleArchive, optional): Packed sample archive the audio is read from.
+
+    Returns:
+        str: Hex digest of the in-memory buffer if present, the hash stored in the archive
+        if the file is packed in it, otherwise of the file on disk, qualified by the frame
+        span for segments of a longer file.
+    """
+    audio_data = getattr(audiofile_obj, "audio_data", None)
+    if audio_data is not None:
+        return buffer_hash(audio_data)
+
+    # Packed stems carry the hash of their samples, so the source file is never read
+    if archive is not None and archive.is_current(audiofile_obj):
+        stored_hash = archive.content_hash(audiofile_obj.id)
+        if stored_hash is not None:
+            return stored_hash
+
+    digest = utilities.hash_file(audiofile_obj.absolute_path)
+
+    segment_start = getattr(audiofile_obj, "segment_start", None)
+    if segment_start is not None:
+        digest = f"{digest}:{segment_start}-{getattr(audiofile_obj, 'segment_end', None)}"
+
+    return digest
+
+class RenderCache:
+    """
+    On-disk cache of rendered stems keyed by source content and render parameters.
+
+    Entries are stored as .npy files written atomically, so concurrent runs never observe a
+    partially written stem. When the cache grows past max_bytes the least recently used
+    entries are evicted.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._total_bytes = None  # Running size of the cache, counted on the first write
+
+    @staticmethod
+    def make_key(source_hash, operation, **params):
+        """
+        Build a cache key from the source content hash, the operation and its parameters.
+
+        Args:
+            source_hash (str): Content hash of the input audio.
+            operation (str): Name of the render step, e.g. "time_stretch".
+            **params: Every parameter that changes the rendered output.
+
+        Returns:
+            str: Hex digest identifying the rendered output.
+        """
+        payload = json.dumps({"source": source_hash, "operation": operation, **params}, sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.npy")
+
+    def get(self, key):
+        """
+        Return the cached buffer for a key, or None on a miss.
+        """
+        path = self._entry_path(key)
+
+        try:
+            audio_data = np.load(path)
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+
+        # Refresh the access time used for LRU eviction
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return audio_data
+
+    def put(self, key, audio_data):
+        """
+        Store a buffer under a key, then evict old entries if the cache is over its size cap.
+
+        A cache that cannot be written to is reported and otherwise ignored, so the render is
+        still used; it is just not cached.
+
+        Returns:
+            bool: Whether the buffer was stored.
+        """
+        path = self._entry_path(key)
+        directory = os.path.dirname(path)
+
+        try:
+            os.makedirs(directory, exist_ok=True)
+
+            # Write to a unique temporary file and rename it into place
+            fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    np.save(f, audio_data)
+                os.replace(temp_path, path)
+            except Exception:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+
+            size = os.path.getsize(path)
+        except OSError as e:
+            print(f"An error occurred while caching a render in {self.cache_dir}: {str(e)}")
+            return False
+
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._scan()[1]
+            else:
+                self._total_bytes += size
+            over_limit = self.max_bytes is not None and self._total_bytes > self.max_bytes
+
+        # The cache tree is only walked when this write pushed the total past the limit
+        if over_limit:
+            self.evict()
+
+        return True
+
+    def _scan(self):
+        """
+        Return the cache entries as (mtime, size, path) and their total size.
+        """
+        entries = []
+        total_bytes = 0
+
+        for root, dirs, files in os.walk(self.cache_dir):
+            for file in files:
+                if not file.endswith(".npy"):
+                    continue
+                path = os.path.join(root, file)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_bytes += stat.st_size
+
+        return entries, total_bytes
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache fits within max_bytes.
+        """
+        if self.max_bytes is None:
+            return
+
+        with self._lock:
+            # Other processes share the directory, so the running total is corrected from disk here
+            entries, total_bytes = self._scan()
+
+            if total_bytes > self.max_bytes:
+                entries.sort()
+                for mtime, size, path in entries:
+                    if total_bytes <= self.max_bytes:
+                        break
+                    try:
+                        os.remove(path)
+                        total_bytes -= size
+                    except FileNotFoundError:
+                        total_bytes -= size
+                    except OSError as e:
+                        print(f"An error occurred while evicting {path}: {str(e)}")
+
+            self._total_bytes = total_bytes
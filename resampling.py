@@ -0,0 +1,80 @@
+from fractions import Fraction
+from functools import lru_cache
+import numpy as np
+from scipy import signal
+
+# Filter half-width in input periods and Kaiser window beta for each quality preset.
+# Wider filters and larger betas give a steeper, cleaner anti-aliasing filter at a higher cost.
+QUALITY_PRESETS = {
+    "fast": {"half_width": 8, "beta": 5.0},
+    "balanced": {"half_width": 16, "beta": 8.0},
+    "best": {"half_width": 32, "beta": 12.0},
+}
+DEFAULT_QUALITY = "balanced"
+MAX_FACTOR = 10000  # Largest up or down factor used exactly; the filter has 2 * half_width taps per unit of it
+
+def rational_ratio(source_rate, target_rate, max_factor=MAX_FACTOR):
+    """
+    Express target_rate / source_rate as a reduced fraction up / down.
+
+    The ratio is exact unless up or down would exceed max_factor, in which case the closest
+    fraction within it is used and the rate actually produced is reported.
+
+    Example: 44100 Hz to 48000 Hz gives (160, 147).
+    """
+    ratio = Fraction(int(target_rate), int(source_rate))
+
+    if max(ratio.numerator, ratio.denominator) > max_factor:
+        exact = ratio
+        ratio = ratio.limit_denominator(max_factor)
+        if ratio.numerator > max_factor:
+            ratio = Fraction(max_factor, max(1, round(max_factor / exact)))
+        print(f"Resampling {source_rate} Hz to {target_rate} Hz approximately, as {ratio.numerator}/{ratio.denominator}: "
+              f"the output is {float(source_rate * ratio):.2f} Hz.")
+
+    return ratio.numerator, ratio.denominator
+
+@lru_cache(maxsize=64)
+def polyphase_filter(source_rate, target_rate, quality=DEFAULT_QUALITY):
+    """
+    Design, once per (source rate, target rate, quality), the low-pass FIR filter for a rational resampling ratio.
+
+    Returns:
+    - tuple: up factor, down factor and the read-only filter taps.
+    """
+    if quality not in QUALITY_PRESETS:
+        raise ValueError(f"Invalid quality: {quality}. Expected one of: {', '.join(QUALITY_PRESETS)}.")
+
+    preset = QUALITY_PRESETS[quality]
+    up, down = rational_ratio(source_rate, target_rate)
+    max_rate = max(up, down)
+
+    half_len = preset["half_width"] * max_rate
+    taps = signal.firwin(2 * half_len + 1, 1.0 / max_rate, window=("kaiser", preset["beta"]))
+    taps.setflags(write=False)
+
+    return up, down, taps
+
+def resample(audio_data, source_rate, target_rate, quality=DEFAULT_QUALITY):
+    """
+    Resample audio data along its first axis with a cached polyphase filter.
+
+    Parameters:
+    - audio_data (numpy.array): Mono (frames,) or multichannel (frames, channels) audio data.
+    - source_rate (int): Sample rate of audio_data.
+    - target_rate (int): Desired sample rate.
+    - quality (str, optional): One of QUALITY_PRESETS. Defaults to DEFAULT_QUALITY.
+
+    Returns:
+    - numpy.array: The resampled audio data, in the same floating point dtype as the input.
+    """
+    if source_rate == target_rate:
+        return audio_data
+
+    up, down, taps = polyphase_filter(int(source_rate), int(target_rate), quality)
+    resampled = signal.resample_poly(audio_data, up, down, axis=0, window=taps)
+
+    if np.issubdtype(audio_data.dtype, np.floating):
+        resampled = resampled.astype(audio_data.dtype, copy=False)
+
+    return resampled
@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import numpy as np
+import soundfile as sf
+from render_cache import buffer_hash
+
+DEFAULT_ARCHIVE_DIR = "./archive"
+SAMPLES_FILENAME = "samples.bin"
+INDEX_FILENAME = "index.npy"
+META_FILENAME = "meta.json"
+
+ARCHIVE_DTYPES = ["float32", "int16"]
+
+INDEX_DTYPE = np.dtype([
+    ("id", np.int64),
+    ("offset", np.int64),  # In samples (not frames) from the start of the data file
+    ("frames", np.int64),
+    ("channels", np.int32),
+    ("sample_rate", np.int32),
+    ("hash", "S64"),  # render_cache.buffer_hash() of the packed samples; empty in archives packed before it was stored
+    ("mtime_ns", np.int64),  # Modification time and size of the source file when it was packed; 0 in older archives
+    ("size", np.int64),
+])
+
+class SampleArchive:
+    """
+    Read-only access to a packed archive of decoded stems.
+
+    All stems live back to back in one memory-mapped file, so get() returns a NumPy view
+    into the page cache instead of decoding a WAV file. An index maps each DBAudioFile.id to
+    the offset, length and channel count of its samples, and to the modification time and size
+    of the file they were decoded from. A row keeps its id when watch_ingest re-analyses a
+    changed file, so callers check is_current() before reading a stem.
+    """
+
+    def __init__(self, archive_dir=DEFAULT_ARCHIVE_DIR):
+        self.archive_dir = archive_dir
+
+        with open(os.path.join(archive_dir, META_FILENAME)) as f:
+            self.dtype = np.dtype(json.load(f)["dtype"])
+
+        self.index = load_index(os.path.join(archive_dir, INDEX_FILENAME))
+        self._positions = {int(audiofile_id): position for position, audiofile_id in enumerate(self.index["id"])}
+
+        samples_path = os.path.join(archive_dir, SAMPLES_FILENAME)
+        if os.path.getsize(samples_path) > 0:
+            self.samples = np.memmap(samples_path, dtype=self.dtype, mode="r")
+        else:
+            self.samples = np.empty(0, dtype=self.dtype)
+
+    def __contains__(self, audiofile_id):
+        return audiofile_id in self._positions
+
+    def __len__(self):
+        return len(self._positions)
+
+    def _entry(self, audiofile_id):
+        position = self._positions.get(audiofile_id)
+        if position is None:
+            return None
+        return self.index[position]
+
+    def is_current(self, audiofile_obj):
+        """
+        Whether the archive holds the samples of an audio file as the file is now, i.e. the file
+        has not been modified since it was packed. Entries of archives packed before the file
+        stat was stored never are; packing again refreshes them.
+        """
+        entry = self._entry(getattr(audiofile_obj, "id", None))
+        if entry is None:
+            return False
+
+        try:
+            stat = os.stat(audiofile_obj.absolute_path)
+        except OSError:
+            # Nothing newer exists than what was packed
+            return True
+
+        return int(entry["mtime_ns"]) == stat.st_mtime_ns and int(entry["size"]) == stat.st_size
+
+    def sample_rate(self, audiofile_id):
+        entry = self._entry(audiofile_id)
+        return None if entry is None else int(entry["sample_rate"])
+
+    def content_hash(self, audiofile_id):
+        """
+        Return the hash of a stem's packed samples, stored when it was packed, so that render
+        cache keys need not read the source file. None if the id is not in the archive or the
+        archive predates stored hashes.
+        """
+        entry = self._entry(audiofile_id)
+        if entry is None or not entry["hash"]:
+            return None
+        return entry["hash"].decode("ascii")
+
+    def get(self, audiofile_id):
+        """
+        Return a zero-copy, read-only view of a stem's samples in the archive dtype.
+
+        Returns:
+            tuple: The samples, shaped (frames,) for mono or (frames, channels), and the sample rate.
+            None if the id is not in the archive.
+        """
+        entry = self._entry(audiofile_id)
+        if entry is None:
+            return None
+
+        offset = int(entry["offset"])
+        frames = int(entry["frames"])
+        channels = int(entry["channels"])
+
+        view = self.samples[offset:offset + frames * channels]
+        if channels > 1:
+            view = view.reshape(frames, channels)
+
+        return view, int(entry["sample_rate"])
+
+    def get_float(self, audiofile_id):
+        """
+        Return a stem's samples as float32.
+
+        The view is zero-copy for float32 archives; int16 archives are scaled into a new array.
+        """
+        result = self.get(audiofile_id)
+        if result is None:
+            return None
+
+        view, sample_rate = result
+        if self.dtype == np.int16:
+            return view.astype(np.float32) / 32768.0, sample_rate
+
+        return view, sample_rate
+
+def load_index(index_path):
+    """Load an archive index, adding empty fields to entries of archives packed without them."""
+    index = np.load(index_path)
+    if index.dtype == INDEX_DTYPE:
+        return index
+
+    upgraded = np.zeros(len(index), dtype=INDEX_DTYPE)
+    for name in index.dtype.names:
+        upgraded[name] = index[name]
+    return upgraded
+
+def pack_audiofiles(audiofiles, archive_dir=DEFAULT_ARCHIVE_DIR, dtype="float32"):
+    """
+    Decode audio files and append them to a packed archive, creating it if needed.
+
+    Files already in the archive are skipped unless they were modified since they were packed;
+    those are packed again and their entry points at the new samples (the old ones stay in the
+    data file, unused). The index is rewritten atomically at the end, so readers never see
+    entries for samples that are not written yet.
+
+    Parameters:
+    - audiofiles (list): DBAudioFile objects (anything with id and absolute_path).
+    - archive_dir (str, optional): Directory of the archive. Defaults to DEFAULT_ARCHIVE_DIR.
+    - dtype (str, optional): "float32" or "int16". Must match an existing archive.
+
+    Returns:
+    - int: The number of stems added or refreshed.
+    """
+    if dtype not in ARCHIVE_DTYPES:
+        raise ValueError(f"Invalid dtype: {dtype}. Expected one of: {', '.join(ARCHIVE_DTYPES)}.")
+
+    os.makedirs(archive_dir, exist_ok=True)
+    meta_path = os.path.join(archive_dir, META_FILENAME)
+    index_path = os.path.join(archive_dir, INDEX_FILENAME)
+    samples_path = os.path.join(archive_dir, SAMPLES_FILENAME)
+
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            existing_dtype = json.load(f)["dtype"]
+        if existing_dtype != dtype:
+            raise ValueError(f"Archive {archive_dir} stores {existing_dtype}, not {dtype}.")
+        index = [tuple(entry) for entry in load_index(index_path)]
+    else:
+        with open(meta_path, "w") as f:
+            json.dump({"dtype": dtype}, f)
+        index = []
+
+    positions = {int(entry[0]): position for position, entry in enumerate(index)}
+    itemsize = np.dtype(dtype).itemsize
+    added = 0
+
+    with open(samples_path, "ab") as samples_file:
+        offset = samples_file.tell() // itemsize
+
+        for audiofile in audiofiles:
+            try:
+                stat = os.stat(audiofile.absolute_path)
+            except OSError as e:
+                print(f"An error occurred while packing {audiofile.absolute_path}: {str(e)}")
+                continue
+
+            position = positions.get(audiofile.id)
+            if position is not None and index[position][6:8] == (stat.st_mtime_ns, stat.st_size):
+                continue
+
+            try:
+                data, sample_rate = sf.read(audiofile.absolute_path, start=getattr(audiofile, "segment_start", None) or 0,
+                                            stop=getattr(audiofile, "segment_end", None), dtype=dtype)
+            except Exception as e:
+                print(f"An error occurred while packing {audiofile.absolute_path}: {str(e)}")
+                continue
+
+            channels = 1 if data.ndim == 1 else data.shape[1]
+            data = np.ascontiguousarray(data)
+            data.tofile(samples_file)
+
+            entry = (audiofile.id, offset, data.shape[0], channels, sample_rate, buffer_hash(data).encode("ascii"),
+                     stat.st_mtime_ns, stat.st_size)
+            if position is None:
+                positions[audiofile.id] = len(index)
+                index.append(entry)
+            else:
+                index[position] = entry
+            offset += data.size
+            added += 1
+
+    temp_index_path = f"{index_path}.tmp.npy"
+    np.save(temp_index_path, np.array(index, dtype=INDEX_DTYPE))
+    os.replace(temp_index_path, index_path)
+
+    return added
+
+if __name__ == "__main__":
+    from dbaudiofile import DBAudioFile
+    from database_setup import Session
+
+    parser = argparse.ArgumentParser(description="Pack decoded stems into a memory-mapped sample archive.")
+    parser.add_argument("--archive-dir", default=DEFAULT_ARCHIVE_DIR, help="Directory of the archive.")
+    parser.add_argument("--dtype", choices=ARCHIVE_DTYPES, default="float32", help="Sample format of the archive.")
+    parser.add_argument("--instrument-type", default=None, help="Only pack stems of this instrument type.")
+    args = parser.parse_args()
+
+    session = Session()
+    try:
+        query = session.query(DBAudioFile)
+        if args.instrument_type:
+            query = query.filter_by(instrument_type=args.instrument_type)
+        added = pack_audiofiles(query.all(), args.archive_dir, args.dtype)
+        print(f"Added {added} stems to {args.archive_dir}")
+    finally:
+        session.close()
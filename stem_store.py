@@ -0,0 +1,164 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import uuid
+from datetime import datetime
+import utilities
+
+OUTPUT_DIR = "./output"
+STORE_DIR = "./output/stems"
+MANIFEST_FILENAME = "manifest.json"
+
+FICLONE = 0x40049409  # Linux ioctl that clones a file's extents (btrfs, XFS, ...)
+
+def new_song_name(song_id=None):
+    """
+    Return a unique name for a generated song: a timestamp plus a random suffix.
+
+    Parameters:
+    - song_id (str, optional): Extra identifier appended to the name, e.g. the index within a batch.
+
+    Returns:
+    - str: The song name.
+    """
+    name = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    if song_id is not None:
+        name = f"{name}_{song_id}"
+    return name
+
+def reflink(source, destination):
+    """
+    Create destination as a copy-on-write clone of source.
+
+    Returns:
+    - bool: True if the filesystem supports cloning and the clone was made.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return False
+
+    try:
+        with open(source, "rb") as src, open(destination, "wb") as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return True
+    except OSError:
+        if os.path.exists(destination):
+            os.remove(destination)
+        return False
+
+def link_or_copy(source, destination):
+    """
+    Place source at destination as a reflink where the filesystem supports it, and as a full
+    copy otherwise. Never a hardlink: it would share the inode with the library file, so an
+    in-place edit of the sample would silently change the stored stem under its content hash.
+
+    Returns:
+    - str: "reflink" or "copy".
+    """
+    if reflink(source, destination):
+        return "reflink"
+
+    shutil.copy2(source, destination)
+    return "copy"
+
+def store_stem(path):
+    """
+    Add a file to the content-addressed stem store, unless it is already there.
+
+    Parameters:
+    - path (str): Path of the source audio file.
+
+    Returns:
+    - tuple: The SHA-256 digest of the file and its path inside the store.
+    """
+    digest = utilities.hash_file(path)
+    extension = os.path.splitext(path)[1] or ".wav"
+    stored_path = os.path.join(STORE_DIR, digest[:2], f"{digest}{extension}")
+
+    if not os.path.exists(stored_path):
+        os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+
+        # Link under a private name first so concurrent writers never expose a partial file
+        temp_path = f"{stored_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        link_or_copy(path, temp_path)
+        os.replace(temp_path, stored_path)
+
+    return digest, stored_path
+
+def write_json_atomic(path, data):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(data, f, indent=2, default=str)
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def write_song_manifest(song_name, output_path, audiofile_objects, gains, samplerate, tempo, key, render=None):
+    """
+    Store a song's source stems and record everything needed to render it again.
+
+    The manifest lands in ./output/<song_name>/manifest.json and lists, for every layer, the
+    DBAudioFile id, the content hash and stored path of the source file, the stretch factor and
+    the gain applied in the mix.
+
+    Parameters:
+    - song_name (str): Unique song name from new_song_name().
+    - output_path (str): Path of the rendered song.
+    - audiofile_objects (list): The stretched AudioFile objects that were mixed.
+    - gains (list): Linear gain applied to each layer.
+    - samplerate (int): Sample rate of the song.
+    - tempo (float): Tempo of the song.
+    - key (str): Musical key of the song.
+    - render (dict, optional): Renderer settings, e.g. repeats or the arrangement timeline.
+
+    Returns:
+    - str: The path of the manifest, or None if an error occurred.
+    """
+    try:
+        stems = []
+
+        for audiofile, gain in zip(audiofile_objects, gains):
+            source_path = getattr(audiofile, "source_path", None) or audiofile.absolute_path
+            digest, stored_path = store_stem(source_path)
+
+            stems.append({
+                "id": getattr(audiofile, "source_id", None),
+                "filename": audiofile.filename,
+                "instrument_type": audiofile.instrument_type,
+                "key": audiofile.key,
+                "source_path": source_path,
+                "hash": digest,
+                "stored_path": os.path.abspath(stored_path),
+                "stretch_factor": getattr(audiofile, "stretch_factor", None),
+                "segment_start": getattr(audiofile, "segment_start", None),
+                "segment_end": getattr(audiofile, "segment_end", None),
+                "gain": float(gain),
+            })
+
+        manifest = {
+            "song": song_name,
+            "output_path": os.path.abspath(output_path),
+            "created_at": datetime.now().isoformat(),
+            "key": key,
+            "tempo": tempo,
+            "sample_rate": samplerate,
+            "render": render or {},
+            "stems": stems,
+        }
+
+        manifest_path = os.path.join(OUTPUT_DIR, song_name, MANIFEST_FILENAME)
+        write_json_atomic(manifest_path, manifest)
+
+        return manifest_path
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+        return None
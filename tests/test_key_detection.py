@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+import key_detection
+
+SAMPLE_RATE = 44100
+
+def note_frequency(midi_note):
+    return 440.0 * 2 ** ((midi_note - 69) / 12)
+
+def bass_line(midi_notes, seconds_per_note=1.0):
+    """Pure sine notes played one after another, with short fades so note changes do not click."""
+    t = np.arange(int(seconds_per_note * SAMPLE_RATE)) / SAMPLE_RATE
+    envelope = np.minimum(1.0, np.minimum(t, t[::-1]) / 0.01)
+    return np.concatenate([
+        0.5 * envelope * np.sin(2 * np.pi * note_frequency(note) * t) for note in midi_notes
+    ]).astype(np.float32)
+
+def test_detects_a_key_rooted_in_the_bass_register():
+    # A minor arpeggio from A1 (55 Hz) to E2 (82 Hz), where N_FFT bins span several semitones
+    audio_data = bass_line([33, 36, 40, 33, 36, 40, 33, 33])
+
+    key, scale_mode, confidence = key_detection.detect_key(audio_data, SAMPLE_RATE)
+
+    assert (key, scale_mode) == ("A", "Minor")
+    assert confidence >= key_detection.CONFIDENCE_THRESHOLD
+
+@pytest.mark.parametrize("sample_rate", [22050, 44100, 48000, 96000])
+def test_low_band_resolves_semitones_down_to_the_minimum_frequency(sample_rate):
+    n_fft = key_detection.low_band_n_fft(sample_rate)
+
+    assert key_detection.resolved_frequency(sample_rate, n_fft) <= key_detection.MIN_FREQUENCY
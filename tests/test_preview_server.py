@@ -0,0 +1,63 @@
+from types import SimpleNamespace
+import numpy as np
+import pytest
+import soundfile as sf
+
+preview_server = pytest.importorskip("preview_server")
+pa = preview_server.pa
+gain_staging = preview_server.gain_staging
+
+SAMPLE_RATE = preview_server.PREVIEW_SAMPLE_RATE
+TEMPO = 120.0
+
+def sine(seconds, amplitude):
+    t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+    mono = amplitude * np.sin(2 * np.pi * 220.0 * t)
+    return np.stack([mono, mono], axis=1).astype(np.float32)
+
+def db_row(tmp_path, id, audio_data, prerendered_stems=()):
+    path = tmp_path / f"{id}.wav"
+    sf.write(path, audio_data, SAMPLE_RATE, subtype="FLOAT")
+    return SimpleNamespace(
+        id=id,
+        filename=f"{id}",
+        file_type="wav",
+        absolute_path=str(path),
+        directory_path=str(tmp_path),
+        key="C",
+        tempo=TEMPO,
+        instrument_type="melodic",
+        loudness=gain_staging.rms_db(audio_data),
+        sample_rate=SAMPLE_RATE,
+        length_in_samples=len(audio_data),
+        segment_start=None,
+        segment_end=None,
+        prerendered_stems=list(prerendered_stems),
+    )
+
+def mixed_level(mix, audiofile):
+    data, gain = mix.render_layer(audiofile, TEMPO)
+    return gain_staging.rms_db(data * gain)
+
+def test_prerendered_and_live_layers_mix_at_the_same_level(tmp_path, monkeypatch):
+    # Stretching at the source tempo is the identity; only the gain staging is under test
+    monkeypatch.setattr(pa.pyrb, "time_stretch", lambda y, sr, rate, rbargs=None: y)
+    monkeypatch.setattr(pa, "RENDER_CACHE", False)
+
+    source = sine(8.0, 0.5)  # Four bars at TEMPO, so the live render is not padded
+
+    # A prerendered stem is stored loudness-normalized, as prerender.py writes it
+    normalized = (source * gain_staging.db_to_gain(-20.0 - gain_staging.rms_db(source))).astype(np.float32)
+    stem_path = tmp_path / "prerendered.wav"
+    sf.write(stem_path, normalized, SAMPLE_RATE, subtype="FLOAT")
+    stem = SimpleNamespace(tempo=TEMPO, sample_rate=SAMPLE_RATE, loudness=gain_staging.rms_db(normalized),
+                           absolute_path=str(stem_path))
+
+    prerendered = db_row(tmp_path, 1, source, [stem])
+    live = db_row(tmp_path, 2, source)
+
+    mix = preview_server.PreviewMix(max_workers=1)
+    try:
+        assert mixed_level(mix, prerendered) == pytest.approx(mixed_level(mix, live), abs=0.1)
+    finally:
+        mix.executor.shutdown()
@@ -1,5 +1,9 @@
 import time
 import threading
+import hashlib
+import os
+
+_file_hashes = {}
 
 def time_function_execution(func, *args):
     results = {}  # To store the result of the function
@@ -31,3 +35,55 @@ def time_function_execution(func, *args):
     duration = end_time - start_time
     print(f"\nThe function took {duration:.2f} seconds to complete.")
     return results.get("output")
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """
+    Compute the SHA-256 digest of a file's contents.
+
+    Digests are memoized per (path, size, mtime) so repeated lookups of an unchanged file
+    within one process do not re-read it.
+
+    Args:
+        path (str): Path to the file.
+        chunk_size (int, optional): Number of bytes read per iteration.
+
+    Returns:
+        str: Hex digest of the file contents.
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    digest = _file_hashes.get(memo_key)
+    if digest is not None:
+        return digest
+
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    digest = sha.hexdigest()
+
+    _file_hashes[memo_key] = digest
+    return digest
+
+def get_audio_filepaths(directory_path, file_extensions=[". wav"]):
+    """
+    Retrieves all file paths with specified extensions in the given directory and its subdirectories.
+
+    Parameters:
+    - directory_path (str): The path to the directory to be searched.
+    - file_extensions (list of str, optional): A list of file extensions to be searched for (default is [".wav"]).
+
+    Returns:
+    - list of str: The paths to all files with the specified extensions in the directory structure.
+    """
+    audio_filepaths = []
+    
+    # Walk through root, dirs, and files in the directory
+    for root, dirs, files in os.walk(directory_path):
+        for file in files:
+            # Check if file ends with one of the desired extensions
+            if any(file.lower().endswith(ext) for ext in file_extensions):
+                # Construct full path to the audio file and append to list
+                audio_filepaths.append(os.path.join(root, file))
+    print(f"Total number of audio files found: {len(audio_filepaths)}")
+    return audio_filepaths
@@ -0,0 +1,348 @@
+import argparse
+import os
+import queue
+import time
+import analysis_sandbox
+import main_analysis
+import ingest_failures
+import analysis_profiles
+from analysis_sandbox import AnalysisSandbox
+from analysis_profiles import DEFAULT_PROFILE
+from sqlalchemy import bindparam, update
+import fingerprint
+from dbaudiofile import DBAudioFile, DBAudioFingerprint, DBFingerprintHash, DBPrerenderedStem
+from database_setup import Session
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+FILE_EXTENSIONS = [".wav"]
+POLL_INTERVAL = 2.0  # Seconds between scans when polling
+SETTLE_SECONDS = 3.0  # A file must keep the same size and mtime this long before it is analyzed
+
+def is_audio_path(path, file_extensions=FILE_EXTENSIONS):
+    return any(path.lower().endswith(ext) for ext in file_extensions)
+
+def file_signature(path):
+    """Return (size, mtime_ns) of a file, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+class WatchdogHandler(FileSystemEventHandler):
+    """Forward inotify (or other native) events for audio files into a queue."""
+
+    def __init__(self, events, file_extensions=FILE_EXTENSIONS):
+        self.events = events
+        self.file_extensions = file_extensions
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+
+        if event.event_type == "moved":
+            self.events.put(("moved", os.path.abspath(event.src_path), os.path.abspath(event.dest_path)))
+        elif event.event_type == "deleted":
+            self.events.put(("deleted", os.path.abspath(event.src_path)))
+        elif event.event_type in ("created", "modified", "closed"):
+            self.events.put(("changed", os.path.abspath(event.src_path)))
+
+class MtimePoller:
+    """
+    Detect changes by comparing snapshots of the directory tree.
+
+    Only audio files are stat'ed. A deleted path and a new path with the same inode, size and
+    mtime in one scan are reported as a move, so renamed samples keep their analysis.
+    """
+
+    def __init__(self, directory_path, events, file_extensions=FILE_EXTENSIONS):
+        self.directory_path = directory_path
+        self.events = events
+        self.file_extensions = file_extensions
+        self.snapshot = self.scan()
+
+    def scan(self):
+        snapshot = {}
+        directories = [self.directory_path]
+
+        while directories:
+            try:
+                entries = os.scandir(directories.pop())
+            except OSError:
+                continue
+
+            with entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            directories.append(entry.path)
+                        elif is_audio_path(entry.name, self.file_extensions):
+                            stat = entry.stat()
+                            snapshot[os.path.abspath(entry.path)] = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+                    except OSError:
+                        continue
+
+        return snapshot
+
+    def poll(self):
+        snapshot = self.scan()
+        previous = self.snapshot
+        self.snapshot = snapshot
+
+        deleted = {path: signature for path, signature in previous.items() if path not in snapshot}
+        created = {path: signature for path, signature in snapshot.items() if path not in previous}
+
+        # A rename keeps inode, size and mtime; matching all three avoids mistaking a reused inode for a move
+        deleted_by_signature = {signature: path for path, signature in deleted.items()}
+        for path, signature in created.items():
+            source = deleted_by_signature.pop(signature, None)
+            if source is not None:
+                del deleted[source]
+                self.events.put(("moved", source, path))
+            else:
+                self.events.put(("changed", path))
+
+        for path in deleted:
+            self.events.put(("deleted", path))
+
+        for path, signature in snapshot.items():
+            if path in previous and previous[path] != signature:
+                self.events.put(("changed", path))
+
+def delete_dependent_rows(session, audiofile_ids):
+    """Delete the fingerprints and prerendered stems of audio file rows."""
+    for table in (DBAudioFingerprint, DBFingerprintHash, DBPrerenderedStem):
+        session.query(table).filter(table.audiofile_id.in_(audiofile_ids)).delete(synchronize_session=False)
+
+def update_audio_files(audio_files, analyzed_paths=None):
+    """
+    Insert new audio files, or update the rows of files that were analyzed before.
+
+    Rows are matched by path and segment start, so the segments of a long file keep their ids
+    when it is re-analyzed; every row matching an analyzed segment is updated, and rows of
+    segments the file no longer has are deleted. A file that yielded no audio files at all
+    (rejected, or failed and recorded in ingest_failures) loses all its rows, since they
+    describe audio it no longer has. Prerendered stems of an updated row are dropped, since
+    they were rendered from the old audio.
+
+    Like the other ingest paths, everything is written with executemany Core statements
+    (main_analysis.insert_audio_files for new rows) instead of through ORM objects.
+
+    Parameters:
+    - audio_files (list): The AudioFiles the analysis produced.
+    - analyzed_paths (list, optional): Every path that was analyzed, including those without
+      results. Defaults to the paths of audio_files.
+    """
+    session = Session()
+
+    try:
+        result_paths = list(dict.fromkeys(audio_file.absolute_path for audio_file in audio_files))
+        paths = list(dict.fromkeys(result_paths + list(analyzed_paths or [])))
+        existing = {}  # (path, segment start) -> ids of the rows of that segment
+        for row_id, path, segment_start in session.query(DBAudioFile.id, DBAudioFile.absolute_path, DBAudioFile.segment_start) \
+                .filter(DBAudioFile.absolute_path.in_(paths)):
+            existing.setdefault((path, segment_start), []).append(row_id)
+
+        new_files = []
+        updated = []  # (row id, AudioFile)
+        for audio_file in audio_files:
+            row_ids = existing.pop((audio_file.absolute_path, audio_file.segment_start), None)
+            if row_ids is None:
+                new_files.append(audio_file)
+            else:
+                updated.extend((row_id, audio_file) for row_id in row_ids)
+
+        if updated:
+            updated_ids = [row_id for row_id, audio_file in updated]
+            table = DBAudioFile.__table__
+            session.execute(
+                update(table).where(table.c.id == bindparam("row_id")),
+                [{"row_id": row_id, **audio_file.validate().to_row()} for row_id, audio_file in updated],
+            )
+            delete_dependent_rows(session, updated_ids)
+            fingerprint.insert_fingerprints(session, [(row_id, audio_file.fingerprint) for row_id, audio_file in updated])
+
+        main_analysis.insert_audio_files(session, new_files)
+
+        # Whatever is left are segments the files no longer have
+        stale_ids = [row_id for row_ids in existing.values() for row_id in row_ids]
+        if stale_ids:
+            session.query(DBAudioFile).filter(DBAudioFile.duplicate_of.in_(stale_ids)).update(
+                {"duplicate_of": None}, synchronize_session=False)
+            delete_dependent_rows(session, stale_ids)
+            session.query(DBAudioFile).filter(DBAudioFile.id.in_(stale_ids)).delete(synchronize_session=False)
+
+        ingest_failures.clear_failures(session, result_paths)
+        session.commit()
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+        session.rollback()
+    finally:
+        session.close()
+
+def remove_audio_files(paths):
+    session = Session()
+
+    try:
+        rows = session.query(DBAudioFile).filter(DBAudioFile.absolute_path.in_(paths)).all()
+
+        # Copies of a removed original no longer point at a missing row
+        removed_ids = [row.id for row in rows]
+        session.query(DBAudioFile).filter(DBAudioFile.duplicate_of.in_(removed_ids)).update(
+            {"duplicate_of": None}, synchronize_session=False)
+
+        for row in rows:
+            session.delete(row)
+        session.commit()
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+        session.rollback()
+    finally:
+        session.close()
+
+def move_audio_file(source_path, dest_path):
+    """
+    Point the rows of a moved file (one per segment for long files) at its new path. The audio
+    did not change, so it is not analyzed again.
+
+    Returns:
+    - bool: False if the source had no row, in which case the destination should be analyzed.
+    """
+    session = Session()
+
+    try:
+        rows = session.query(DBAudioFile).filter_by(absolute_path=source_path).all()
+        if not rows:
+            return False
+
+        directory_path, filename = os.path.split(dest_path)
+        for row in rows:
+            row.absolute_path = dest_path
+            row.directory_path = directory_path
+            row.filename = os.path.splitext(filename)[0]
+        session.commit()
+        return True
+    except Exception as e:
+        print(f"An error occurred: {str(e)}")
+        session.rollback()
+        return False
+    finally:
+        session.close()
+
+def analyze_paths(paths, sandbox, profile=DEFAULT_PROFILE):
+    audio_files = []
+    pitch_queue = []
+
+    for path in paths:
+        audio_files.extend(main_analysis.analyze_isolated(sandbox, path, pitch_queue, profile))
+
+    failed_paths = main_analysis.pitch_isolated(sandbox, pitch_queue)
+    update_audio_files([audio_file for audio_file in audio_files if audio_file.absolute_path not in failed_paths], paths)
+
+def watch(directory_path, sandbox, poll_interval=POLL_INTERVAL, settle_seconds=SETTLE_SECONDS,
+          file_extensions=FILE_EXTENSIONS, force_polling=False, profile=DEFAULT_PROFILE):
+    """
+    Keep the database in sync with a directory tree until interrupted.
+
+    Uses native file system events through watchdog when it is installed, otherwise polls
+    mtimes every poll_interval seconds. Created or modified files are analyzed once their size
+    and mtime have been stable for settle_seconds, so files that are still being copied are
+    not analyzed half-written. Deleted files lose their rows and moved files keep them.
+
+    Parameters:
+    - directory_path (str): Root directory of the audio samples.
+    - sandbox (AnalysisSandbox): Process that analyzes files under time and memory limits.
+    - poll_interval (float, optional): Seconds between scans or event checks.
+    - settle_seconds (float, optional): Quiet period before a changed file is analyzed.
+    - file_extensions (list, optional): Extensions of the files to watch.
+    - force_polling (bool, optional): Poll even if watchdog is available.
+    - profile (str, optional): Analysis profile for new and changed files.
+    """
+    directory_path = os.path.abspath(directory_path)
+    events = queue.Queue()
+    pending = {}  # Path -> (signature, time the signature was last seen changing)
+
+    observer = None
+    poller = None
+    if Observer is not None and not force_polling:
+        observer = Observer()
+        observer.schedule(WatchdogHandler(events, file_extensions), directory_path, recursive=True)
+        observer.start()
+        print(f"Watching {directory_path} for file system events")
+    else:
+        poller = MtimePoller(directory_path, events, file_extensions)
+        print(f"Polling {directory_path} every {poll_interval} seconds")
+
+    try:
+        while True:
+            time.sleep(poll_interval)
+            if poller is not None:
+                poller.poll()
+
+            deleted = []
+            while True:
+                try:
+                    event = events.get_nowait()
+                except queue.Empty:
+                    break
+
+                if event[0] == "moved":
+                    source_path, dest_path = event[1], event[2]
+                    pending.pop(source_path, None)
+                    if is_audio_path(dest_path, file_extensions) and not move_audio_file(source_path, dest_path):
+                        pending[dest_path] = (None, time.monotonic())
+                    elif not is_audio_path(dest_path, file_extensions) and is_audio_path(source_path, file_extensions):
+                        deleted.append(source_path)
+                elif not is_audio_path(event[1], file_extensions):
+                    continue
+                elif event[0] == "deleted":
+                    pending.pop(event[1], None)
+                    deleted.append(event[1])
+                else:
+                    pending[event[1]] = (None, time.monotonic())
+
+            if deleted:
+                remove_audio_files(deleted)
+                print(f"Removed {len(deleted)} audio files")
+
+            now = time.monotonic()
+            settled = []
+            for path, (signature, changed_at) in list(pending.items()):
+                current = file_signature(path)
+                if current is None:
+                    del pending[path]
+                elif current != signature:
+                    pending[path] = (current, now)
+                elif now - changed_at >= settle_seconds:
+                    del pending[path]
+                    settled.append(path)
+
+            if settled:
+                analyze_paths(settled, sandbox, profile)
+                print(f"Analyzed {len(settled)} audio files")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Continuously ingest audio samples added to a directory.")
+    parser.add_argument("--directory", default=main_analysis.directory_path, help="Root directory of the audio samples.")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL, help="Seconds between checks.")
+    parser.add_argument("--settle-seconds", type=float, default=SETTLE_SECONDS, help="Quiet period before a changed file is analyzed.")
+    parser.add_argument("--force-polling", action="store_true", help="Poll mtimes even if watchdog is installed.")
+    parser.add_argument("--profile", default=DEFAULT_PROFILE, choices=analysis_profiles.PROFILE_ORDER, help="Analysis profile.")
+    parser.add_argument("--timeout", type=float, default=analysis_sandbox.FILE_TIMEOUT_SECONDS, help="Seconds allowed per file.")
+    parser.add_argument("--memory-limit-mb", type=float, default=analysis_sandbox.FILE_MEMORY_LIMIT_MB, help="Memory allowed for the analysis process.")
+    args = parser.parse_args()
+
+    with AnalysisSandbox(args.timeout, args.memory_limit_mb) as sandbox:
+        watch(args.directory, sandbox, args.poll_interval, args.settle_seconds, force_polling=args.force_polling, profile=args.profile)